@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from core.charts import render_charts
+from core.pipeline import load_jmeter_file, load_perfmon_files, filter_jmeter_data, filter_perfmon_data, merge_for_correlation, correlate_merged_data
+from benchmarks.synthetic import generate_jmeter_csv, generate_perfmon_csv, leading_counter_name
+
+# Times each pipeline stage on synthetic data at a chosen scale and checks that the planted correlations are
+# recovered. Run from the repository root:
+#   python -m benchmarks.run_benchmarks --scale medium [--baseline baseline.json] [--save baseline.json]
+
+scales = {
+    'small': {'rows': 100_000, 'labels': 20, 'response_codes': 4, 'servers': 2, 'counters': 50, 'duration_seconds': 3600},
+    'medium': {'rows': 2_000_000, 'labels': 100, 'response_codes': 6, 'servers': 4, 'counters': 250, 'duration_seconds': 4 * 3600},
+    'large': {'rows': 20_000_000, 'labels': 500, 'response_codes': 10, 'servers': 8, 'counters': 1000, 'duration_seconds': 8 * 3600},
+}
+
+planted_labels = 2
+planted_counters = 2
+lead_buckets = 2
+min_correlation = 0.8
+
+
+def timed(timings, stage, function, *arguments, **keyword_arguments):
+    stage_start = time.perf_counter()
+    result = function(*arguments, **keyword_arguments)
+    timings[stage] = time.perf_counter() - stage_start
+    return result
+
+
+def run_benchmark(scale, folder, charts=20, seed=0):
+    timings = {}
+    servers = [f"SERVER{index:02d}" for index in range(scale['servers'])]
+
+    # Generate the data (not timed as part of the pipeline)
+    jmeter_path = os.path.join(folder, 'jmeter.csv')
+    planted_label_names = timed(timings, 'generate_jmeter', generate_jmeter_csv, jmeter_path, scale['rows'], scale['labels'], scale['response_codes'],
+                                scale['duration_seconds'], planted_labels, seed=seed)
+    perfmon_paths = []
+    planted_counter_names = []
+    generate_start = time.perf_counter()
+    for server in servers:
+        perfmon_path = os.path.join(folder, f'perfmon_{server}.csv')
+        planted_counter_names += generate_perfmon_csv(perfmon_path, server, scale['counters'], scale['duration_seconds'], planted_counters=planted_counters,
+                                                      lead_buckets=lead_buckets if server == servers[0] else None, seed=seed)
+        perfmon_paths.append(perfmon_path)
+    timings['generate_perfmon'] = time.perf_counter() - generate_start
+
+    # The synthetic JTL and Perfmon files share a clock, so no timezone offset is applied
+    formatted_jmeter_data, _ = timed(timings, 'ingest_jmeter', load_jmeter_file, jmeter_path, utc_offset_hours=0)
+    formatted_perfmon_data = timed(timings, 'ingest_perfmon', load_perfmon_files, perfmon_paths)
+
+    filter_start = time.perf_counter()
+    formatted_jmeter_data = filter_jmeter_data(formatted_jmeter_data)
+    formatted_perfmon_data = filter_perfmon_data(formatted_perfmon_data, ['*Synthetic*'])
+    timings['filter'] = time.perf_counter() - filter_start
+
+    merged_data = timed(timings, 'preprocess', merge_for_correlation, formatted_perfmon_data, formatted_jmeter_data)
+    correlation_results = timed(timings, 'correlate', correlate_merged_data, merged_data)
+    lagged_results = timed(timings, 'correlate_lagged', correlate_merged_data, merged_data, max_lag=lead_buckets + 2)
+
+    correlation_start, correlation_end = correlation_results.range(min_correlation, 1.0)
+    correlations = correlation_results.to_frame(correlation_start, correlation_end)
+    timed(timings, 'render', render_charts, merged_data, correlations.head(charts), folder=os.path.join(folder, 'charts'))
+
+    # Every planted transaction should correlate with every planted counter, and nothing else should
+    planted_pairs = {(f'jmeter_label_{label}', f'perfmon_{counter}') for label in planted_label_names for counter in planted_counter_names}
+    found_pairs = set(zip(correlations[0], correlations[1]))
+    missing_pairs = planted_pairs - found_pairs
+    unexpected_pairs = {pair for pair in found_pairs - planted_pairs if 'Leading' not in pair[1]}
+
+    # The lag scan should find the leading counter lead_buckets ahead of the planted transactions
+    lagged_correlations = lagged_results.to_frame(0, len(lagged_results))
+    leading_lags = lagged_correlations[(lagged_correlations[1] == f'perfmon_{leading_counter_name(servers[0])}') & lagged_correlations[0].isin([f'jmeter_label_{label}' for label in planted_label_names])][3]
+    wrong_lags = int((leading_lags != lead_buckets).sum())
+
+    return {
+        'scale': scale,
+        'timings': timings,
+        'pairs': len(correlation_results),
+        'planted_pairs': len(planted_pairs),
+        'missing_pairs': sorted(missing_pairs),
+        'unexpected_pairs': sorted(unexpected_pairs),
+        'wrong_lags': wrong_lags,
+        'passed': not missing_pairs and not unexpected_pairs and wrong_lags == 0 and len(leading_lags) == planted_labels,
+    }
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    # Return the stages that took more than tolerance times as long as in the baseline
+    return {stage: (baseline['timings'][stage], seconds) for stage, seconds in result['timings'].items()
+            if stage in baseline['timings'] and not stage.startswith('generate') and seconds > baseline['timings'][stage] * tolerance}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmark the correlation pipeline on synthetic data with planted correlations.")
+    parser.add_argument("--scale", choices=scales.keys(), default='small')
+    parser.add_argument("--rows", type=int, help="Override the number of JTL samples")
+    parser.add_argument("--labels", type=int, help="Override the number of JMeter labels")
+    parser.add_argument("--response-codes", type=int, help="Override the number of response codes")
+    parser.add_argument("--servers", type=int, help="Override the number of Perfmon servers")
+    parser.add_argument("--counters", type=int, help="Override the number of counters per server")
+    parser.add_argument("--duration", type=int, dest="duration_seconds", help="Override the test duration in seconds")
+    parser.add_argument("--charts", type=int, default=20, help="Number of charts to render (default 20)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--folder", help="Folder for the generated files (default: a temporary folder)")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare the stage timings with")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed slowdown against the baseline (default 1.5x)")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    arguments = parser.parse_args(arguments)
+
+    scale = dict(scales[arguments.scale])
+    for setting in scale:
+        if getattr(arguments, setting, None) is not None:
+            scale[setting] = getattr(arguments, setting)
+
+    if arguments.folder:
+        os.makedirs(arguments.folder, exist_ok=True)
+        result = run_benchmark(scale, arguments.folder, arguments.charts, arguments.seed)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            result = run_benchmark(scale, folder, arguments.charts, arguments.seed)
+
+    print(f"Scale: {scale}")
+    for stage, seconds in result['timings'].items():
+        print(f"  {stage:<18}{seconds:>10.3f}s")
+    print(f"{result['pairs']} pairs correlated, {result['planted_pairs']} planted, {len(result['missing_pairs'])} missed, "
+          f"{len(result['unexpected_pairs'])} unexpected, {result['wrong_lags']} wrong lags")
+
+    exit_code = 0 if result['passed'] else 1
+    if not result['passed']:
+        print("FAILED: the planted correlations were not recovered")
+
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['scale'] != scale:
+            print(f"The baseline was run at a different scale ({baseline['scale']}), so the timings are not compared")
+            baseline = {'timings': {}}
+        slower_stages = compare_with_baseline(result, baseline, arguments.tolerance)
+        for stage, (baseline_seconds, seconds) in slower_stages.items():
+            print(f"SLOWER: {stage} took {seconds:.3f}s against {baseline_seconds:.3f}s in the baseline")
+        if slower_stages:
+            exit_code = 1
+
+    if arguments.save:
+        with open(arguments.save, 'w') as save_file:
+            json.dump(result, save_file, indent=2, default=str)
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import zlib
+import numpy as np
+import pandas as pd
+from core.perfmon import pdh_timestamp_format
+
+# Synthetic JTL and Perfmon CSV generators with planted correlations. A hidden load signal drives the
+# response times of the "Planted" transactions and the values of the "Planted" counters (and of a "Leading"
+# counter that runs lead_buckets ahead of it); every other transaction and counter is independent noise.
+
+default_start = pd.Timestamp('2024-01-01 09:00:00')
+
+
+def load_signal(duration_seconds, seed=0):
+    # Per-second load signal between 0 and 1 (a few slow waves plus a random walk)
+    rng = np.random.default_rng(seed)
+    seconds = np.arange(duration_seconds)
+    signal = np.zeros(duration_seconds)
+    for period in (1800, 600, 240):
+        signal += np.sin(2 * np.pi * seconds / period + rng.uniform(0, 2 * np.pi))
+    signal += np.cumsum(rng.normal(scale=0.05, size=duration_seconds))
+    return (signal - signal.min()) / (signal.max() - signal.min())
+
+
+def planted_label_name(index):
+    return f"Planted Transaction {index}"
+
+
+def planted_counter_name(server, index):
+    return f"\\\\{server}\\Synthetic(_Total)\\Planted {index}"
+
+
+def leading_counter_name(server):
+    return f"\\\\{server}\\Synthetic(_Total)\\Leading"
+
+
+def generate_jmeter_csv(path, rows, labels=20, response_codes=4, duration_seconds=3600, planted_labels=2,
+                        start=default_start, seed=0, chunk_rows=1_000_000):
+    # Write a JTL CSV of rows samples spread over duration_seconds. The first planted_labels labels get
+    # response times that follow the load signal. Written in chunks so large files use little memory.
+    rng = np.random.default_rng(seed + 1)
+    signal = load_signal(duration_seconds, seed)
+    label_names = [planted_label_name(index) for index in range(planted_labels)]
+    label_names += [f"Transaction {index}" for index in range(labels - planted_labels)]
+    label_base = rng.uniform(50, 2000, size=labels)
+    codes = np.array([200, 302, 404, 500, 503, 400, 401, 403, 502, 504][:max(1, response_codes)])
+    code_weights = np.array([0.9] + [0.1 / (len(codes) - 1)] * (len(codes) - 1)) if len(codes) > 1 else np.array([1.0])
+    start_epoch_ms = int(start.value // 1_000_000)
+
+    written_rows = 0
+    with open(path, 'w', newline='') as jmeter_file:
+        jmeter_file.write("timeStamp,elapsed,label,responseCode,responseMessage,threadName,success,bytes\n")
+        while written_rows < rows:
+            chunk_size = min(chunk_rows, rows - written_rows)
+            offsets = rng.integers(0, duration_seconds * 1000, size=chunk_size)
+            label_index = rng.integers(0, labels, size=chunk_size)
+            load = np.where(label_index < planted_labels, 1 + 3 * signal[offsets // 1000], 1.0)
+            elapsed = np.maximum(1, label_base[label_index] * load * rng.lognormal(0, 0.3, size=chunk_size)).astype(np.int64)
+            response_code = rng.choice(codes, size=chunk_size, p=code_weights)
+
+            chunk = pd.DataFrame({
+                'timeStamp': start_epoch_ms + offsets,
+                'elapsed': elapsed,
+                'label': np.array(label_names, dtype=object)[label_index],
+                'responseCode': response_code,
+                'responseMessage': np.where(response_code < 400, 'OK', 'Error'),
+                'threadName': 'Thread Group 1-1',
+                'success': np.where(response_code < 400, 'true', 'false'),
+                'bytes': rng.integers(200, 50000, size=chunk_size),
+            })
+            chunk.to_csv(jmeter_file, header=False, index=False)
+            written_rows += chunk_size
+
+    return [planted_label_name(index) for index in range(planted_labels)]
+
+
+def generate_perfmon_csv(path, server, counters=50, duration_seconds=3600, sample_seconds=15, planted_counters=2,
+                         lead_buckets=None, bucket_seconds=60, start=default_start, seed=0):
+    # Write a relog-style CSV for one server with a counter per column sampled every sample_seconds. The
+    # planted counters follow the load signal; with lead_buckets a "Leading" counter follows the signal
+    # lead_buckets time buckets ahead of time. The other counters are noise.
+    rng = np.random.default_rng(seed + zlib.crc32(server.encode()))
+    signal = load_signal(duration_seconds + (lead_buckets or 0) * bucket_seconds, seed)
+    sample_offsets = np.arange(0, duration_seconds, sample_seconds)
+
+    perfmon_data = {"(PDH-CSV 4.0) (GMT Standard Time)(0)": (start + pd.to_timedelta(sample_offsets, unit='s')).strftime(pdh_timestamp_format).str[:-3]}
+    for index in range(planted_counters):
+        perfmon_data[planted_counter_name(server, index)] = 100 * signal[sample_offsets] + rng.normal(scale=2, size=len(sample_offsets))
+    if lead_buckets:
+        perfmon_data[leading_counter_name(server)] = 100 * signal[sample_offsets + lead_buckets * bucket_seconds] + rng.normal(scale=2, size=len(sample_offsets))
+    for index in range(counters - planted_counters - (1 if lead_buckets else 0)):
+        perfmon_data[f"\\\\{server}\\Synthetic(_Total)\\Counter {index}"] = rng.uniform(0, 100, size=len(sample_offsets))
+
+    pd.DataFrame(perfmon_data).round(3).to_csv(path, index=False)
+    return [planted_counter_name(server, index) for index in range(planted_counters)]
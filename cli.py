@@ -0,0 +1,49 @@
+import argparse
+import sys
+from core.pipeline import run_pipeline
+from core.pyramid import bucket_intervals, default_interval
+
+# Headless entry point for the ingest -> filter -> correlate pipeline, e.g.
+#   python cli.py results.jtl web01.csv db01.csv --output runs/nightly --counter "*Processor*" --charts
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="Correlate JMeter results with Windows Performance Monitor logs without the browser.")
+    parser.add_argument("jmeter_file", help="JMeter .JTL/.CSV results file")
+    parser.add_argument("perfmon_files", nargs="+", help="One or more Perfmon .CSV (or, on Windows, .BLG) files")
+    parser.add_argument("--output", "-o", required=True, help="Folder to write correlations.csv, merged.parquet and the charts to")
+    parser.add_argument("--interval", choices=bucket_intervals, default=default_interval, help=f"Time bucket size (default {default_interval})")
+    parser.add_argument("--label", action="append", dest="labels", help="Only keep JMeter labels matching this name or glob (repeatable)")
+    parser.add_argument("--response-code", action="append", dest="response_codes", help="Only keep response codes matching this code or glob (repeatable)")
+    parser.add_argument("--counter", action="append", dest="counter_patterns", help="Only keep Perfmon counters matching this substring or glob (repeatable)")
+    parser.add_argument("--server", default="", help="Only keep Perfmon counters from this server")
+    parser.add_argument("--method", choices=["Pearson", "Spearman"], default="Pearson", help="Correlation method (default Pearson)")
+    parser.add_argument("--max-lag", type=int, default=None, help="Scan lags of up to this many time buckets")
+    parser.add_argument("--top-k", type=int, default=None, help="Only keep this many of the most correlated counters for each transaction")
+    parser.add_argument("--min-correlation", type=float, default=0.8, help="Minimum absolute correlation to report (default 0.8)")
+    parser.add_argument("--max-correlation", type=float, default=1.0, help="Maximum absolute correlation to report (default 1.0)")
+    parser.add_argument("--charts", action="store_true", help="Render a chart for every reported correlation")
+    parser.add_argument("--workers", type=int, default=None, help="Number of chart rendering processes (default: one per CPU)")
+    parser.add_argument("--utc-offset", type=float, default=None, help="Hours to add to the JMeter timestamps to match the Perfmon clock (default: this machine's offset)")
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    arguments = parse_arguments(arguments)
+    try:
+        correlations = run_pipeline(arguments.jmeter_file, arguments.perfmon_files, arguments.output,
+                                    interval=arguments.interval, labels=arguments.labels, response_codes=arguments.response_codes,
+                                    counter_patterns=arguments.counter_patterns, server=arguments.server, method=arguments.method,
+                                    max_lag=arguments.max_lag, min_correlation=arguments.min_correlation,
+                                    max_correlation=arguments.max_correlation, charts=arguments.charts,
+                                    max_workers=arguments.workers, utc_offset_hours=arguments.utc_offset, top_k=arguments.top_k)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    print(f"{len(correlations)} correlations found between {arguments.min_correlation * 100:g}% and {arguments.max_correlation * 100:g}%. Results written to {arguments.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
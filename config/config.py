@@ -1,4 +1,5 @@
 import streamlit as st
+from core.workspace import session_workspace
 
 def set_page_config():
     st.set_page_config(
@@ -18,4 +19,7 @@ def set_page_config():
     </style>
     """,
         unsafe_allow_html=True,
-    )
\ No newline at end of file
+    )
+
+    # Every page view keeps this session's workspace from expiring
+    session_workspace(st.session_state)
\ No newline at end of file
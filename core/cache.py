@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+from core.storage import save_formatted_data, load_formatted_data, formatted_data_path
+
+# Folder holding previously processed uploads, and the maximum size it may grow to before
+# the least recently used entries are removed
+cache_folder = "cache_data"
+cache_max_bytes = 10 * 1024 ** 3
+
+# Size of the blocks fed to the hash function
+hash_block_size = 16 * 1024 * 1024
+
+
+def hash_upload(file_buffer, parameters):
+    # Build a cache key from the uploaded bytes (one buffer, or a list of buffers for a multi-file upload)
+    # plus the parameters used to process them
+    file_hash = hashlib.blake2b(digest_size=32)
+    file_buffers = file_buffer if isinstance(file_buffer, (list, tuple)) else [file_buffer]
+    for buffer in file_buffers:
+        file_view = memoryview(buffer)
+        if len(file_buffers) > 1:
+            # Separate the files so that moving bytes from one file to the next changes the key
+            file_hash.update(len(file_view).to_bytes(8, 'little'))
+        for offset in range(0, len(file_view), hash_block_size):
+            file_hash.update(file_view[offset:offset + hash_block_size])
+    file_hash.update(json.dumps(parameters, sort_keys=True, default=str).encode('utf-8'))
+    return file_hash.hexdigest()
+
+
+def _metadata_path(key, folder):
+    return os.path.join(folder, f"{key}.json")
+
+
+def load_cached_frame(key, folder=cache_folder):
+    # Return the (data, metadata) previously cached under the key, or (None, None) if there is no entry
+    data_path = formatted_data_path(key, folder)
+    metadata_path = _metadata_path(key, folder)
+    if not (os.path.exists(data_path) and os.path.exists(metadata_path)):
+        return None, None
+
+    try:
+        data = load_formatted_data(key, folder=folder)
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+    except Exception:
+        # A damaged entry is treated as a cache miss and removed
+        remove_cached_frame(key, folder)
+        return None, None
+
+    # Mark the entry as recently used
+    os.utime(data_path)
+    os.utime(metadata_path)
+    return data, metadata
+
+
+def save_cached_frame(key, data, metadata=None, folder=cache_folder, max_bytes=cache_max_bytes, evict=True):
+    # Cache a processed dataframe (plus any small metadata) and trim the cache back to its size limit
+    save_formatted_data(data, key, folder)
+    with open(_metadata_path(key, folder), "w") as f:
+        json.dump(metadata or {}, f, default=str)
+    if evict:
+        evict_cache(max_bytes, folder, keep=key)
+
+
+def remove_cached_frame(key, folder=cache_folder):
+    for file_path in (formatted_data_path(key, folder), _metadata_path(key, folder)):
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def _entry_key(cache_key):
+    # The levels of a pyramid are cached as <key>_<interval> and evicted together under <key>
+    return cache_key.partition('_')[0]
+
+
+def evict_cache(max_bytes=cache_max_bytes, folder=cache_folder, keep=None):
+    # Remove the least recently used entries (a whole pyramid at a time) until the cache fits within
+    # max_bytes. The entry of the keep key is never removed.
+    if not os.path.isdir(folder):
+        return
+
+    entries = {}
+    for filename in os.listdir(folder):
+        cache_key, _ = os.path.splitext(filename)
+        try:
+            file_stat = os.stat(os.path.join(folder, filename))
+        except FileNotFoundError:
+            # Removed by another session while the folder was being listed
+            continue
+        size, last_used, cache_keys = entries.get(_entry_key(cache_key), (0, 0, set()))
+        entries[_entry_key(cache_key)] = (size + file_stat.st_size, max(last_used, file_stat.st_mtime), cache_keys | {cache_key})
+
+    total_bytes = sum(size for size, _, _ in entries.values())
+    for entry_key, (size, _, cache_keys) in sorted(entries.items(), key=lambda entry: entry[1][1]):
+        if total_bytes <= max_bytes:
+            break
+        if keep is not None and entry_key == _entry_key(keep):
+            continue
+        for cache_key in cache_keys:
+            remove_cached_frame(cache_key, folder)
+        total_bytes -= size
+
+
+def load_cached_pyramid(key, intervals, folder=cache_folder):
+    # Return the ({interval: data}, metadata) cached for every interval, or (None, None) if any level is missing
+    pyramid = {}
+    metadata = None
+    for interval in intervals:
+        data, metadata = load_cached_frame(f"{key}_{interval}", folder)
+        if data is None:
+            return None, None
+        pyramid[interval] = data
+    return pyramid, metadata
+
+
+def save_cached_pyramid(key, pyramid, metadata=None, folder=cache_folder, max_bytes=cache_max_bytes):
+    # Cache every level of a pre-aggregated pyramid of frames, then trim the cache once with the whole
+    # pyramid protected
+    for interval, data in pyramid.items():
+        save_cached_frame(f"{key}_{interval}", data, metadata, folder, max_bytes, evict=False)
+    evict_cache(max_bytes, folder, keep=key)
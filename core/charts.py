@@ -0,0 +1,128 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Folder the correlation charts are written to
+chart_folder = "chart_data"
+
+# With this many charts or fewer to draw they are drawn in the calling process, as starting worker
+# processes (which each import matplotlib and seaborn) would take longer than drawing them
+inline_chart_limit = 4
+
+_chart_pool = None
+_chart_pool_workers = None
+_chart_pool_lock = threading.Lock()
+
+
+def chart_pool(max_workers):
+    # The worker pool shared by every call (and every session) of this process. It is only replaced when a
+    # different number of workers is asked for or a worker has died.
+    global _chart_pool, _chart_pool_workers
+    with _chart_pool_lock:
+        if _chart_pool is None or _chart_pool_workers != max_workers or getattr(_chart_pool, '_broken', False):
+            if _chart_pool is not None:
+                _chart_pool.shutdown(wait=False)
+            _chart_pool = ProcessPoolExecutor(max_workers=max_workers)
+            _chart_pool_workers = max_workers
+        return _chart_pool
+
+
+def chart_filename(jmeter_column, perfmon_column, folder=chart_folder):
+    fig_filename = f"{jmeter_column}_{perfmon_column}.png".replace("\\", "_").replace("%", "_").replace("/", "_")
+    return os.path.join(folder, fig_filename)
+
+
+def render_chart(fig_filename, chart_data, jmeter_column, perfmon_column, correlation):
+    # Draw a single correlation chart to a PNG file. Runs inside a worker process, so only the two
+    # columns being charted are passed in and the non-interactive Agg backend is used.
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    import seaborn as sns
+
+    jmeter_column_name = f"(JMeter) {jmeter_column.replace('jmeter_', '')}"
+    perfmon_column_name = f"(Perfmon) {perfmon_column.replace('perfmon_', '')}"
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    sns.lineplot(data=chart_data, x=chart_data.index, y=jmeter_column, ax=ax, label=jmeter_column_name)
+    sns.lineplot(data=chart_data, x=chart_data.index, y=perfmon_column, ax=ax, label=perfmon_column_name)
+    if correlation < 0:
+        ax.set_title(f"{correlation*100:.2f}% (Negative Correlation)")
+    elif correlation == 0:
+        ax.set_title(f"{correlation*100:.2f}% (Correlation)")
+    else:
+        ax.set_title(f"{correlation*100:.2f}% (Positive Correlation)")
+    ax.set_xlabel("Time")
+    ax.set_ylabel("Normalised Value")
+    ax.legend()
+    # Format x-axis to display time as hh:mm
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    fig.savefig(fig_filename, format='png')
+    plt.close(fig)
+    return fig_filename
+
+
+def render_charts(merged_data, correlations, max_workers=None, progress_callback=None, folder=chart_folder):
+    # Render the charts for a dataframe of (jmeter column, perfmon column, correlation) rows across the
+    # shared pool of worker processes, or in this process when there are only a few. Charts that already
+    # exist are skipped. progress_callback(completed, total) is called from the calling thread as each
+    # chart finishes.
+    os.makedirs(folder, exist_ok=True)
+
+    pending_charts = []
+    for jmeter_column, perfmon_column, correlation in zip(correlations[0], correlations[1], correlations[2]):
+        fig_filename = chart_filename(jmeter_column, perfmon_column, folder)
+        if not os.path.exists(fig_filename):
+            pending_charts.append((fig_filename, jmeter_column, perfmon_column, correlation))
+
+    total_charts = len(pending_charts)
+    if total_charts == 0:
+        if progress_callback:
+            progress_callback(0, 0)
+        return 0
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, max_workers)
+    completed_charts = 0
+
+    if total_charts <= inline_chart_limit or max_workers == 1:
+        for fig_filename, jmeter_column, perfmon_column, correlation in pending_charts:
+            render_chart(fig_filename, merged_data[[jmeter_column, perfmon_column]], jmeter_column, perfmon_column, correlation)
+            completed_charts += 1
+            if progress_callback:
+                progress_callback(completed_charts, total_charts)
+        return completed_charts
+
+    # Only keep a few charts queued per worker so the pending chart data stays small
+    max_in_flight = max_workers * 4
+
+    def collect(futures):
+        nonlocal completed_charts
+        for future in futures:
+            future.result()
+            completed_charts += 1
+            if progress_callback:
+                progress_callback(completed_charts, total_charts)
+
+    executor = chart_pool(max_workers)
+    in_flight = set()
+    try:
+        for fig_filename, jmeter_column, perfmon_column, correlation in pending_charts:
+            chart_data = merged_data[[jmeter_column, perfmon_column]]
+            in_flight.add(executor.submit(render_chart, fig_filename, chart_data, jmeter_column, perfmon_column, correlation))
+
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        collect(wait(in_flight).done)
+    except BaseException:
+        # Don't leave this call's charts queued on the shared pool
+        for future in in_flight:
+            future.cancel()
+        raise
+
+    return completed_charts
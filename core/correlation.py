@@ -0,0 +1,274 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+
+def _centre_columns(data):
+    # Return the column-centred values (missing values replaced by 0) and a 0/1 mask of the present values
+    values = data.to_numpy(dtype=np.float64)
+    mask = ~np.isnan(values)
+    with warnings.catch_warnings():
+        # Columns without any data have no mean; they are fully masked out anyway
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        column_means = np.nanmean(values, axis=0, keepdims=True)
+    values = np.where(mask, values - column_means, 0.0)
+    return values, mask.astype(np.float64)
+
+
+def correlate_columns(x_data, y_data):
+    # Pearson correlation of every column of x_data against every column of y_data in one set of matrix
+    # products. Missing values are handled pairwise (each pair only uses the rows where both columns have
+    # data), which gives the same results as calling Series.corr for each pair.
+    x_values, x_mask = _centre_columns(x_data)
+    y_values, y_mask = _centre_columns(y_data)
+    correlation = _correlate_centred(x_values, x_mask, y_values, y_mask)
+    return pd.DataFrame(correlation, index=x_data.columns, columns=y_data.columns)
+
+
+def _correlate_centred(x_values, x_mask, y_values, y_mask):
+    # The correlation matrix from the centred values and masks of _centre_columns(), using pairwise-complete
+    # counts and sums
+    count = x_mask.T @ y_mask
+    x_sum = x_values.T @ y_mask
+    y_sum = x_mask.T @ y_values
+    x_square_sum = (x_values ** 2).T @ y_mask
+    y_square_sum = x_mask.T @ (y_values ** 2)
+    cross_sum = x_values.T @ y_values
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = cross_sum - x_sum * y_sum / count
+        x_variance = x_square_sum - x_sum ** 2 / count
+        y_variance = y_square_sum - y_sum ** 2 / count
+        correlation = covariance / np.sqrt(x_variance * y_variance)
+
+    # Pairs with fewer than two common rows or with a constant column have no correlation
+    correlation[(count < 2) | (x_variance <= 0) | (y_variance <= 0)] = np.nan
+    return np.clip(correlation, -1.0, 1.0)
+
+
+def top_correlate_columns(x_data, y_data, k, max_lag=None, min_periods=3, block_bytes=256 * 1024 ** 2):
+    # Keep only the k strongest (absolute) correlations of each x column. The y columns are correlated in
+    # blocks sized to fit block_bytes and each block is merged into the running top k with a partial sort,
+    # so memory stays at O(x columns x (k + block)) however many y columns there are. With max_lag each
+    # block is lag scanned as in lagged_correlate_columns().
+    # Returns three x by k arrays: the correlations (NaN where there are fewer than k), the positions of
+    # the y columns they belong to and the lags (None without max_lag).
+    x_column_count, y_column_count = x_data.shape[1], y_data.shape[1]
+    k = int(max(1, min(k, y_column_count)))
+    top_correlation = np.full((x_column_count, 0), np.nan)
+    top_index = np.zeros((x_column_count, 0), dtype=np.int64)
+    top_lag = np.zeros((x_column_count, 0), dtype=np.int32)
+
+    if not max_lag:
+        x_values, x_mask = _centre_columns(x_data)
+    # Each y column of a block costs its values, squares and mask plus the six x by y sums
+    block_size = max(k, int(block_bytes // (8 * (3 * len(y_data) + 6 * max(x_column_count, 1)))))
+    for block_start in range(0, y_column_count, block_size):
+        block_columns = y_data.columns[block_start:block_start + block_size]
+        if max_lag:
+            correlation, lag = lagged_correlate_columns(x_data, y_data[block_columns], max_lag, min_periods, block_bytes)
+            correlation, lag = correlation.to_numpy(), lag.to_numpy(dtype=np.int32)
+        else:
+            y_values, y_mask = _centre_columns(y_data[block_columns])
+            correlation = _correlate_centred(x_values, x_mask, y_values, y_mask)
+            lag = np.zeros(correlation.shape, dtype=np.int32)
+        index = np.broadcast_to(np.arange(block_start, block_start + len(block_columns)), correlation.shape)
+
+        top_correlation = np.concatenate([top_correlation, correlation], axis=1)
+        top_index = np.concatenate([top_index, index], axis=1)
+        top_lag = np.concatenate([top_lag, lag], axis=1)
+        if top_correlation.shape[1] > k:
+            strength = np.where(np.isnan(top_correlation), -1.0, np.abs(top_correlation))
+            best = np.argpartition(-strength, k - 1, axis=1)[:, :k]
+            top_correlation = np.take_along_axis(top_correlation, best, axis=1)
+            top_index = np.take_along_axis(top_index, best, axis=1)
+            top_lag = np.take_along_axis(top_lag, best, axis=1)
+
+    return top_correlation, top_index, (top_lag if max_lag else None)
+
+
+def rank_columns(data):
+    # Replace the values of every column by their ranks (ties share the average rank, missing values stay
+    # missing). The Pearson correlation of ranked columns is the Spearman rank correlation, so each column
+    # only has to be ranked once for the whole correlation matrix.
+    return data.rank(method='average')
+
+
+# Lag scans with at most this many lags (2 x max_lag + 1) shift the rows and use matrix products; longer
+# scans use FFT cross-correlations
+direct_lag_limit = 128
+
+
+def _lagged_sums(x_spectrum, y_spectrum, fft_length, max_lag):
+    # Cross-correlation sums, sum over t of x[t + lag] * y[t], for every x column against every y column and
+    # every lag in -max_lag..max_lag, from the zero-padded spectra. Returns an (x, y, lag) array.
+    sums = np.fft.irfft(x_spectrum[:, None, :] * np.conj(y_spectrum)[None, :, :], n=fft_length, axis=-1)
+    return np.concatenate([sums[:, :, fft_length - max_lag:], sums[:, :, :max_lag + 1]], axis=-1)
+
+
+def _shifted_sums(x_values, x_mask, y_values, y_mask, max_lag):
+    # The six pairwise sums of _correlate_centred() for every lag in -max_lag..max_lag, from matrix products
+    # of the overlapping rows at each lag. Returns six (x, y, lag) arrays.
+    row_count = len(x_values)
+    sums = np.empty((6, x_values.shape[1], y_values.shape[1], 2 * max_lag + 1))
+    for position, lag in enumerate(range(-max_lag, max_lag + 1)):
+        x_rows = slice(max(lag, 0), row_count + min(lag, 0))
+        y_rows = slice(max(-lag, 0), row_count - max(lag, 0))
+        x_lag_values, x_lag_mask = x_values[x_rows], x_mask[x_rows]
+        y_lag_values, y_lag_mask = y_values[y_rows], y_mask[y_rows]
+        sums[0, :, :, position] = x_lag_mask.T @ y_lag_mask
+        sums[1, :, :, position] = x_lag_values.T @ y_lag_mask
+        sums[2, :, :, position] = x_lag_mask.T @ y_lag_values
+        sums[3, :, :, position] = (x_lag_values ** 2).T @ y_lag_mask
+        sums[4, :, :, position] = x_lag_mask.T @ (y_lag_values ** 2)
+        sums[5, :, :, position] = x_lag_values.T @ y_lag_values
+    return sums
+
+
+def lagged_correlate_columns(x_data, y_data, max_lag, min_periods=3, block_bytes=256 * 1024 ** 2):
+    # Pearson correlation of every column of x_data against every column of y_data with y_data shifted by
+    # every lag from -max_lag to max_lag rows, keeping the lag with the strongest (absolute) correlation for
+    # each pair. A positive lag means the y column leads the x column by that many rows.
+    # The rows must be evenly spaced in time. Each of the sums that correlate_columns() builds with a matrix
+    # product is built for every lag: with up to direct_lag_limit lags by a matrix product of the overlapping
+    # rows at each lag, and with more lags for all lags at once as an FFT cross-correlation, so the cost per
+    # pair is O(n log n) rather than O(n x lags). Missing values are handled pairwise at every lag, as in
+    # correlate_columns(), and lags with fewer than min_periods common rows are ignored.
+    # Returns two x by y dataframes: the peak correlation and the lag it occurs at.
+    row_count = len(x_data)
+    max_lag = int(min(max_lag, max(row_count - 1, 0)))
+    fft_length = 1 << int(np.ceil(np.log2(max(row_count + max_lag, 1))))
+    lags = np.arange(-max_lag, max_lag + 1)
+    use_fft = len(lags) > direct_lag_limit
+
+    x_values, x_mask = _centre_columns(x_data)
+    y_values, y_mask = _centre_columns(y_data)
+
+    def spectra(values, mask):
+        return [np.fft.rfft(column_data.T, n=fft_length, axis=-1) for column_data in (mask, values, values ** 2)]
+
+    x_column_count, y_column_count = x_values.shape[1], y_values.shape[1]
+    peak_correlation = np.full((x_column_count, y_column_count), np.nan)
+    peak_lag = np.zeros((x_column_count, y_column_count), dtype=np.int32)
+
+    # Work through blocks of x and y columns so the (x, y, lag) sums, and with the FFT the (x, y, frequency)
+    # products, stay within block_bytes however many columns there are
+    pair_bytes = 8 * 9 * len(lags) + (16 * 2 * fft_length if use_fft else 0)
+    block_pairs = max(1, int(block_bytes // pair_bytes))
+    x_block_size = max(1, min(x_column_count, int(np.sqrt(block_pairs))))
+    y_block_size = max(1, block_pairs // x_block_size)
+    for y_block_start in range(0, y_column_count, y_block_size):
+        y_block = slice(y_block_start, y_block_start + y_block_size)
+        if use_fft:
+            y_mask_spectrum, y_value_spectrum, y_square_spectrum = spectra(y_values[:, y_block], y_mask[:, y_block])
+
+        for x_block_start in range(0, x_column_count, x_block_size):
+            x_block = slice(x_block_start, x_block_start + x_block_size)
+            if use_fft:
+                x_mask_spectrum, x_value_spectrum, x_square_spectrum = spectra(x_values[:, x_block], x_mask[:, x_block])
+                count = np.rint(_lagged_sums(x_mask_spectrum, y_mask_spectrum, fft_length, max_lag))
+                x_sum = _lagged_sums(x_value_spectrum, y_mask_spectrum, fft_length, max_lag)
+                y_sum = _lagged_sums(x_mask_spectrum, y_value_spectrum, fft_length, max_lag)
+                x_square_sum = _lagged_sums(x_square_spectrum, y_mask_spectrum, fft_length, max_lag)
+                y_square_sum = _lagged_sums(x_mask_spectrum, y_square_spectrum, fft_length, max_lag)
+                cross_sum = _lagged_sums(x_value_spectrum, y_value_spectrum, fft_length, max_lag)
+            else:
+                count, x_sum, y_sum, x_square_sum, y_square_sum, cross_sum = _shifted_sums(
+                    x_values[:, x_block], x_mask[:, x_block], y_values[:, y_block], y_mask[:, y_block], max_lag)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                covariance = cross_sum - x_sum * y_sum / count
+                x_variance = x_square_sum - x_sum ** 2 / count
+                y_variance = y_square_sum - y_sum ** 2 / count
+                correlation = covariance / np.sqrt(x_variance * y_variance)
+
+            # The FFT and the sums over shifted rows leave round-off, so treat variances that are tiny relative
+            # to the sum of squares as constant columns
+            tolerance = 1e-9
+            correlation[(count < max(min_periods, 2)) | (x_variance <= tolerance * x_square_sum) | (y_variance <= tolerance * y_square_sum)] = np.nan
+            correlation = np.clip(correlation, -1.0, 1.0)
+
+            # Pick the lag with the strongest correlation for each pair
+            strength = np.where(np.isnan(correlation), -1.0, np.abs(correlation))
+            best = np.argmax(strength, axis=-1)
+            peak_correlation[x_block, y_block] = np.take_along_axis(correlation, best[..., None], axis=-1)[..., 0]
+            peak_lag[x_block, y_block] = lags[best]
+
+    peak_lag[np.isnan(peak_correlation)] = 0
+    return (pd.DataFrame(peak_correlation, index=x_data.columns, columns=y_data.columns),
+            pd.DataFrame(peak_lag, index=x_data.columns, columns=y_data.columns))
+
+
+class CorrelationResults:
+    # Compact store of the jmeter vs perfmon correlation coefficients. Each pair is held as a float32
+    # coefficient plus integer indexes into the jmeter/perfmon column names, sorted by descending |r| so
+    # that a slider range can be answered with two binary searches. Results of a lag scan also hold the lag
+    # (in rows) each coefficient was found at.
+
+    def __init__(self, jmeter_columns, perfmon_columns, jmeter_index, perfmon_index, correlation, lag=None):
+        self.jmeter_columns = np.asarray(jmeter_columns, dtype=object)
+        self.perfmon_columns = np.asarray(perfmon_columns, dtype=object)
+        self.jmeter_index = jmeter_index
+        self.perfmon_index = perfmon_index
+        self.correlation = correlation
+        self.lag = lag
+
+        # Negated |r| is ascending, which is what np.searchsorted needs
+        self._sort_key = -np.abs(correlation)
+
+    @classmethod
+    def from_matrix(cls, correlation_matrix, lag_matrix=None):
+        # Build the store from a jmeter x perfmon correlation dataframe (and optionally the matching lag
+        # dataframe from lagged_correlate_columns), dropping pairs without a coefficient
+        values = correlation_matrix.to_numpy(dtype=np.float32)
+        jmeter_index, perfmon_index = np.nonzero(~np.isnan(values))
+        correlation = values[jmeter_index, perfmon_index]
+
+        order = np.argsort(-np.abs(correlation), kind='stable')
+        lag = None
+        if lag_matrix is not None:
+            lag = lag_matrix.to_numpy(dtype=np.int32)[jmeter_index, perfmon_index][order]
+        return cls(correlation_matrix.index, correlation_matrix.columns,
+                   jmeter_index[order].astype(np.int32), perfmon_index[order].astype(np.int32), correlation[order], lag)
+
+    @classmethod
+    def from_top(cls, jmeter_columns, perfmon_columns, top_correlation, top_index, top_lag=None):
+        # Build the store from the x by k arrays of top_correlate_columns(), dropping the empty slots
+        rows, slots = np.nonzero(~np.isnan(top_correlation))
+        correlation = top_correlation[rows, slots].astype(np.float32)
+
+        order = np.argsort(-np.abs(correlation), kind='stable')
+        lag = None
+        if top_lag is not None:
+            lag = top_lag[rows, slots].astype(np.int32)[order]
+        return cls(jmeter_columns, perfmon_columns, rows[order].astype(np.int32), top_index[rows, slots][order].astype(np.int32), correlation[order], lag)
+
+    def __len__(self):
+        return len(self.correlation)
+
+    def range(self, min_value, max_value):
+        # Return the (start, end) positions of the pairs with min_value <= |r| <= max_value
+        start = int(np.searchsorted(self._sort_key, -max_value, side='left'))
+        end = int(np.searchsorted(self._sort_key, -min_value, side='right'))
+        return start, max(start, end)
+
+    def to_frame(self, start, end):
+        # Return the pairs between two positions as a dataframe of (jmeter column, perfmon column, correlation),
+        # plus a fourth column with the lag when the results came from a lag scan
+        correlations = pd.DataFrame({
+            0: self.jmeter_columns[self.jmeter_index[start:end]],
+            1: self.perfmon_columns[self.perfmon_index[start:end]],
+            2: self.correlation[start:end].astype(np.float64),
+        })
+        if self.lag is not None:
+            correlations[3] = self.lag[start:end]
+        return correlations
+
+    def group_positions(self, start, end):
+        # Group the pairs between two positions by jmeter column. Returns {jmeter column: positions relative
+        # to start}, with the positions in each group still ordered by descending |r|.
+        jmeter_index = self.jmeter_index[start:end]
+        order = np.argsort(jmeter_index, kind='stable')
+        group_ids, group_starts = np.unique(jmeter_index[order], return_index=True)
+        groups = np.split(order, group_starts[1:]) if len(order) else []
+        return {self.jmeter_columns[group_id]: positions for group_id, positions in zip(group_ids, groups)}
@@ -0,0 +1,215 @@
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from collections.abc import Mapping
+import pyarrow as pa
+
+# Process-wide store for the dataframes the pages share. Every Streamlit session runs in the same process,
+# so rather than each session keeping its own frames in st.session_state, the frames are held once here
+# and the session state only keeps handles to them. When the frames held in memory exceed the budget, the
+# least recently used ones are spilled to Arrow IPC files (which are memory-mapped when read back) and
+# reloaded transparently the next time they are used. Stored frames are treated as read-only, so a spill
+# file stays valid after its frame is reloaded and spilling it again costs nothing.
+
+spill_folder = "spill_data"
+
+# Memory budget for all sessions together; set DATASET_MEMORY_BUDGET_MB to change it
+dataset_memory_budget_mb = int(os.environ.get("DATASET_MEMORY_BUDGET_MB", 2048))
+
+
+class DatasetStore:
+
+    def __init__(self, memory_budget_bytes, folder=spill_folder):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.folder = folder
+        self._datasets = OrderedDict()
+        self._sizes = {}
+        self._spill_files = set()
+        self._spilling = {}
+        self._lock = threading.RLock()
+
+        # Spill files only mean something to the process that wrote them
+        shutil.rmtree(folder, ignore_errors=True)
+
+    def put(self, data, key=None, owner=None):
+        # Hold a dataframe and return its key. Frames put with an owner (e.g. a session's workspace) can be
+        # released together with release_owner().
+        key = key or uuid.uuid4().hex
+        if owner is not None:
+            key = f"{owner}_{key}"
+        with self._lock:
+            self.release(key)
+            self._datasets[key] = data
+            self._sizes[key] = int(data.memory_usage(index=True, deep=True).sum())
+            spills = self._select_spills()
+        self._write_spills(spills)
+        return key
+
+    def get(self, key):
+        # Return a dataframe, reloading it from its spill file if it has been spilled. The file is read
+        # without holding the lock so other sessions are not held up by the disk.
+        with self._lock:
+            if key in self._datasets:
+                self._datasets.move_to_end(key)
+                return self._datasets[key]
+            data = self._spilling.get(key)
+            if data is None and key not in self._spill_files:
+                raise KeyError(f"The dataset '{key}' is no longer available")
+
+        if data is None:
+            with pa.memory_map(self._spill_path(key)) as source:
+                data = pa.ipc.open_file(source).read_all().to_pandas()
+
+        with self._lock:
+            if key not in self._sizes:
+                # Released while it was being read
+                return data
+            data = self._datasets.setdefault(key, data)
+            self._datasets.move_to_end(key)
+            spills = self._select_spills()
+        self._write_spills(spills)
+        return data
+
+    def release(self, key):
+        with self._lock:
+            self._datasets.pop(key, None)
+            self._sizes.pop(key, None)
+            self._spilling.pop(key, None)
+            if key in self._spill_files:
+                self._spill_files.discard(key)
+                self._remove_spill_file(key)
+
+    def release_owner(self, owner):
+        with self._lock:
+            for key in [key for key in self._sizes if key.startswith(f"{owner}_")]:
+                self.release(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._sizes
+
+    def memory_bytes(self):
+        with self._lock:
+            return sum(self._sizes[key] for key in self._datasets)
+
+    def spilled_count(self):
+        with self._lock:
+            return len(self._spill_files.difference(self._datasets))
+
+    def _select_spills(self):
+        # Called with the lock held: take the least recently used frames out of memory until the rest fit the
+        # budget, and return the ones that still need a spill file. The most recently used frame always stays
+        # in memory, even when it is larger than the budget on its own. Frames being written stay readable
+        # through _spilling until their file is complete.
+        memory_bytes = self.memory_bytes()
+        spills = []
+        while memory_bytes > self.memory_budget_bytes and len(self._datasets) > 1:
+            key, data = self._datasets.popitem(last=False)
+            memory_bytes -= self._sizes[key]
+            if key not in self._spill_files and key not in self._spilling:
+                self._spilling[key] = data
+                spills.append((key, data))
+        return spills
+
+    def _write_spills(self, spills):
+        # Write the spill files chosen by _select_spills() without holding the lock
+        for key, data in spills:
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                table = pa.Table.from_pandas(data, preserve_index=True)
+                with pa.OSFile(self._spill_path(key), 'wb') as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+                written = True
+            except OSError as e:
+                print(f"Failed to spill dataset {key}, keeping it in memory: {e}")
+                written = False
+
+            with self._lock:
+                self._spilling.pop(key, None)
+                if key not in self._sizes:
+                    # Released while it was being written
+                    if written:
+                        self._remove_spill_file(key)
+                elif written:
+                    self._spill_files.add(key)
+                else:
+                    self._datasets.setdefault(key, data)
+
+    def _remove_spill_file(self, key):
+        try:
+            os.remove(self._spill_path(key))
+        except OSError:
+            # Still mapped by a frame in use (Windows); it is cleared when the process restarts
+            pass
+
+    def _spill_path(self, key):
+        return os.path.join(self.folder, f"{key}.arrow")
+
+
+_dataset_store = None
+_dataset_store_lock = threading.Lock()
+
+
+def dataset_store():
+    # The store shared by every session of this process
+    global _dataset_store
+    with _dataset_store_lock:
+        if _dataset_store is None:
+            _dataset_store = DatasetStore(dataset_memory_budget_mb * 1024 ** 2)
+        return _dataset_store
+
+
+class DatasetHandle:
+    # What the session state keeps in place of a dataframe
+
+    def __init__(self, key):
+        self.key = key
+
+    def load(self):
+        return dataset_store().get(self.key)
+
+    def release(self):
+        dataset_store().release(self.key)
+
+
+class StoredPyramid(Mapping):
+    # A time bucket pyramid ({interval: dataframe}) whose levels are held in the dataset store. Levels are
+    # only loaded when they are looked up.
+
+    def __init__(self, handles):
+        self.handles = handles
+
+    def __getitem__(self, interval):
+        return self.handles[interval].load()
+
+    def __contains__(self, interval):
+        return interval in self.handles
+
+    def __iter__(self):
+        return iter(self.handles)
+
+    def __len__(self):
+        return len(self.handles)
+
+    def release(self):
+        for handle in self.handles.values():
+            handle.release()
+
+
+def store_dataset(data, owner=None):
+    return DatasetHandle(dataset_store().put(data, owner=owner))
+
+
+def store_pyramid(pyramid, owner=None):
+    return StoredPyramid({interval: store_dataset(interval_data, owner) for interval, interval_data in pyramid.items()})
+
+
+def release_datasets(session_state, names):
+    # Remove handles (or stored pyramids) from the session state and release what they hold
+    for name in names:
+        value = session_state.pop(name, None)
+        if isinstance(value, (DatasetHandle, StoredPyramid)):
+            value.release()
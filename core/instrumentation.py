@@ -0,0 +1,160 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+trace_folder = "trace_data"
+
+# Number of trace files kept in a folder; the oldest are removed when a new one is written
+max_trace_files = 20
+
+
+def peak_rss_bytes():
+    # Peak resident set size of this process so far, or None where it can't be measured
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS reports bytes
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+    except ImportError:
+        pass
+
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+class Trace:
+    # Records the wall time, CPU time, peak RSS growth and (optionally) the row/column count of each named
+    # processing step. Steps are recorded either with the stage() context manager or, on the Streamlit
+    # pages, by tracking an st.status container so that each status.update(label=...) starts a new step.
+    # The peak RSS is a high-water mark for the whole process, so a step only shows growth when it pushes
+    # the peak higher than any earlier step.
+
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now()
+        self.stages = []
+        self._current = None
+
+    def start(self, stage):
+        self.end()
+        self._current = {
+            'stage': stage,
+            'state': 'complete',
+            'wall_seconds': time.perf_counter(),
+            'cpu_seconds': time.process_time(),
+            'peak_rss_delta_mb': peak_rss_bytes(),
+            'rows': None,
+            'columns': None,
+        }
+
+    def end(self, state='complete'):
+        if self._current is None:
+            return
+        stage = self._current
+        stage['state'] = state
+        stage['wall_seconds'] = time.perf_counter() - stage['wall_seconds']
+        stage['cpu_seconds'] = time.process_time() - stage['cpu_seconds']
+        peak_rss = peak_rss_bytes()
+        stage['peak_rss_delta_mb'] = None if peak_rss is None else (peak_rss - stage['peak_rss_delta_mb']) / 1024 ** 2
+        self.stages.append(stage)
+        self._current = None
+
+    def shape(self, data):
+        # Record the size of the data produced by the current step
+        if self._current is not None and data is not None:
+            self._current['rows'] = data.shape[0]
+            self._current['columns'] = data.shape[1] if len(data.shape) > 1 else 1
+
+    @contextmanager
+    def stage(self, stage):
+        self.start(stage)
+        try:
+            yield self
+        except Exception:
+            self.end('error')
+            raise
+        self.end()
+
+    def track(self, status, label):
+        # Wrap an st.status container so its label updates are recorded as steps
+        self.start(label)
+        return TracedStatus(status, self)
+
+    def to_frame(self):
+        return pd.DataFrame(self.stages, columns=['stage', 'state', 'wall_seconds', 'cpu_seconds', 'peak_rss_delta_mb', 'rows', 'columns'])
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started': self.started.isoformat(timespec='seconds'),
+            'wall_seconds': sum(stage['wall_seconds'] for stage in self.stages),
+            'cpu_seconds': sum(stage['cpu_seconds'] for stage in self.stages),
+            'stages': self.stages,
+        }
+
+    def write_json(self, folder=trace_folder):
+        # Close the last step and write the trace to <folder>/<name>_<start time>.json
+        self.end()
+        os.makedirs(folder, exist_ok=True)
+        trace_path = os.path.join(folder, f"{self.name}_{self.started.strftime('%Y%m%d_%H%M%S_%f')}.json")
+        with open(trace_path, 'w') as trace_file:
+            json.dump(self.to_dict(), trace_file, indent=2)
+        return trace_path
+
+
+class TracedStatus:
+    # Stands in for an st.status container: a new running label starts a step, an error or complete
+    # state ends the current one. Everything else is passed through to the container.
+
+    def __init__(self, status, trace):
+        self._status = status
+        self._trace = trace
+
+    def update(self, label=None, state=None, expanded=None):
+        if state == 'error':
+            self._trace.end('error')
+        elif state == 'complete':
+            self._trace.end()
+        elif label is not None:
+            self._trace.start(label)
+        return self._status.update(label=label, state=state, expanded=expanded)
+
+    def __getattr__(self, name):
+        return getattr(self._status, name)
+
+
+def finish_trace(trace, traces, folder=trace_folder, max_files=max_trace_files):
+    # Write the trace to JSON, keeping only the newest max_files traces in the folder, and keep its timing
+    # table (e.g. in the session state) under the trace name. Returns the timing table.
+    trace.write_json(folder)
+    trace_files = sorted((entry for entry in os.scandir(folder) if entry.name.endswith('.json')), key=lambda entry: entry.stat().st_mtime)
+    for entry in trace_files[:max(len(trace_files) - max_files, 0)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+    traces[trace.name] = trace.to_frame()
+    return traces[trace.name]
+
+
+def trace_table(trace_data):
+    # The timing table of a trace with readable column names, for display
+    return trace_data.rename(columns={'stage': 'Step', 'state': 'State', 'wall_seconds': 'Wall time (s)', 'cpu_seconds': 'CPU time (s)',
+                                      'peak_rss_delta_mb': 'Peak memory growth (MB)', 'rows': 'Rows', 'columns': 'Columns'})
@@ -0,0 +1,298 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from core.pyramid import bucket_intervals, default_interval, bucket_timestamps
+from core.quantiles import ElapsedSketch
+
+# The JTL columns the tool uses; everything else (URL, failureMessage, responseMessage, ...) is never loaded
+jmeter_compact_columns = ['timeStamp', 'elapsed', 'label', 'responseCode', 'success', 'threadName', 'bytes']
+
+# Repetitive text columns are held as categoricals (one small integer code per sample)
+jmeter_category_columns = ['label', 'responseCode', 'threadName']
+
+
+def read_jmeter_csv(file_path):
+    # Read only the used columns of a JTL file, with categorical text columns and the smallest integer
+    # types that fit the numeric columns
+    header = pd.read_csv(file_path, nrows=0).columns
+    usecols = [column for column in header if column in jmeter_compact_columns]
+    dtype = {column: 'category' for column in usecols if column in jmeter_category_columns}
+    jmeter_df = pd.read_csv(file_path, usecols=usecols, dtype=dtype, engine='c')
+    return compact_jmeter_frame(jmeter_df)
+
+
+def compact_jmeter_frame(jmeter_df):
+    # Downcast the integer columns (elapsed, bytes, ...) in place; timeStamp stays int64 epoch milliseconds
+    for column in jmeter_df.columns:
+        if column != 'timeStamp' and pd.api.types.is_integer_dtype(jmeter_df[column]):
+            jmeter_df[column] = pd.to_numeric(jmeter_df[column], downcast='integer')
+    return jmeter_df
+
+
+def format_labels(jmeter_df, interval=default_interval):
+    # Average the elapsed time of every label for each time bucket in a single grouped pass
+    labels = pd.unique(jmeter_df['label'])
+    timestamps = bucket_timestamps(jmeter_df['timeStamp'], interval)
+    label_data = jmeter_df['elapsed'].groupby([timestamps, jmeter_df['label']], sort=False, observed=True).mean().unstack('label')
+
+    # Keep the columns in the order the labels first appear in the file
+    label_data = label_data.reindex(columns=labels)
+    label_data.columns = [f"label_{label}" for label in labels]
+
+    return label_data.sort_index().reset_index()
+
+
+def format_response_codes(jmeter_df, interval=default_interval):
+    # Count every response code for each time bucket in a single grouped pass.
+    # Buckets without a given response code are left empty rather than zero.
+    response_codes = pd.unique(jmeter_df['responseCode'])
+    timestamps = bucket_timestamps(jmeter_df['timeStamp'], interval)
+    code_data = jmeter_df['responseCode'].groupby([timestamps, jmeter_df['responseCode']], sort=False, observed=True).size().unstack('responseCode')
+
+    code_data = code_data.reindex(columns=response_codes)
+    code_data.columns = [f"responseCode_{code}" for code in response_codes]
+
+    return code_data.sort_index().reset_index()
+
+
+def format_statuses(jmeter_df, interval=default_interval):
+    # Count the successful and failed samples for each time bucket, aligned on the bucket itself
+    status_data = pd.DataFrame({
+        'timeStamp': bucket_timestamps(jmeter_df['timeStamp'], interval),
+        'success_true': jmeter_df['success'] == True,
+        'success_false': jmeter_df['success'] == False,
+    })
+    status_data = status_data.groupby('timeStamp').sum().astype(int)
+
+    return status_data.reset_index()
+
+
+def format_jmeter_data(jmeter_df, interval=default_interval):
+    # Build the JMeter frame (label_*, responseCode_* and success_* columns) for one time bucket size
+    timestamps = bucket_timestamps(jmeter_df['timeStamp'], interval)
+    formatted_jmeter_data = pd.DataFrame({'timeStamp': timestamps.drop_duplicates().sort_values().values})
+
+    formatted_jmeter_data = pd.merge(formatted_jmeter_data, format_labels(jmeter_df, interval), on='timeStamp', how='left')
+    formatted_jmeter_data = pd.merge(formatted_jmeter_data, format_response_codes(jmeter_df, interval), on='timeStamp', how='left')
+    if 'success' in jmeter_df.columns:
+        formatted_jmeter_data = pd.merge(formatted_jmeter_data, format_statuses(jmeter_df, interval), on='timeStamp', how='left')
+
+    return formatted_jmeter_data
+
+
+def summarise_labels(jmeter_df):
+    # The count, sum, min and max of the elapsed times of every label over the whole run, plus the number of
+    # passed samples when there is a success column
+    label_summary = _label_statistics(jmeter_df, 'label')
+    return label_summary.reindex(pd.unique(jmeter_df['label']))
+
+
+def _label_statistics(jmeter_df, keys):
+    statistics = {'count': ('elapsed', 'count'), 'sum': ('elapsed', 'sum'), 'min': ('elapsed', 'min'), 'max': ('elapsed', 'max')}
+    if 'success' in jmeter_df.columns:
+        jmeter_df = jmeter_df.assign(passed=jmeter_df['success'] == True)
+        statistics['passed'] = ('passed', 'sum')
+    return jmeter_df.groupby(keys, sort=False, observed=True).agg(**statistics)
+
+
+def translate_timestamps(jmeter_df):
+    # Convert the epoch millisecond timestamps to datetimes (bucketing happens when the data is aggregated)
+    jmeter_df['timeStamp'] = pd.to_datetime(jmeter_df['timeStamp'], unit='ms')
+    return jmeter_df
+
+
+class JMeterAccumulator:
+    # Folds chunks of raw JTL samples into per-bucket/per-label accumulators (count, sum, min and max of the
+    # elapsed times and the number of passed samples, count of each response code and of passed/failed
+    # samples) plus a mergeable per-label ElapsedSketch for the percentiles, so that the raw samples never
+    # have to be held in memory at once. Memory is bounded by the number of time bucket x label pairs rather
+    # than by the size of the file. Samples are held at the finest bucket size and rolled up to coarser sizes
+    # on request.
+    # Each chunk only aggregates itself; the per-chunk partials are combined in one grouped pass when the
+    # results are needed (or every parts_per_combine chunks, to bound memory), rather than re-grouping the
+    # whole accumulated state for every chunk.
+
+    parts_per_combine = 32
+
+    label_aggregation = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max', 'passed': 'sum'}
+
+    def __init__(self):
+        self.labels = []
+        self.response_codes = []
+        self.has_statuses = False
+        self.sample_count = 0
+        self.label_stats = None
+        self.response_code_counts = None
+        self.status_counts = None
+        self.elapsed_sketch = ElapsedSketch()
+        self._label_parts = []
+        self._response_code_parts = []
+        self._status_parts = []
+
+    def add_chunk(self, chunk):
+        # Fold a chunk of samples (with translated timestamps) into the accumulators
+        if len(chunk) == 0:
+            return self
+
+        chunk = chunk.assign(timeStamp=bucket_timestamps(chunk['timeStamp'], bucket_intervals[0]))
+        self.sample_count += len(chunk)
+        self._add_unique(self.labels, chunk['label'])
+        self._add_unique(self.response_codes, chunk['responseCode'])
+
+        self._label_parts.append(_label_statistics(chunk, ['timeStamp', 'label']))
+        self.elapsed_sketch.add(chunk['label'], chunk['elapsed'])
+        self._response_code_parts.append(chunk.groupby(['timeStamp', 'responseCode'], sort=False).size())
+
+        if 'success' in chunk.columns:
+            self.has_statuses = True
+            self._status_parts.append(pd.DataFrame({
+                'timeStamp': chunk['timeStamp'],
+                'success_true': chunk['success'] == True,
+                'success_false': chunk['success'] == False,
+            }).groupby('timeStamp', sort=False).sum())
+
+        if len(self._label_parts) >= self.parts_per_combine:
+            self.combine()
+        return self
+
+    def merge(self, other):
+        # Merge the accumulators of another JMeterAccumulator into this one
+        other.combine()
+        self.sample_count += other.sample_count
+        self._add_unique(self.labels, other.labels)
+        self._add_unique(self.response_codes, other.response_codes)
+        self.has_statuses = self.has_statuses or other.has_statuses
+        if other.label_stats is not None:
+            self._label_parts.append(other.label_stats)
+            self._response_code_parts.append(other.response_code_counts)
+        if other.status_counts is not None:
+            self._status_parts.append(other.status_counts)
+        self.elapsed_sketch.merge(other.elapsed_sketch)
+        return self
+
+    def combine(self):
+        # Fold the pending per-chunk partials into the accumulated state in a single grouped pass
+        self.label_stats = self._combine_parts(self.label_stats, self._label_parts, self._label_aggregation(self._label_parts))
+        self.elapsed_sketch.combine()
+        self.response_code_counts = self._combine_parts(self.response_code_counts, self._response_code_parts)
+        self.status_counts = self._combine_parts(self.status_counts, self._status_parts)
+        return self
+
+    def format_labels(self, interval=default_interval):
+        # Same layout as format_labels(): the average elapsed time of every label for each time bucket
+        label_stats = self._rollup(self.combine().label_stats, interval, self._label_aggregation([self.label_stats]))
+        label_data = (label_stats['sum'] / label_stats['count']).unstack('label')
+        label_data = label_data.reindex(columns=self.labels)
+        label_data.columns = [f"label_{label}" for label in self.labels]
+        return label_data.sort_index().reset_index()
+
+    def format_response_codes(self, interval=default_interval):
+        # Same layout as format_response_codes(): the count of every response code for each time bucket
+        code_data = self._rollup(self.combine().response_code_counts, interval).unstack('responseCode')
+        code_data = code_data.reindex(columns=self.response_codes)
+        code_data.columns = [f"responseCode_{code}" for code in self.response_codes]
+        return code_data.sort_index().reset_index()
+
+    def format_statuses(self, interval=default_interval):
+        # Same layout as format_statuses(): the count of passed and failed samples for each time bucket
+        return self._rollup(self.combine().status_counts, interval).astype(int).sort_index().reset_index()
+
+    def format_jmeter_data(self, interval=default_interval):
+        # Same layout as format_jmeter_data()
+        formatted_jmeter_data = pd.DataFrame({'timeStamp': self.timestamps(interval).values})
+        formatted_jmeter_data = pd.merge(formatted_jmeter_data, self.format_labels(interval), on='timeStamp', how='left')
+        formatted_jmeter_data = pd.merge(formatted_jmeter_data, self.format_response_codes(interval), on='timeStamp', how='left')
+        if self.has_statuses:
+            formatted_jmeter_data = pd.merge(formatted_jmeter_data, self.format_statuses(interval), on='timeStamp', how='left')
+        return formatted_jmeter_data
+
+    def summarise_labels(self):
+        # Same layout as summarise_labels(): the count, sum, min and max of the elapsed times (and the passed
+        # samples) of every label over the whole run
+        label_stats = self.combine().label_stats
+        label_summary = label_stats.groupby(level='label', sort=False).agg(self._label_aggregation([label_stats]))
+        return label_summary.reindex(self.labels)
+
+    def timestamps(self, interval=default_interval):
+        timestamps = self.combine().label_stats.index.get_level_values('timeStamp').unique()
+        return bucket_timestamps(timestamps, interval).unique().sort_values()
+
+    @classmethod
+    def _label_aggregation(cls, label_stats):
+        # How each column of the label statistics combines (passed is only there when the files have a success column)
+        columns = [column for column in cls.label_aggregation if any(column in data.columns for data in label_stats)]
+        return {column: cls.label_aggregation[column] for column in columns}
+
+    @staticmethod
+    def _rollup(data, interval, aggregation='sum'):
+        # Re-group accumulators held at the finest bucket size into a coarser bucket size
+        if interval == bucket_intervals[0]:
+            return data
+        keys = [bucket_timestamps(data.index.get_level_values('timeStamp'), interval)]
+        keys += [data.index.get_level_values(level) for level in data.index.names[1:]]
+        return data.groupby(keys).agg(aggregation)
+
+    @staticmethod
+    def _add_unique(values, new_values):
+        known = set(values)
+        for value in pd.unique(pd.Series(new_values)):
+            if value not in known:
+                values.append(value)
+                known.add(value)
+
+    @staticmethod
+    def _combine_parts(current, parts, aggregation='sum'):
+        # Combine the partials per index entry: counts and sums are added, minimums and maximums are kept
+        if not parts:
+            return current
+        if current is not None:
+            parts.insert(0, current)
+        combined = parts[0] if len(parts) == 1 else pd.concat(parts)
+        parts.clear()
+        return combined.groupby(level=list(range(combined.index.nlevels)), sort=False).agg(aggregation)
+
+
+def read_jmeter_chunks(file_path, chunk_size=1_000_000, usecols=None, accumulator=None, clock_offset_ms=0):
+    # Stream a JTL file through a JMeterAccumulator chunk by chunk, optionally correcting the clock of the
+    # load generator that wrote it by clock_offset_ms
+    if accumulator is None:
+        accumulator = JMeterAccumulator()
+    for chunk in pd.read_csv(file_path, chunksize=chunk_size, usecols=usecols):
+        if clock_offset_ms:
+            chunk['timeStamp'] = chunk['timeStamp'] + clock_offset_ms
+        accumulator.add_chunk(translate_timestamps(chunk))
+    return accumulator.combine()
+
+
+def _read_jmeter_file(file_path, clock_offset_ms, chunk_size, columns):
+    # Worker for read_jmeter_files(): each load generator's file may have been saved with different columns
+    header = pd.read_csv(file_path, nrows=0).columns
+    usecols = [column for column in header if column in columns]
+    return read_jmeter_chunks(file_path, chunk_size=chunk_size, usecols=usecols, clock_offset_ms=clock_offset_ms)
+
+
+def read_jmeter_files(file_paths, clock_offsets_ms=None, chunk_size=1_000_000, columns=None, max_workers=None):
+    # Stream the JTL files of several (distributed) load generators into one JMeterAccumulator. Each file is
+    # folded into its own accumulator in a worker process, with its clock offset applied, and the per-bucket
+    # accumulators are then merged, so the files are never concatenated in memory. Because every aggregate
+    # is a per-bucket count, sum, min or max, or a count in the percentile sketch, merging the accumulators
+    # gives the same result as a timestamp-ordered merge of the samples.
+    if clock_offsets_ms is None:
+        clock_offsets_ms = [0] * len(file_paths)
+    if columns is None:
+        columns = ['timeStamp', 'elapsed', 'label', 'responseCode', 'success']
+
+    if len(file_paths) == 1:
+        return _read_jmeter_file(file_paths[0], clock_offsets_ms[0], chunk_size, columns)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(file_paths)))
+
+    accumulator = JMeterAccumulator()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # Merge in file order so labels and response codes keep a stable first-appearance order
+        for file_accumulator in executor.map(_read_jmeter_file, file_paths, clock_offsets_ms,
+                                             [chunk_size] * len(file_paths), [columns] * len(file_paths)):
+            accumulator.merge(file_accumulator)
+    return accumulator
@@ -0,0 +1,256 @@
+import io
+import os
+from collections import deque
+import numpy as np
+import pandas as pd
+from core.correlation import CorrelationResults
+from core.jmeter import format_jmeter_data, translate_timestamps
+from core.perfmon import pdh_timestamp_format
+from core.pipeline import filter_jmeter_data, filter_perfmon_data, local_utc_offset_hours
+from core.pyramid import default_interval, bucket_timestamps
+
+# Live mode: follow a JTL file and a Perfmon CSV while the test is still writing them, and keep the
+# correlations up to date as each time bucket completes without going back over the earlier buckets
+
+
+class FileTail:
+    # Reads the complete lines appended to a growing CSV file since the previous read. The header is taken
+    # from the first line and a line that is still being written is held back until its newline arrives.
+
+    def __init__(self, path, max_bytes=64 * 1024 ** 2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.header = None
+        self._partial = b''
+
+    def truncated(self):
+        # The file has been replaced or cut short (e.g. the test was restarted)
+        try:
+            return os.path.getsize(self.path) < self.offset
+        except FileNotFoundError:
+            return False
+
+    def read(self, **read_csv_arguments):
+        # Return the new rows as a dataframe, or None when no complete row has been added
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as tail_file:
+            tail_file.seek(self.offset)
+            data = tail_file.read(self.max_bytes)
+        self.offset += len(data)
+
+        complete, newline, self._partial = (self._partial + data).rpartition(b'\n')
+        if not newline:
+            return None
+        lines = complete + newline
+
+        if self.header is None:
+            header_line, _, lines = lines.partition(b'\n')
+            self.header = pd.read_csv(io.BytesIO(header_line), nrows=0).columns
+        if not lines.strip():
+            return None
+        return pd.read_csv(io.BytesIO(lines), header=None, names=self.header, **read_csv_arguments)
+
+
+class RunningCorrelation:
+    # Pearson correlation of every x column against every y column from running pairwise sums (n, sum x,
+    # sum y, sum x^2, sum y^2, sum xy), so adding rows costs O(rows x pairs) and reading the correlations
+    # costs O(pairs) however many rows came before. Missing values are handled pairwise as in
+    # correlate_columns(). Each column is shifted by the first value seen in it, which keeps the sums small
+    # and avoids the cancellation of the one-pass formula on large, slowly varying values.
+
+    sums = ['count', 'x_sum', 'y_sum', 'x_square_sum', 'y_square_sum', 'cross_sum']
+
+    def __init__(self, min_periods=3):
+        self.min_periods = min_periods
+        self.x_columns = []
+        self.y_columns = []
+        self.x_shift = np.empty(0)
+        self.y_shift = np.empty(0)
+        for name in self.sums:
+            setattr(self, name, np.zeros((0, 0)))
+        self.rows = 0
+
+    def update(self, x_data, y_data):
+        # Add rows (aligned on the same index) to the sums. Columns not seen before are added with empty sums.
+        self._add_columns([column for column in x_data.columns if column not in self.x_columns], [])
+        self._add_columns([], [column for column in y_data.columns if column not in self.y_columns])
+
+        x_values, x_mask = self._shifted(x_data.reindex(columns=self.x_columns), self.x_shift)
+        y_values, y_mask = self._shifted(y_data.reindex(columns=self.y_columns), self.y_shift)
+
+        self.count += x_mask.T @ y_mask
+        self.x_sum += x_values.T @ y_mask
+        self.y_sum += x_mask.T @ y_values
+        self.x_square_sum += (x_values ** 2).T @ y_mask
+        self.y_square_sum += x_mask.T @ (y_values ** 2)
+        self.cross_sum += x_values.T @ y_values
+        self.rows += len(x_data)
+        return self
+
+    def correlation(self):
+        # Return the x by y correlation dataframe
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = self.cross_sum - self.x_sum * self.y_sum / self.count
+            x_variance = self.x_square_sum - self.x_sum ** 2 / self.count
+            y_variance = self.y_square_sum - self.y_sum ** 2 / self.count
+            correlation = covariance / np.sqrt(x_variance * y_variance)
+
+        correlation[(self.count < max(self.min_periods, 2)) | (x_variance <= 0) | (y_variance <= 0)] = np.nan
+        correlation = np.clip(correlation, -1.0, 1.0)
+        return pd.DataFrame(correlation, index=pd.Index(self.x_columns), columns=pd.Index(self.y_columns))
+
+    def _add_columns(self, x_columns, y_columns):
+        if not x_columns and not y_columns:
+            return
+        self.x_columns += x_columns
+        self.y_columns += y_columns
+        self.x_shift = np.concatenate([self.x_shift, np.full(len(x_columns), np.nan)])
+        self.y_shift = np.concatenate([self.y_shift, np.full(len(y_columns), np.nan)])
+        for name in self.sums:
+            setattr(self, name, np.pad(getattr(self, name), ((0, len(x_columns)), (0, len(y_columns)))))
+
+    @staticmethod
+    def _shifted(data, shift):
+        # Shift the values by the first value seen in each column (set here for columns seen for the first
+        # time; their sums are all still zero) and return them with missing values as 0, plus a 0/1 mask
+        values = data.to_numpy(dtype=np.float64)
+        mask = ~np.isnan(values)
+        unset = np.isnan(shift) & mask.any(axis=0)
+        if unset.any():
+            shift[unset] = values[mask.argmax(axis=0)[unset], np.nonzero(unset)[0]]
+        values = np.where(mask, values - np.nan_to_num(shift), 0.0)
+        return values, mask.astype(np.float64)
+
+
+class LiveCorrelator:
+    # Tails a JTL file and a Perfmon CSV and feeds each completed time bucket into a RunningCorrelation.
+    # Samples are held raw only until their bucket completes, i.e. once both files have moved on to a
+    # later bucket; they are then aggregated exactly as an upload would be (mean elapsed time per label,
+    # count per response code, mean per counter). Samples that arrive after their bucket has completed are
+    # counted as late and left out. Only the last history_buckets completed buckets are kept, for charting.
+
+    jmeter_columns = ['timeStamp', 'elapsed', 'label', 'responseCode', 'success']
+
+    def __init__(self, jmeter_path, perfmon_path, interval=default_interval, utc_offset_hours=None,
+                 labels=None, response_codes=None, counter_patterns=None, min_periods=3, history_buckets=360):
+        self.jmeter_tail = FileTail(jmeter_path)
+        self.perfmon_tail = FileTail(perfmon_path)
+        self.interval = interval
+        self.utc_offset_hours = local_utc_offset_hours() if utc_offset_hours is None else utc_offset_hours
+        self.labels = labels
+        self.response_codes = response_codes
+        self.counter_patterns = counter_patterns
+        self.min_periods = min_periods
+        self.history_buckets = history_buckets
+        self.reset()
+
+    def reset(self):
+        self.jmeter_tail.reset()
+        self.perfmon_tail.reset()
+        self.running_correlation = RunningCorrelation(self.min_periods)
+        self.pending_jmeter_data = None
+        self.pending_perfmon_data = None
+        self.completed_until = None
+        self.bucket_data = deque()
+        self.history_rows = 0
+        self.sample_count = 0
+        self.late_samples = 0
+
+    def poll(self):
+        # Read whatever has been appended to the files and fold every newly completed bucket into the
+        # correlations. Returns the number of buckets completed by this poll.
+        if self.jmeter_tail.truncated() or self.perfmon_tail.truncated():
+            self.reset()
+
+        jmeter_data = self._read_jmeter()
+        perfmon_data = self._read_perfmon()
+        self.pending_jmeter_data = self._append_pending(self.pending_jmeter_data, jmeter_data, jmeter_data['timeStamp'] if jmeter_data is not None else None)
+        self.pending_perfmon_data = self._append_pending(self.pending_perfmon_data, perfmon_data, perfmon_data.index if perfmon_data is not None else None)
+
+        if self.pending_jmeter_data is None or self.pending_perfmon_data is None:
+            return 0
+        # A bucket is complete once both files have samples from a later bucket
+        watermark = min(bucket_timestamps(pd.Series([self.pending_jmeter_data['timeStamp'].max()]), self.interval).iloc[0],
+                        bucket_timestamps(pd.Index([self.pending_perfmon_data.index.max()]), self.interval)[0])
+        return self._complete(watermark)
+
+    def flush(self):
+        # Treat every pending bucket as complete (e.g. when the test has finished)
+        if self.pending_jmeter_data is None or self.pending_perfmon_data is None:
+            return 0
+        return self._complete(max(self.pending_jmeter_data['timeStamp'].max(), self.pending_perfmon_data.index.max()) + pd.Timedelta(self.interval))
+
+    def correlation_results(self):
+        return CorrelationResults.from_matrix(self.running_correlation.correlation())
+
+    def pair_data(self, jmeter_column, perfmon_column):
+        # The recent completed buckets of one jmeter_/perfmon_ pair, for charting
+        if not self.bucket_data:
+            return pd.DataFrame(columns=[jmeter_column, perfmon_column])
+        return pd.concat([merged_data.reindex(columns=[jmeter_column, perfmon_column]) for merged_data in self.bucket_data]).tail(self.history_buckets)
+
+    def _read_jmeter(self):
+        jmeter_data = self.jmeter_tail.read(usecols=lambda column: column in self.jmeter_columns)
+        if jmeter_data is None or len(jmeter_data) == 0:
+            return None
+        jmeter_data = translate_timestamps(jmeter_data)
+        jmeter_data['timeStamp'] = jmeter_data['timeStamp'] + pd.Timedelta(hours=self.utc_offset_hours)
+        self.sample_count += len(jmeter_data)
+        return jmeter_data
+
+    def _read_perfmon(self):
+        perfmon_data = self.perfmon_tail.read(na_values=[' ', ''], dtype=str)
+        if perfmon_data is None or len(perfmon_data) == 0:
+            return None
+        timestamp_column = perfmon_data.columns[0]
+        timestamps = pd.to_datetime(perfmon_data[timestamp_column], format=pdh_timestamp_format, errors='coerce')
+        if timestamps.isna().all():
+            timestamps = pd.to_datetime(perfmon_data[timestamp_column])
+        perfmon_data = perfmon_data.drop(columns=[timestamp_column]).apply(pd.to_numeric, errors='coerce').astype(np.float32)
+        perfmon_data.index = pd.DatetimeIndex(timestamps, name='timeStamp')
+        return perfmon_data
+
+    def _append_pending(self, pending_data, new_data, timestamps):
+        if new_data is None:
+            return pending_data
+        if self.completed_until is not None:
+            late = np.asarray(timestamps < self.completed_until)
+            self.late_samples += int(late.sum())
+            new_data = new_data[~late]
+        if pending_data is None:
+            return new_data
+        return pd.concat([pending_data, new_data])
+
+    def _complete(self, watermark):
+        jmeter_done = self.pending_jmeter_data['timeStamp'] < watermark
+        perfmon_done = self.pending_perfmon_data.index < watermark
+        completed_jmeter_data = self.pending_jmeter_data[jmeter_done]
+        completed_perfmon_data = self.pending_perfmon_data[perfmon_done]
+        self.pending_jmeter_data = self.pending_jmeter_data[~jmeter_done]
+        self.pending_perfmon_data = self.pending_perfmon_data[~perfmon_done]
+        self.completed_until = watermark if self.completed_until is None else max(self.completed_until, watermark)
+        if len(completed_jmeter_data) == 0 or len(completed_perfmon_data) == 0:
+            return 0
+
+        formatted_jmeter_data = format_jmeter_data(completed_jmeter_data, self.interval).set_index('timeStamp')
+        # Keep the success_true/success_false counts, as merge_for_correlation() does for an upload
+        formatted_jmeter_data = filter_jmeter_data(formatted_jmeter_data, self.labels, self.response_codes).join(formatted_jmeter_data.filter(like='success_'))
+        formatted_perfmon_data = completed_perfmon_data.groupby(bucket_timestamps(completed_perfmon_data.index, self.interval)).mean()
+        formatted_perfmon_data = filter_perfmon_data(formatted_perfmon_data, self.counter_patterns)
+
+        merged_data = pd.merge(formatted_perfmon_data.add_prefix('perfmon_'), formatted_jmeter_data.add_prefix('jmeter_'),
+                               how='inner', left_index=True, right_index=True)
+        if len(merged_data) == 0:
+            return 0
+        merged_data.index.name = 'timeStamp'
+        self.running_correlation.update(merged_data.filter(like='jmeter_'), merged_data.filter(like='perfmon_'))
+        self.bucket_data.append(merged_data)
+        self.history_rows += len(merged_data)
+        while self.history_rows - len(self.bucket_data[0]) >= self.history_buckets:
+            self.history_rows -= len(self.bucket_data.popleft())
+        return len(merged_data)
@@ -0,0 +1,263 @@
+import fnmatch
+import os
+import re
+import ctypes
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from core.pyramid import bucket_intervals, bucket_timestamps
+
+
+# relog and Perfmon write CSV timestamps in this format, whatever the locale of the machine
+pdh_timestamp_format = "%m/%d/%Y %H:%M:%S.%f"
+
+
+def parse_counter_path(counter_path):
+    # Split a counter path such as \\SERVER\Process(java#1)\% Processor Time into
+    # (server, object, instance, counter). The instance is "" for counters without one.
+    path = counter_path[2:] if counter_path.startswith("\\\\") else counter_path
+    server, _, remainder = path.partition("\\")
+    counter_object, _, counter = remainder.rpartition("\\")
+    instance = ""
+    if counter_object.endswith(")") and "(" in counter_object:
+        counter_object, _, instance = counter_object[:-1].partition("(")
+    return server, counter_object, instance, counter
+
+
+def perfmon_counter_metadata(columns):
+    # Build a dataframe of (server, object, instance, counter) for each counter column, indexed by column name
+    return pd.DataFrame([parse_counter_path(column) for column in columns], columns=['server', 'object', 'instance', 'counter'], index=pd.Index(columns, name='column'))
+
+
+def match_counters(counter_columns, counter_patterns=None, server=""):
+    # The counter columns matching any of the search patterns (globs or substrings, see search_counters)
+    # and the server, in their original order. All of them when there are no patterns and no server.
+    counter_columns = list(counter_columns)
+    if not counter_patterns and not server:
+        return counter_columns
+    counter_metadata = perfmon_counter_metadata(counter_columns)
+    selected_columns = set()
+    for pattern in (counter_patterns or [""]):
+        selected_columns.update(search_counters(counter_metadata, pattern, server=server))
+    return [column for column in counter_columns if column in selected_columns]
+
+
+def read_perfmon_csv(csv_path, counter_patterns=None, server=""):
+    # Read a relog/Perfmon CSV into a float32 frame indexed by timeStamp in a single pass.
+    # The first column holds the PDH timestamp, every other column is a counter and " " marks a missing sample.
+    # Only the counters selected by match_counters() are parsed.
+    header = pd.read_csv(csv_path, nrows=0).columns
+    timestamp_column = header[0]
+    counter_columns = match_counters(header[1:], counter_patterns, server)
+
+    usecols = [timestamp_column] + counter_columns
+    try:
+        perfmon_data = pd.read_csv(csv_path, usecols=usecols, na_values=[' ', ''], dtype={column: np.float32 for column in counter_columns}, engine='c')
+    except ValueError:
+        # A counter contains text other than the blank marker; read it as text and coerce what can't be parsed
+        perfmon_data = pd.read_csv(csv_path, usecols=usecols, na_values=[' ', ''], engine='c')
+        for column in counter_columns:
+            if not pd.api.types.is_numeric_dtype(perfmon_data[column]):
+                perfmon_data[column] = pd.to_numeric(perfmon_data[column], errors='coerce')
+        perfmon_data[counter_columns] = perfmon_data[counter_columns].astype(np.float32)
+
+    # Keep the original column order
+    perfmon_data = perfmon_data[usecols]
+
+    timestamps = pd.to_datetime(perfmon_data[timestamp_column], format=pdh_timestamp_format, errors='coerce')
+    if timestamps.isna().all():
+        # Not a PDH export (e.g. re-saved in another tool), so fall back to inferring the format
+        timestamps = pd.to_datetime(perfmon_data[timestamp_column])
+
+    perfmon_data = perfmon_data.drop(columns=[timestamp_column])
+    perfmon_data.index = pd.DatetimeIndex(timestamps, name='timeStamp')
+    return perfmon_data
+
+
+# Performance Data Helper (pdh.dll) constants, see pdh.h and pdhmsg.h
+pdh_fmt_double = 0x00000200
+pdh_fmt_nocap100 = 0x00008000
+pdh_more_data = 0x800007D2
+pdh_no_more_data = 0x800007CC
+pdh_cstatus_valid_data = 0x00000000
+pdh_cstatus_new_data = 0x00000001
+perf_detail_wizard = 400
+# FILETIME counts 100 nanosecond ticks from 1601-01-01, the Unix epoch is this many ticks later
+filetime_unix_epoch = 116444736000000000
+
+
+class PdhFormattedCounterValue(ctypes.Structure):
+    # PDH_FMT_COUNTERVALUE with the double member of its union
+    _fields_ = [('CStatus', ctypes.c_uint32), ('doubleValue', ctypes.c_double)]
+
+
+def blg_supported():
+    # The binary .BLG format is undocumented, so it is decoded by the Windows Performance Data Helper
+    # library, the same one Perfmon and relog use. It is only available on Windows.
+    return os.name == 'nt'
+
+
+def _pdh_check(status, action):
+    if status != 0:
+        raise RuntimeError(f"Could not {action} (PDH error 0x{status & 0xFFFFFFFF:08X})")
+
+
+def _pdh_list(pdh_function, *arguments):
+    # Call a PDH enumeration function that fills one multi-string buffer, sizing the buffer first
+    buffer_length = ctypes.c_uint32(0)
+    status = pdh_function(*arguments, None, ctypes.byref(buffer_length)) & 0xFFFFFFFF
+    if status not in (0, pdh_more_data) or buffer_length.value == 0:
+        return []
+    buffer = ctypes.create_unicode_buffer(buffer_length.value)
+    _pdh_check(pdh_function(*arguments, buffer, ctypes.byref(buffer_length)) & 0xFFFFFFFF, "list the contents of the .BLG file")
+    return [item for item in buffer[:buffer_length.value].split('\0') if item]
+
+
+def _pdh_counter_paths(pdh, data_source):
+    # Every counter path logged in the data source, expanding each object's instances and counters
+    counter_paths = []
+    for machine in _pdh_list(pdh.PdhEnumMachinesHW, data_source):
+        machine = machine if machine.startswith('\\\\') else '\\\\' + machine
+        for counter_object in _pdh_list(lambda buffer, length: pdh.PdhEnumObjectsHW(data_source, machine, buffer, length, perf_detail_wizard, False)):
+            instance_length = ctypes.c_uint32(0)
+            counter_length = ctypes.c_uint32(0)
+            pdh.PdhEnumObjectItemsHW(data_source, machine, counter_object, None, ctypes.byref(counter_length), None, ctypes.byref(instance_length), perf_detail_wizard, 0)
+            wildcard_path = f"{machine}\\{counter_object}(*)\\*" if instance_length.value > 2 else f"{machine}\\{counter_object}\\*"
+            counter_paths += _pdh_list(lambda buffer, length: pdh.PdhExpandWildCardPathHW(data_source, wildcard_path, buffer, length, 0))
+    return list(dict.fromkeys(counter_paths))
+
+
+def read_perfmon_blg(blg_path, counter_patterns=None, server=""):
+    # Read a binary Perfmon .BLG log into a float32 frame indexed by timeStamp, like read_perfmon_csv(),
+    # without converting it to an intermediate CSV. Only the counters selected by match_counters() are read.
+    if not blg_supported():
+        raise RuntimeError("Reading .BLG files needs the Windows Performance Data Helper library. Export the log to .CSV on Windows (relog <file>.blg -f CSV -o <file>.csv) and upload the CSV instead.")
+
+    pdh = ctypes.WinDLL('pdh.dll')
+    data_source = ctypes.c_void_p()
+    # The data source is a list of log files terminated by an empty string
+    _pdh_check(pdh.PdhBindInputDataSourceW(ctypes.byref(data_source), ctypes.c_wchar_p(os.path.abspath(blg_path) + '\0')) & 0xFFFFFFFF, f"open '{blg_path}'")
+    try:
+        query = ctypes.c_void_p()
+        _pdh_check(pdh.PdhOpenQueryH(data_source, None, ctypes.byref(query)) & 0xFFFFFFFF, "query the .BLG file")
+        try:
+            counter_columns = []
+            counter_handles = []
+            for counter_path in match_counters(_pdh_counter_paths(pdh, data_source), counter_patterns, server):
+                counter_handle = ctypes.c_void_p()
+                if pdh.PdhAddCounterW(query, counter_path, None, ctypes.byref(counter_handle)) == 0:
+                    counter_columns.append(counter_path)
+                    counter_handles.append(counter_handle)
+
+            # Each collection steps to the next sample in the log. Samples a counter has no valid value for
+            # (e.g. the first sample of a rate) are NaN, as the blank cells of a CSV export are.
+            timestamps = []
+            samples = []
+            timestamp = ctypes.c_longlong()
+            counter_value = PdhFormattedCounterValue()
+            while True:
+                status = pdh.PdhCollectQueryDataWithTime(query, ctypes.byref(timestamp)) & 0xFFFFFFFF
+                if status == pdh_no_more_data:
+                    break
+                _pdh_check(status, f"read '{blg_path}'")
+                sample = np.full(len(counter_handles), np.nan, dtype=np.float32)
+                for position, counter_handle in enumerate(counter_handles):
+                    if (pdh.PdhGetFormattedCounterValue(counter_handle, pdh_fmt_double | pdh_fmt_nocap100, None, ctypes.byref(counter_value)) == 0
+                            and counter_value.CStatus in (pdh_cstatus_valid_data, pdh_cstatus_new_data)):
+                        sample[position] = counter_value.doubleValue
+                timestamps.append(timestamp.value)
+                samples.append(sample)
+        finally:
+            pdh.PdhCloseQuery(query)
+    finally:
+        pdh.PdhCloseLog(data_source, 0)
+
+    # Perfmon logs local time, so the timestamps are kept as naive local times like those of a CSV export
+    index = pd.to_datetime((np.array(timestamps, dtype=np.int64) - filetime_unix_epoch) * 100, unit='ns')
+    perfmon_data = pd.DataFrame(np.array(samples, dtype=np.float32).reshape(len(samples), len(counter_columns)), columns=counter_columns)
+    perfmon_data.index = pd.DatetimeIndex(index, name='timeStamp')
+    return perfmon_data
+
+
+def read_perfmon_file(perfmon_path, counter_patterns=None, server=""):
+    # Parse one Perfmon log, a .BLG or a CSV export of one
+    if perfmon_path.lower().endswith('.blg'):
+        return read_perfmon_blg(perfmon_path, counter_patterns, server)
+    return read_perfmon_csv(perfmon_path, counter_patterns, server)
+
+
+def clean_perfmon_data(perfmon_data):
+    # Drop the counters without any data or with only zeros and the samples with only zeros, and round to
+    # 3 decimal places
+    perfmon_data = perfmon_data.dropna(axis=1, how='all')
+    perfmon_data = perfmon_data.loc[:, (perfmon_data != 0).any(axis=0)]
+    perfmon_data = perfmon_data.loc[~(perfmon_data == 0).all(axis=1)]
+    return perfmon_data.round(3)
+
+
+def read_perfmon_buckets(perfmon_path, counter_patterns=None, server="", interval=bucket_intervals[0]):
+    # Read and clean one Perfmon log and return the sum and count of each counter per time bucket. Coarser
+    # buckets are exact roll-ups of these, so they can be averaged to any bucket size afterwards.
+    perfmon_data = clean_perfmon_data(read_perfmon_file(perfmon_path, counter_patterns, server))
+    perfmon_buckets = perfmon_data.groupby(bucket_timestamps(perfmon_data.index, interval))
+    return perfmon_buckets.sum(), perfmon_buckets.count()
+
+
+def combine_perfmon_frames(perfmon_frames):
+    # Align the frames of several servers on their common time buckets with an outer join. A counter logged
+    # in more than one file is kept once.
+    perfmon_data = pd.concat(perfmon_frames, axis=1, join='outer', sort=True)
+    perfmon_data = perfmon_data.loc[:, ~perfmon_data.columns.duplicated()]
+    perfmon_data.index.name = 'timeStamp'
+    return perfmon_data
+
+
+def read_perfmon_files(perfmon_paths, counter_patterns=None, server="", max_workers=None):
+    # Parse and bucket the logs of several servers in parallel worker processes, so the total time
+    # is bounded by the largest log rather than the sum of them. Each server samples at its own instants, so
+    # the logs are only joined once they are in time buckets. Returns the (sums, counts) frames of
+    # read_perfmon_buckets() for all of the servers.
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(perfmon_paths)))
+
+    if max_workers == 1:
+        perfmon_buckets = [read_perfmon_buckets(perfmon_path, counter_patterns, server) for perfmon_path in perfmon_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            perfmon_buckets = list(executor.map(read_perfmon_buckets, perfmon_paths, [counter_patterns] * len(perfmon_paths), [server] * len(perfmon_paths)))
+    return (combine_perfmon_frames([perfmon_sums for perfmon_sums, _ in perfmon_buckets]),
+            combine_perfmon_frames([perfmon_counts for _, perfmon_counts in perfmon_buckets]))
+
+
+def average_perfmon_buckets(perfmon_sums, perfmon_counts, interval):
+    # Average the bucket sums and counts of read_perfmon_files() into one time bucket size. Buckets without
+    # any samples of a counter are NaN.
+    timestamps = bucket_timestamps(perfmon_sums.index, interval)
+    perfmon_data = perfmon_sums.groupby(timestamps).sum() / perfmon_counts.groupby(timestamps).sum()
+    perfmon_data = perfmon_data.astype(np.float32)
+    perfmon_data.index.name = 'timeStamp'
+    return perfmon_data
+
+
+def search_counters(counter_metadata, pattern="", server="", counter_object="", instance=""):
+    # Return the counter columns matching the server/object/instance selections and a search pattern.
+    # Patterns containing * or ? are matched as globs against the whole counter path, anything else is
+    # matched (case-insensitively) as a substring of the path.
+    mask = np.ones(len(counter_metadata), dtype=bool)
+    if server:
+        mask &= (counter_metadata['server'] == server).to_numpy()
+    if counter_object:
+        mask &= (counter_metadata['object'] == counter_object).to_numpy()
+    if instance:
+        mask &= (counter_metadata['instance'] == instance).to_numpy()
+
+    pattern = pattern.strip()
+    if pattern:
+        if "*" in pattern or "?" in pattern:
+            glob = re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+            mask &= np.fromiter((glob.match(column) is not None for column in counter_metadata.index), dtype=bool, count=len(counter_metadata))
+        else:
+            mask &= counter_metadata.index.to_series().str.contains(pattern, case=False, regex=False).to_numpy()
+
+    return counter_metadata.index[mask]
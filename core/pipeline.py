@@ -0,0 +1,167 @@
+import fnmatch
+import os
+import re
+from datetime import datetime
+import pandas as pd
+from core.charts import render_charts
+from core.correlation import correlate_columns, lagged_correlate_columns, top_correlate_columns, rank_columns, CorrelationResults
+from core.instrumentation import Trace, finish_trace
+from core.jmeter import read_jmeter_chunks
+from core.perfmon import read_perfmon_files, average_perfmon_buckets, match_counters
+from core.pyramid import default_interval
+
+# The ingest -> filter -> correlate steps of the Streamlit pages as plain functions, so that a run can be
+# processed without a browser (see cli.py)
+
+jmeter_required_columns = ['timeStamp', 'elapsed', 'label', 'responseCode']
+
+
+def local_utc_offset_hours():
+    # JMeter timestamps are UTC epochs while Perfmon logs local time, so JMeter data is shifted by this much
+    return datetime.now().astimezone().utcoffset().total_seconds() / 3600
+
+
+def load_jmeter_file(jmeter_path, interval=default_interval, utc_offset_hours=None, chunk_size=1_000_000):
+    # Stream a JTL file into the label_*/responseCode_*/success_* frame for one time bucket size, indexed by
+    # local timeStamp. Returns (formatted data, number of samples).
+    jmeter_columns = pd.read_csv(jmeter_path, nrows=0).columns
+    missing_columns = [column for column in jmeter_required_columns if column not in jmeter_columns]
+    if missing_columns:
+        raise ValueError(f"The following required columns are missing from the JMeter file: {', '.join(missing_columns)}")
+
+    usecols = [column for column in jmeter_columns if column in jmeter_required_columns + ['success']]
+    jmeter_accumulator = read_jmeter_chunks(jmeter_path, chunk_size=chunk_size, usecols=usecols)
+
+    if utc_offset_hours is None:
+        utc_offset_hours = local_utc_offset_hours()
+    formatted_jmeter_data = jmeter_accumulator.format_jmeter_data(interval)
+    formatted_jmeter_data['timeStamp'] = formatted_jmeter_data['timeStamp'] + pd.DateOffset(hours=utc_offset_hours)
+    return formatted_jmeter_data.set_index('timeStamp'), jmeter_accumulator.sample_count
+
+
+def load_perfmon_file(perfmon_path, interval=default_interval, counter_patterns=None, server=""):
+    # Read the selected counters of a Perfmon .CSV or .BLG, drop counters/samples without data and
+    # average it into one time bucket size
+    return load_perfmon_files([perfmon_path], interval, counter_patterns, server, max_workers=1)
+
+
+def load_perfmon_files(perfmon_paths, interval=default_interval, counter_patterns=None, server="", max_workers=None):
+    # Load one or more Perfmon logs (e.g. one per server) in parallel worker processes and line them up
+    # side by side on the same time buckets, exactly as the Perfmon page does. Only the counters matching
+    # the patterns and server (see filter_perfmon_data) are parsed.
+    perfmon_sums, perfmon_counts = read_perfmon_files(perfmon_paths, counter_patterns, server, max_workers)
+    return average_perfmon_buckets(perfmon_sums, perfmon_counts, interval)
+
+
+def _match_any(values, patterns):
+    # Glob (* and ?) or exact, case-insensitive matches of values against any of the patterns
+    expressions = [re.compile(fnmatch.translate(pattern), re.IGNORECASE) for pattern in patterns]
+    return [value for value in values if any(expression.match(str(value)) for expression in expressions)]
+
+
+def filter_jmeter_data(formatted_jmeter_data, labels=None, response_codes=None):
+    # Keep the label_* and responseCode_* columns matching the label and response code patterns (all of them
+    # when no patterns are given), as the filter page does
+    label_names = [column[len('label_'):] for column in formatted_jmeter_data.columns if column.startswith('label_')]
+    code_names = [column[len('responseCode_'):] for column in formatted_jmeter_data.columns if column.startswith('responseCode_')]
+    if labels:
+        label_names = _match_any(label_names, labels)
+    if response_codes:
+        code_names = _match_any(code_names, response_codes)
+    return formatted_jmeter_data.filter(items=[f'label_{label}' for label in label_names] + [f'responseCode_{code}' for code in code_names])
+
+
+def filter_perfmon_data(formatted_perfmon_data, counter_patterns=None, server=""):
+    # Keep the counters matching any of the search patterns (globs or substrings, see search_counters)
+    return formatted_perfmon_data[match_counters(formatted_perfmon_data.columns, counter_patterns, server)]
+
+
+def prepare_for_correlation(formatted_data, interval, prefix):
+    # The clean-up the correlate page applies to each data set before they are merged
+    non_numeric_columns = formatted_data.select_dtypes(exclude='number').columns
+    if len(non_numeric_columns) > 0:
+        formatted_data = formatted_data.copy()
+        formatted_data[non_numeric_columns] = formatted_data[non_numeric_columns].apply(pd.to_numeric, errors='coerce')
+    formatted_data = formatted_data.round(3).asfreq(interval)
+    formatted_data = formatted_data.loc[~(formatted_data == 0).all(axis=1)]
+    formatted_data = formatted_data.loc[:, (formatted_data != 0).any(axis=0)]
+    formatted_data = formatted_data.dropna(axis=1, how='all').dropna(axis=0, how='all')
+    return formatted_data.add_prefix(prefix)
+
+
+def merge_for_correlation(formatted_perfmon_data, formatted_jmeter_data, interval=default_interval):
+    # Prepare, merge and normalise the two data sets into the merged frame the charts and correlations use
+    merged_data = pd.merge(prepare_for_correlation(formatted_perfmon_data, interval, 'perfmon_'),
+                           prepare_for_correlation(formatted_jmeter_data, interval, 'jmeter_'),
+                           how='inner', left_index=True, right_index=True)
+    return (merged_data - merged_data.mean()) / merged_data.std()
+
+
+def correlate_merged_data(merged_data, interval=default_interval, method="Pearson", max_lag=None, top_k=None):
+    # Correlate every jmeter_ column against every perfmon_ column, optionally by rank (Spearman) and/or
+    # scanning lags of up to max_lag time buckets. With top_k only the top_k strongest perfmon_ columns of
+    # each jmeter_ column are kept, and the full jmeter x perfmon matrix is never built.
+    correlation_data = merged_data.asfreq(interval) if max_lag else merged_data
+    if method == "Spearman":
+        correlation_data = rank_columns(correlation_data)
+
+    if top_k:
+        jmeter_data, perfmon_data = correlation_data.filter(like='jmeter_'), correlation_data.filter(like='perfmon_')
+        top_correlation, top_index, top_lag = top_correlate_columns(jmeter_data, perfmon_data, top_k, max_lag)
+        return CorrelationResults.from_top(jmeter_data.columns, perfmon_data.columns, top_correlation, top_index, top_lag)
+    if max_lag:
+        correlation_matrix, lag_matrix = lagged_correlate_columns(correlation_data.filter(like='jmeter_'), correlation_data.filter(like='perfmon_'), max_lag)
+    else:
+        correlation_matrix = correlate_columns(correlation_data.filter(like='jmeter_'), correlation_data.filter(like='perfmon_'))
+        lag_matrix = None
+    return CorrelationResults.from_matrix(correlation_matrix, lag_matrix)
+
+
+def run_pipeline(jmeter_path, perfmon_paths, output_folder, interval=default_interval, labels=None, response_codes=None,
+                 counter_patterns=None, server="", method="Pearson", max_lag=None, min_correlation=0.8, max_correlation=1.0,
+                 charts=False, max_workers=None, utc_offset_hours=None, top_k=None):
+    # Ingest, filter and correlate one test run, writing correlations.csv (and the charts) to output_folder
+    # along with a JSON trace of how long each step took. Returns the correlations within the min/max range
+    # as a dataframe.
+    os.makedirs(output_folder, exist_ok=True)
+    trace = Trace("pipeline")
+
+    try:
+        with trace.stage("Loading JMeter data"):
+            formatted_jmeter_data, jmeter_transaction_count = load_jmeter_file(jmeter_path, interval, utc_offset_hours)
+            trace.shape(formatted_jmeter_data)
+        with trace.stage("Loading Perfmon data"):
+            # Only the selected counters are parsed, so the Perfmon data is already filtered
+            formatted_perfmon_data = load_perfmon_files(perfmon_paths, interval, counter_patterns, server)
+            trace.shape(formatted_perfmon_data)
+
+        with trace.stage("Filtering"):
+            formatted_jmeter_data = filter_jmeter_data(formatted_jmeter_data, labels, response_codes)
+            if formatted_jmeter_data.shape[1] == 0:
+                raise ValueError("No JMeter labels or response codes match the filters")
+            if formatted_perfmon_data.shape[1] == 0:
+                raise ValueError("No Perfmon counters match the filters")
+
+        with trace.stage("Preparing and merging data"):
+            merged_data = merge_for_correlation(formatted_perfmon_data, formatted_jmeter_data, interval)
+            trace.shape(merged_data)
+        with trace.stage("Calculating correlation coefficients"):
+            correlation_results = correlate_merged_data(merged_data, interval, method, max_lag, top_k)
+
+            correlation_start, correlation_end = correlation_results.range(min_correlation, max_correlation)
+            correlations = correlation_results.to_frame(correlation_start, correlation_end)
+            trace.shape(correlations)
+
+        if charts:
+            with trace.stage("Rendering charts"):
+                render_charts(merged_data, correlations, max_workers=max_workers, folder=os.path.join(output_folder, 'charts'))
+
+        with trace.stage("Saving results"):
+            output_columns = {0: 'jmeter_column', 1: 'perfmon_column', 2: 'correlation', 3: 'lag'}
+            correlations = correlations.rename(columns=output_columns)
+            correlations.to_csv(os.path.join(output_folder, 'correlations.csv'), index=False)
+            merged_data.to_parquet(os.path.join(output_folder, 'merged.parquet'), index=True)
+    finally:
+        finish_trace(trace, {}, output_folder)
+
+    return correlations
@@ -0,0 +1,28 @@
+import pandas as pd
+
+# Time bucket sizes the data is pre-aggregated to, finest first. Every size is a whole multiple of the
+# finer ones, so a coarser bucket is always an exact roll-up of the finer buckets.
+bucket_intervals = ['5s', '15s', '1min', '5min', '15min']
+default_interval = '1min'
+
+bucket_interval_names = {
+    '5s': "5 seconds",
+    '15s': "15 seconds",
+    '1min': "1 minute",
+    '5min': "5 minutes",
+    '15min': "15 minutes",
+}
+
+
+def bucket_timestamps(timestamps, interval=default_interval):
+    # Assign timestamps (a Series or DatetimeIndex) to the start of their time bucket
+    if isinstance(timestamps, pd.Series):
+        return timestamps.dt.floor(interval)
+    return timestamps.floor(interval)
+
+
+def select_interval(pyramid, data, interval=default_interval):
+    # Look up the pre-aggregated frame for an interval, only re-aggregating when it isn't in the pyramid
+    if pyramid is not None and interval in pyramid:
+        return pyramid[interval]
+    return data.resample(interval).mean()
@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+
+
+class SortedSegments:
+    # Exact per-group quantiles from a single sort. The values are sorted once by (group, value), which
+    # leaves each group as a contiguous sorted segment, so any set of percentiles for every group is just
+    # index arithmetic on the segment offsets. Missing values are ignored, as they are by Series.quantile.
+
+    def __init__(self, groups=None, values=None):
+        if groups is None:
+            return
+        groups = pd.Series(groups).reset_index(drop=True)
+        values = pd.Series(values, dtype=float).reset_index(drop=True)
+        present = values.notna().to_numpy()
+
+        codes, self.groups = pd.factorize(groups[present], sort=True)
+        values = values[present].to_numpy()
+
+        # Gather the groups into contiguous segments (a stable sort of small integer codes is a radix sort),
+        # then sort the values within each segment in place
+        self.values = values[np.argsort(codes, kind='stable')]
+        self.counts = np.bincount(codes, minlength=len(self.groups))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            self.values[start:end].sort()
+
+    def to_frame(self):
+        # The sorted values with their (categorical) group, e.g. to hold in the dataset store
+        codes = np.repeat(np.arange(len(self.groups)), self.counts)
+        return pd.DataFrame({'group': pd.Categorical.from_codes(codes, self.groups), 'value': self.values})
+
+    @classmethod
+    def from_frame(cls, frame):
+        # Rebuild the segments from to_frame() without sorting again
+        segments = cls()
+        segments.groups = frame['group'].cat.categories
+        segments.values = frame['value'].to_numpy()
+        segments.counts = np.bincount(frame['group'].cat.codes.to_numpy(), minlength=len(segments.groups))
+        segments.offsets = np.concatenate([[0], np.cumsum(segments.counts)])
+        return segments
+
+    def quantiles(self, percentiles):
+        # Linearly interpolated quantiles (the same as np.percentile and Series.quantile) of every group.
+        # percentiles are fractions between 0 and 1. Returns a dataframe of groups x percentiles.
+        percentiles = np.asarray(percentiles, dtype=float)
+        positions = percentiles[None, :] * (self.counts[:, None] - 1)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.ceil(positions).astype(np.int64)
+        fraction = positions - lower
+
+        result = np.full(positions.shape, np.nan)
+        populated = self.counts > 0
+        starts = self.offsets[:-1, None]
+        lower_values = self.values[(starts + lower)[populated]]
+        upper_values = self.values[(starts + upper)[populated]]
+        result[populated] = lower_values + (upper_values - lower_values) * fraction[populated]
+
+        return pd.DataFrame(result, index=self.groups, columns=percentiles)
+
+
+class ElapsedSketch:
+    # Mergeable per-group quantile estimates in bounded memory, for when the raw values are never held at once
+    # (e.g. a streamed JTL file). Each value is counted in a logarithmic bucket: bucket i holds the values in
+    # (gamma^(i-1), gamma^i] and stands for 2 gamma^i / (gamma + 1), which is within relative_accuracy of every
+    # value in it. The histograms of any number of chunks or files are merged by adding their counts, and
+    # memory is bounded by the number of groups x log_gamma(largest / smallest value).
+
+    # Bucket of the values <= 0
+    zero_bucket = -(2 ** 31)
+
+    parts_per_combine = 32
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.histogram = None
+        self._parts = []
+
+    def add(self, groups, values):
+        # Count a batch of values into the histogram of their group. Missing values are ignored.
+        values = pd.Series(values, dtype=float).reset_index(drop=True)
+        groups = pd.Series(groups).reset_index(drop=True)
+        present = values.notna().to_numpy()
+        buckets = pd.Series(self._bucket(values[present].to_numpy()), name='bucket')
+        self._parts.append(buckets.groupby([groups[present].reset_index(drop=True).rename('group'), buckets], sort=False, observed=True).size())
+        if len(self._parts) >= self.parts_per_combine:
+            self.combine()
+        return self
+
+    def merge(self, other):
+        # Add the histograms of another sketch with the same relative_accuracy
+        other.combine()
+        if other.histogram is not None:
+            self._parts.append(other.histogram)
+        return self
+
+    def combine(self):
+        # Fold the pending batches into the histogram in a single grouped pass
+        if self._parts:
+            if self.histogram is not None:
+                self._parts.insert(0, self.histogram)
+            combined = self._parts[0] if len(self._parts) == 1 else pd.concat(self._parts)
+            self._parts.clear()
+            self.histogram = combined.groupby(level=['group', 'bucket'], sort=False, observed=True).sum()
+        return self
+
+    def quantiles(self, percentiles, minimum=None, maximum=None):
+        # Linearly interpolated quantile estimates of every group, laid out as SortedSegments.quantiles().
+        # Each estimate interpolates between the estimates of the two order statistics either side of it, so
+        # it stays within relative_accuracy of the exact quantile. The exact minimum and maximum of each group
+        # (Series indexed by group), when given, clip the estimates.
+        percentiles = np.asarray(percentiles, dtype=float)
+        histogram = self.combine().histogram
+        if histogram is None:
+            return pd.DataFrame(columns=percentiles, dtype=float)
+        histogram = histogram.sort_index()
+
+        groups = histogram.index.get_level_values('group').unique()
+        result = np.full((len(groups), len(percentiles)), np.nan)
+        for position, group in enumerate(groups):
+            group_histogram = histogram.xs(group, level='group')
+            buckets = group_histogram.index.to_numpy()
+            cumulative_counts = np.cumsum(group_histogram.to_numpy())
+            estimates = np.where(buckets == self.zero_bucket, 0.0, 2 * np.power(self.gamma, buckets.astype(float)) / (self.gamma + 1))
+            if minimum is not None and maximum is not None:
+                estimates = np.clip(estimates, minimum[group], maximum[group])
+
+            ranks = percentiles * (cumulative_counts[-1] - 1)
+            lower = estimates[np.searchsorted(cumulative_counts, np.floor(ranks), side='right')]
+            upper = estimates[np.searchsorted(cumulative_counts, np.ceil(ranks), side='right')]
+            result[position] = lower + (upper - lower) * (ranks - np.floor(ranks))
+
+        return pd.DataFrame(result, index=groups, columns=percentiles)
+
+    def to_frame(self):
+        # The histogram as (group, bucket, count) rows, e.g. to cache or hold in the dataset store
+        histogram = self.combine().histogram
+        if histogram is None:
+            return pd.DataFrame({'group': pd.Series(dtype=object), 'bucket': pd.Series(dtype=np.int64), 'count': pd.Series(dtype=np.int64)})
+        return histogram.rename('count').reset_index()
+
+    @classmethod
+    def from_frame(cls, frame, relative_accuracy=0.01):
+        sketch = cls(relative_accuracy)
+        if len(frame) > 0:
+            sketch.histogram = frame.set_index(['group', 'bucket'])['count']
+        return sketch
+
+    def _bucket(self, values):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            buckets = np.ceil(np.log(values) / np.log(self.gamma))
+        return np.where(values > 0, buckets, self.zero_bucket).astype(np.int64)
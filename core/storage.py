@@ -0,0 +1,24 @@
+import os
+import pandas as pd
+
+# Folder holding the processed (formatted) data artifacts
+formatted_data_folder = "formatted_data"
+
+
+def formatted_data_path(name, folder=formatted_data_folder):
+    return os.path.join(folder, f"{name}.parquet")
+
+
+def save_formatted_data(data, name, folder=formatted_data_folder):
+    # Save a formatted dataframe as a typed, columnar Parquet file. The DatetimeIndex is stored
+    # alongside the columns so it is restored as the index when the file is loaded again.
+    os.makedirs(folder, exist_ok=True)
+    file_path = formatted_data_path(name, folder)
+    data.to_parquet(file_path, engine='pyarrow', index=True)
+    return file_path
+
+
+def load_formatted_data(name, columns=None, folder=formatted_data_folder):
+    # Load a formatted dataframe, optionally reading only the selected columns from disk
+    return pd.read_parquet(formatted_data_path(name, folder), engine='pyarrow', columns=columns)
+
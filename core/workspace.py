@@ -0,0 +1,94 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from core.datastore import dataset_store, release_datasets
+
+# Every browser session gets its own workspace folder for its uploads, formatted data, charts and traces, so
+# that analyses running side by side on one server never overwrite each other's files. A background thread
+# removes the workspaces (and the stored frames) of sessions that have not been used for the time to live,
+# so nothing has to be cleaned up while a page is loading.
+
+workspace_root = "workspaces"
+workspace_folders = ['uploaded_data', 'formatted_data', 'chart_data', 'trace_data']
+
+# Hours a workspace is kept after its session was last used; set WORKSPACE_TTL_HOURS to change it
+workspace_ttl_hours = float(os.environ.get("WORKSPACE_TTL_HOURS", 12))
+
+# How often the background thread looks for expired workspaces
+workspace_cleanup_seconds = 300
+
+# The session state entries holding frames in the dataset store
+session_dataset_names = ["formatted_jmeter_data", "jmeter_pyramid", "raw_jmeter_data", "formatted_perfmon_data", "perfmon_pyramid", "merged_data", "jmeter_elapsed_segments", "jmeter_elapsed_sketch"]
+
+_cleaner_thread = None
+_cleaner_lock = threading.Lock()
+
+
+def session_workspace(session_state, root=workspace_root):
+    # Return the workspace folder of a session, creating it on first use, and mark it as used now. A session
+    # whose workspace has expired starts again with a new, empty one.
+    start_workspace_cleaner(root)
+
+    workspace_id = session_state.get("workspace_id")
+    if workspace_id is not None and not os.path.isdir(os.path.join(root, workspace_id)):
+        release_datasets(session_state, session_dataset_names)
+        workspace_id = None
+    if workspace_id is None:
+        workspace_id = uuid.uuid4().hex
+        session_state["workspace_id"] = workspace_id
+
+    workspace_path = os.path.join(root, workspace_id)
+    for folder in workspace_folders:
+        os.makedirs(os.path.join(workspace_path, folder), exist_ok=True)
+    os.utime(workspace_path)
+    return workspace_path
+
+
+def workspace_folder(session_state, folder, root=workspace_root):
+    # The uploaded_data, formatted_data, chart_data or trace_data folder of a session's workspace
+    return os.path.join(session_workspace(session_state, root), folder)
+
+
+def remove_workspace(workspace_id, root=workspace_root):
+    # Delete a workspace folder and release the frames its session stored
+    dataset_store().release_owner(workspace_id)
+    shutil.rmtree(os.path.join(root, workspace_id), ignore_errors=True)
+
+
+def evict_workspaces(root=workspace_root, ttl_hours=workspace_ttl_hours):
+    # Remove the workspaces that have not been used for ttl_hours. Returns the number removed.
+    if not os.path.isdir(root):
+        return 0
+    expiry_time = time.time() - ttl_hours * 3600
+    evicted = 0
+    for workspace_id in os.listdir(root):
+        try:
+            if os.path.getmtime(os.path.join(root, workspace_id)) < expiry_time:
+                remove_workspace(workspace_id, root)
+                evicted += 1
+        except OSError:
+            # Removed by another process, or a file is still open (Windows); try again next time
+            pass
+    return evicted
+
+
+def start_workspace_cleaner(root=workspace_root, ttl_hours=workspace_ttl_hours, interval_seconds=workspace_cleanup_seconds):
+    # Start the background thread that evicts expired workspaces (once per process)
+    global _cleaner_thread
+    with _cleaner_lock:
+        if _cleaner_thread is not None and _cleaner_thread.is_alive():
+            return _cleaner_thread
+
+        def clean():
+            while True:
+                try:
+                    evict_workspaces(root, ttl_hours)
+                except Exception as e:
+                    print(f"Failed to evict expired workspaces: {e}")
+                time.sleep(interval_seconds)
+
+        _cleaner_thread = threading.Thread(target=clean, name="workspace-cleaner", daemon=True)
+        _cleaner_thread.start()
+        return _cleaner_thread
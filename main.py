@@ -16,18 +16,20 @@ with st.sidebar:
     with r:
         if st.button("Let's Begin!"):
             st.switch_page("pages/jmeter.py")
+        # Follow the files of a test that is still running
+        if st.button("Live test"):
+            st.switch_page("pages/live.py")
     
 
  
     
-folderlist = ['chart_data', 'formatted_data', 'uploaded_data']
+# Each session works in its own workspace, and expired workspaces are removed in the background, so
+# nothing needs cleaning up here. Offer to clear this session's files if it has already processed some.
+if st.session_state.get("dataAvailable"):
+    if st.button("Clear my data and start again"):
+        st.switch_page("pages/cleanup.py")
 
-# If there are any files in any of the folders listed above, write a message saying that the files are being deleted
-if any([len(os.listdir(folder)) > 0 for folder in folderlist]):
-    st.switch_page("pages/cleanup.py")
-
-# if the operating system is not windows, write a message saying that the tool is not supported
+# if the operating system is not windows, write a message saying that .BLG files can't be read here
 if os.name != 'nt':
-    st.error("This tool is only supported on Windows operating systems.")
-    st.stop()
+    st.info("Performance Monitor .BLG files can only be read on Windows. On this machine, please export them to .CSV first (relog <file>.blg -f CSV -o <file>.csv).")
     
@@ -1,48 +1,18 @@
 import streamlit as st
 from config.config import set_page_config
-import os
-import shutil
+from core.datastore import release_datasets
+from core.workspace import remove_workspace, session_dataset_names
 
 set_page_config()
 
-
-
-# if there are any files in the formatted_data folder, delete them   
-folderlist = ['chart_data', 'formatted_data', 'uploaded_data']
-
-# if there are files in the folders listed above, write a message saying that the files are being deleted
-if any([len(os.listdir(folder)) > 0 for folder in folderlist]):
-    st.info("Found some old files here to clean up. One moment please...")
-
-# Initialize the progress bar
-progress_bar = st.progress(0)
-
-# Initialize a counter
-processed_files = 0
-
-for folder in folderlist:
-    # Calculate the total number of files in the current folder
-    total_files = sum([len(files) for r, d, files in os.walk(folder)])
-
-    for filename in os.listdir(folder):
-        file_path = os.path.join(folder, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-        except Exception as e:
-            print('Failed to delete %s. Reason: %s' % (file_path, e))
-
-        # Update the counter
-        processed_files += 1
-
-        # Update the progress bar
-        progress = min(processed_files / total_files, 1)
-        progress_bar.progress(progress)
+# Remove this session's workspace (uploads, formatted data and charts) and the frames it stored. Other
+# sessions keep their own workspaces, and the workspaces of abandoned sessions expire in the background.
+with st.spinner("Clearing your files. One moment please..."):
+    release_datasets(st.session_state, session_dataset_names)
+    if "workspace_id" in st.session_state:
+        remove_workspace(st.session_state["workspace_id"])
 
 # Clear any session states
 st.session_state.clear()
 
 st.switch_page("main.py")
-
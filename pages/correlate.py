@@ -3,6 +3,12 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from config.config import set_page_config
+from core.storage import save_formatted_data
+from core.pipeline import correlate_merged_data
+from core.instrumentation import Trace, finish_trace, trace_table
+from core.datastore import store_dataset, release_datasets
+from core.workspace import workspace_folder
+from core.pyramid import bucket_intervals, bucket_interval_names, default_interval, select_interval
 import math
            
 set_page_config()
@@ -20,8 +26,8 @@ if len(st.session_state["perfmon_filter_array"]) == 0:
 perfmon_filter_array = st.session_state["perfmon_filter_array"]
 jmeter_filter_label_array = st.session_state["jmeter_filter_label_array"]
 jmeter_filter_responsecode_array = st.session_state["jmeter_filter_responsecode_array"]
-formatted_jmeter_data = st.session_state["formatted_jmeter_data"]
-formatted_perfmon_data = st.session_state["formatted_perfmon_data"]
+formatted_jmeter_data = st.session_state["formatted_jmeter_data"].load()
+formatted_perfmon_data = st.session_state["formatted_perfmon_data"].load()
 
 def translate_jmeter_filter(filter_array_row, filter_type):
     if filter_type=="label":
@@ -29,20 +35,6 @@ def translate_jmeter_filter(filter_array_row, filter_type):
     if filter_type=="responsecode":
         return f'responseCode_{filter_array_row}'
 
-def translate_perfmon_filter(filter_array_row):
-    slash = "\\"
-    if filter_array_row[2] == "":
-        return f"{slash}{slash}{filter_array_row[0]}{slash}{filter_array_row[1]}{slash}{filter_array_row[3]}"
-    else:
-        return f"{slash}{slash}{filter_array_row[0]}{slash}{filter_array_row[1]}({filter_array_row[2]}){slash}{filter_array_row[3]}"
-
-
-# Filter the JMeter Data to only retain what was previously selected
-formatted_jmeter_data = formatted_jmeter_data.filter(items=[translate_jmeter_filter(row, "label") for row in jmeter_filter_label_array] + [translate_jmeter_filter(row, "responsecode") for row in jmeter_filter_responsecode_array])
-
-# Filter the Performance Monitor Data to only retain what was previously selected
-translated_filters = [translate_perfmon_filter(row) for row in perfmon_filter_array]
-formatted_perfmon_data = formatted_perfmon_data[translated_filters]
 
 continue_processing = True
 
@@ -55,6 +47,28 @@ with st.sidebar:
         if st.button("Back"):
             st.switch_page("pages/summary.py")
 
+    # Both data sets are pre-aggregated into every time bucket size, so changing it is a lookup rather than a re-aggregation
+    bucket_interval = st.selectbox("Time bucket size", bucket_intervals, index=bucket_intervals.index(st.session_state.get("bucket_interval", default_interval)), format_func=lambda interval: bucket_interval_names[interval])
+    st.session_state["bucket_interval"] = bucket_interval
+
+# The correlation method, lag scan and top counters option are chosen on the filter page
+correlation_method = st.session_state.get("correlation_method", "Pearson")
+lag_scan = st.session_state.get("lag_scan", False)
+max_lag = st.session_state.get("max_lag", 5)
+top_only = st.session_state.get("top_only", False)
+top_k = st.session_state.get("top_k", 20)
+
+# Select the pre-aggregated data for the chosen time bucket size
+formatted_jmeter_data = select_interval(st.session_state.get("jmeter_pyramid"), formatted_jmeter_data, bucket_interval)
+formatted_perfmon_data = select_interval(st.session_state.get("perfmon_pyramid"), formatted_perfmon_data, bucket_interval)
+
+# Filter the JMeter Data to only retain what was previously selected
+formatted_jmeter_data = formatted_jmeter_data.filter(items=[translate_jmeter_filter(row, "label") for row in jmeter_filter_label_array] + [translate_jmeter_filter(row, "responsecode") for row in jmeter_filter_responsecode_array])
+
+# Filter the Performance Monitor Data to only retain what was previously selected (the filter holds the column names)
+formatted_perfmon_data = formatted_perfmon_data[[column for column in perfmon_filter_array if column in formatted_perfmon_data.columns]]
+
+
 main_l, main_c, main_r = st.columns([1,8,1])
 
 with main_c:
@@ -75,12 +89,18 @@ with main_c:
 #     ### PERFORMANCE MONITOR DATA ###
 
 
+    # Record the time and memory each processing step takes
+    trace = Trace("Correlation")
+    
     with st.status(label="Preparing Performance Monitor Data for correlation", state="running", expanded=False) as status:
+        status = trace.track(status, "Preparing Performance Monitor Data for correlation")
       
-        # Replace any non-numeric data with NaN
+        # Replace any non-numeric data with NaN (the Perfmon loader already produces numeric columns, so this is normally a no-op)
         status.update(label="Converting non-numeric data to NaN", expanded=False)
         try:
-            formatted_perfmon_data = formatted_perfmon_data.apply(pd.to_numeric, errors='coerce')
+            non_numeric_columns = formatted_perfmon_data.select_dtypes(exclude='number').columns
+            if len(non_numeric_columns) > 0:
+                formatted_perfmon_data[non_numeric_columns] = formatted_perfmon_data[non_numeric_columns].apply(pd.to_numeric, errors='coerce')
         except Exception as e:
             status.update(label="Error converting non-numeric data to NaN", state="error", expanded=True)
             st.error(f"Error converting non-numeric data to NaN: {e}")
@@ -90,20 +110,17 @@ with main_c:
         status.update(label="Converting numeric data to 3 decimal places", expanded=False)
         # Change all of the data that is numeric (excluding the headers) to 3 decimal places
         try:
-            # Convert each column to float with 3 decimal places
-            numeric_columns = formatted_perfmon_data.columns
-            formatted_perfmon_data[numeric_columns] = formatted_perfmon_data[numeric_columns].apply(pd.to_numeric, errors='coerce')
-            formatted_perfmon_data[numeric_columns] = formatted_perfmon_data[numeric_columns].round(3)
+            formatted_perfmon_data = formatted_perfmon_data.round(3)
         except Exception as e:
             status.update(label="Error rounding Perfmon data", state="error", expanded=True)
             st.error(f"Error rounding Perfmon data: {e}")
             continue_processing=False
             
         if continue_processing:
-            # Aggregate the data into 1 minute intervals
-            status.update(label="Averaging Perfmon data to 1 minute intervals", expanded=False)
+            # Fill any time buckets without samples so both data sets share a regular index
+            status.update(label=f"Aligning Perfmon data to {bucket_interval_names[bucket_interval]} intervals", expanded=False)
             try:
-                formatted_perfmon_data = formatted_perfmon_data.resample('min').mean()
+                formatted_perfmon_data = formatted_perfmon_data.asfreq(bucket_interval)
 
             except Exception as e:
                 status.update(label="Error aggregating Perfmon data", state="error", expanded=True)
@@ -145,6 +162,7 @@ with main_c:
             status.update(label="Removing rows with all NaNs", expanded=True)
             try:
                 formatted_perfmon_data = formatted_perfmon_data.dropna(axis=0, how='all')
+                trace.shape(formatted_perfmon_data)
             except Exception as e:
                 status.update(label="Error removing rows with all NaNs", state="error", expanded=True)
                 st.error(f"Error removing rows with all NaNs: {e}")
@@ -182,6 +200,7 @@ with main_c:
 
 
     with st.status(label="Preparing JMeter Data for correlation", state="running", expanded=False) as status:        
+        status = trace.track(status, "Preparing JMeter Data for correlation")
         
         # Replace any non-numeric data with NaN
         status.update(label="Converting non-numeric data to NaN", expanded=False)
@@ -206,10 +225,10 @@ with main_c:
                     
         
         if continue_processing:
-            # Aggregate the data into 1 minute intervals
-            status.update(label="Averaging JMeter data to 1 minute intervals", expanded=False)
+            # Fill any time buckets without samples so both data sets share a regular index
+            status.update(label=f"Aligning JMeter data to {bucket_interval_names[bucket_interval]} intervals", expanded=False)
             try:
-                formatted_jmeter_data = formatted_jmeter_data.resample('min').mean()
+                formatted_jmeter_data = formatted_jmeter_data.asfreq(bucket_interval)
             except Exception as e:
                 status.update(label="Error aggregating JMeter data", state="error", expanded=True)
                 st.error(f"Error aggregating JMeter data: {e}")
@@ -250,6 +269,7 @@ with main_c:
             status.update(label="Removing rows with all NaNs", expanded=False)
             try:
                 formatted_jmeter_data = formatted_jmeter_data.dropna(axis=0, how='all')
+                trace.shape(formatted_jmeter_data)
             except Exception as e:
                 status.update(label="Error removing rows with all NaNs", state="error", expanded=True)
                 st.error(f"Error removing rows with all NaNs: {e}")
@@ -279,6 +299,7 @@ with main_c:
             status.update(label="Merging Perfmon and JMeter data", expanded=False)
             try:
                 merged_data = pd.merge(formatted_perfmon_data, formatted_jmeter_data, how='inner', left_index=True, right_index=True)
+                trace.shape(merged_data)
             except Exception as e:
                 status.update(label="Error merging Perfmon and JMeter data", state="error", expanded=True)
                 st.error(f"Error merging Perfmon and JMeter data: {e}")
@@ -294,29 +315,42 @@ with main_c:
                 st.error(f"Error normalising Merged data: {e}")
                 continue_processing=False
                 
+        if continue_processing:
+            # Save the merged data to a columnar (Parquet) file so it can be reused outside of the tool
+            status.update(label="Saving Merged data", expanded=False)
+            try:
+                save_formatted_data(merged_data, 'merged', workspace_folder(st.session_state, 'formatted_data'))
+            except Exception as e:
+                status.update(label="Error saving Merged data", state="error", expanded=True)
+                st.error(f"Error saving Merged data: {e}")
+                continue_processing=False
+                
 
-        # Initialize correlation_pairs if it doesn't exist in session state
-        if "correlation_pairs" not in st.session_state:
-            st.session_state.correlation_pairs = {}
-
-        # For each column starting with jmeter_ calculate the correlation with each column starting with perfmon_
+        # Calculate the correlation of every column starting with jmeter_ against every column starting with perfmon_
         if continue_processing:
             status.update(label="Calculating Correlation Coefficients", expanded=False)
-            # Calculate the correlation coefficients for each column against each other column and display the data as it processes
-            for jmeter_column in merged_data.filter(like='jmeter_').columns:
-                for perfmon_column in merged_data.filter(like='perfmon_').columns:
-                    try:
-                        correlation = merged_data[jmeter_column].corr(merged_data[perfmon_column])
-                        # Save correlation pair and value to session state
-                        st.session_state.correlation_pairs[f"{jmeter_column} vs {perfmon_column}"] = correlation
-                    except Exception as e:
-                        status.update(label="Error calculating correlation coefficients", state="error", expanded=True)
-                        st.error(f"Error calculating correlation coefficients: {e}")
-                        continue_processing=False
-                        break
+            try:
+                if lag_scan:
+                    status.update(label=f"Calculating Correlation Coefficients for lags of up to {max_lag} time buckets", expanded=False)
+                
+                # Compute the whole jmeter vs perfmon block at once, or block by block keeping the top counters of each
+                # transaction (ranking every column once for Spearman), and save the correlation pairs and values to
+                # session state as a compact store sorted by strength
+                st.session_state["correlation_results"] = correlate_merged_data(merged_data, bucket_interval, correlation_method, max_lag if lag_scan else None, top_k if top_only else None)
+                trace.shape(st.session_state["correlation_results"].correlation)
+            except Exception as e:
+                status.update(label="Error calculating correlation coefficients", state="error", expanded=True)
+                st.error(f"Error calculating correlation coefficients: {e}")
+                continue_processing=False
                     
-        # Save the merged data to a session state for future use
-        st.session_state["merged_data"] = merged_data
+        trace_data = finish_trace(trace, st.session_state.setdefault("stage_traces", {}), workspace_folder(st.session_state, 'trace_data'))
+        # Show how long each step of this page took
+        with st.expander(f"Processing timings ({trace_data['wall_seconds'].sum():.2f} seconds)"):
+            st.dataframe(trace_table(trace_data), hide_index=True, use_container_width=True)
+        
+        # Save the merged data to the shared dataset store for future use, replacing the previous run's
+        release_datasets(st.session_state, ["merged_data"])
+        st.session_state["merged_data"] = store_dataset(merged_data, st.session_state["workspace_id"])
         
         # Navigate to the display page
         if continue_processing:
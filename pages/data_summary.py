@@ -2,6 +2,8 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
+from core.quantiles import SortedSegments, ElapsedSketch
+from core.datastore import store_dataset, release_datasets
 
 
 st.set_page_config(page_title="Performance Analysis Tool", layout="wide", initial_sidebar_state="collapsed")
@@ -27,8 +29,8 @@ with right_column:
     if st.button("Start Over"):
         st.switch_page("pages/index.py")
 
-# If there is raw_jmeter_data in the session state, add a tab for JMeter data
-if st.session_state.get('raw_jmeter_data', None) is not None:
+# If there is raw_jmeter_data (or, for a streamed, merged or cached upload, the response time sketch) in the session state, add a tab for JMeter data
+if st.session_state.get('raw_jmeter_data', None) is not None or st.session_state.get('jmeter_elapsed_sketch', None) is not None:
     isJMeterData = True
 else:
     isJMeterData = False
@@ -52,27 +54,67 @@ else:
 
         
 if isJMeterData:
+    raw_jmeter_data = None
+    if st.session_state.get('raw_jmeter_data', None) is not None:
+        # Sort the response times by label once; every percentile on this page is then looked up from the sorted segments
+        # (held in the shared dataset store, like the raw data it is built from)
+        raw_jmeter_data = st.session_state['raw_jmeter_data'].load()
+        if st.session_state.get('jmeter_elapsed_segments_source', None) is not st.session_state['raw_jmeter_data'] or 'jmeter_elapsed_segments' not in st.session_state:
+            elapsed_segments = SortedSegments(raw_jmeter_data['label'], raw_jmeter_data['elapsed'])
+            release_datasets(st.session_state, ['jmeter_elapsed_segments'])
+            st.session_state['jmeter_elapsed_segments'] = store_dataset(elapsed_segments.to_frame(), st.session_state['workspace_id'])
+            st.session_state['jmeter_elapsed_segments_source'] = st.session_state['raw_jmeter_data']
+        else:
+            elapsed_segments = SortedSegments.from_frame(st.session_state['jmeter_elapsed_segments'].load())
+    else:
+        # The raw samples were never held in memory, so the statistics come from the per-label summary and the
+        # percentiles are estimated (to within 1%) from the sketch built while the file was read
+        elapsed_summary = st.session_state['jmeter_elapsed_sketch']['summary']
+        elapsed_sketch = ElapsedSketch.from_frame(st.session_state['jmeter_elapsed_sketch']['histogram'])
+    
+    def label_percentiles(percentiles):
+        # A dataframe of labels x percentiles of the response times
+        if raw_jmeter_data is not None:
+            return elapsed_segments.quantiles(percentiles)
+        return elapsed_sketch.quantiles(percentiles, elapsed_summary['min'], elapsed_summary['max'])
+    
     with tab_jmeter:
         tab_jmeter_tables, tab_jmeter_charts, tab_jmeter_sampledata = st.tabs(["Tables", "Charts", "Data Extract"])
         if len(warning_message) > 0:
             st.warning(warning_message)
         with tab_jmeter_tables:
             
-            # Group the data by 'label'
-            grouped_data = st.session_state['raw_jmeter_data'].groupby('label')
+            if raw_jmeter_data is not None:
+                # Calculate the required statistics for each label with built-in aggregations (the compact JMeter
+                # frame has no responseMessage column, so fall back to the success flag)
+                if 'responseMessage' in raw_jmeter_data.columns:
+                    is_ok = (raw_jmeter_data['responseMessage'] == 'OK')
+                else:
+                    is_ok = raw_jmeter_data['success'] == True
+                table_data = raw_jmeter_data.groupby('label', observed=True).agg(
+                    Total_Transactions=('elapsed', 'count'),
+                    Response_Time_Min=('elapsed', 'min'),
+                    Response_Time_Avg=('elapsed', 'mean'),
+                    Response_Time_Max=('elapsed', 'max'),
+                )
+                table_data.insert(1, 'Success', is_ok.groupby(raw_jmeter_data['label'], observed=True).sum())
+                table_data.insert(2, 'Failed', (~is_ok).groupby(raw_jmeter_data['label'], observed=True).sum())
+            else:
+                # The same statistics from the per-label summary (the passed samples are only counted when there is a success column)
+                passed = elapsed_summary['passed'] if 'passed' in elapsed_summary.columns else pd.Series(float('nan'), index=elapsed_summary.index)
+                table_data = pd.DataFrame({
+                    'Total_Transactions': elapsed_summary['count'],
+                    'Success': passed,
+                    'Failed': elapsed_summary['count'] - passed,
+                    'Response_Time_Min': elapsed_summary['min'],
+                    'Response_Time_Avg': elapsed_summary['sum'] / elapsed_summary['count'],
+                    'Response_Time_Max': elapsed_summary['max'],
+                })
             
-            # Calculate the required statistics for each group
-            table_data = grouped_data.agg(
-                Total_Transactions=('elapsed', 'count'),
-                Success=('responseMessage', lambda x: (x == 'OK').sum()),
-                Failed=('responseMessage', lambda x: (x != 'OK').sum()),
-                Response_Time_Min=('elapsed', 'min'),
-                Response_Time_Avg=('elapsed', 'mean'),
-                Response_Time_Max=('elapsed', 'max'),
-                Response_Time_90th=('elapsed', lambda x: np.percentile(x, 90)),
-                Response_Time_95th=('elapsed', lambda x: np.percentile(x, 95)),
-                Response_Time_99th=('elapsed', lambda x: np.percentile(x, 99))
-            )
+            # Look up the percentiles of every label (exact from the sorted segments, or estimated from the sketch)
+            percentile_data = label_percentiles([0.90, 0.95, 0.99])
+            percentile_data.columns = ['Response_Time_90th', 'Response_Time_95th', 'Response_Time_99th']
+            table_data = table_data.join(percentile_data)
 
             # Rename the columns
             table_data = table_data.rename(columns={'Response_Time_90th':'90%','Response_Time_Max':'Max','Response_Time_Avg':'Avg','Response_Time_Min':'Min','Total_Transactions': '#', 'Success': 'Pass','Failed': 'Fail','Response_Time_95th': '95%', 'Response_Time_99th': '99%'})
@@ -92,58 +134,74 @@ if isJMeterData:
         with tab_jmeter_charts:
             tab_jmeter_charts_rt,  tab_jmeter_charts_rc, tab_jmeter_charts_rb, tab_jmeter_charts_perc = st.tabs(["Response Times", "Response Codes", "Received Bytes", "Percentile"])
             with tab_jmeter_charts_rt:
-                # Aggregate the data to get the average 'elapsed' time for each 'timeStamp' and 'label' combination
-                aggregated_data = st.session_state['raw_jmeter_data'].groupby(['timeStamp', 'label'])['elapsed'].mean().reset_index()
+                if raw_jmeter_data is not None:
+                    # Aggregate the data to get the average 'elapsed' time for each 'timeStamp' and 'label' combination
+                    aggregated_data = raw_jmeter_data.groupby(['timeStamp', 'label'], observed=True)['elapsed'].mean().reset_index()
                 
-                # Pivot the aggregated data
-                chart_data = aggregated_data.pivot(index='timeStamp', columns='label', values='elapsed')
+                    # Pivot the aggregated data
+                    chart_data = aggregated_data.pivot(index='timeStamp', columns='label', values='elapsed')
                 
-                # Get a list of all unique labels
-                all_labels = chart_data.columns.tolist()
+                    # Get a list of all unique labels
+                    all_labels = chart_data.columns.tolist()
                 
-                # Create a multiselect widget for label selection
-                rt_selected_labels = st.multiselect('Select labels to display', all_labels, default=all_labels)
+                    # Create a multiselect widget for label selection
+                    rt_selected_labels = st.multiselect('Select labels to display', all_labels, default=all_labels)
                 
-                # Filter the chart data based on the selected labels
-                filtered_chart_data = chart_data[rt_selected_labels]
+                    # Filter the chart data based on the selected labels
+                    filtered_chart_data = chart_data[rt_selected_labels]
                 
-                st.caption("Transaction Response Times")
-                st.line_chart(filtered_chart_data, use_container_width=True)
+                    st.caption("Transaction Response Times")
+                    st.line_chart(filtered_chart_data, use_container_width=True)
+                else:
+                    # Chart the average response time of every label from the formatted data instead
+                    chart_data = st.session_state['formatted_jmeter_data'].load().filter(like='label_')
+                    chart_data.columns = [column[len('label_'):] for column in chart_data.columns]
+                    all_labels = chart_data.columns.tolist()
+                    rt_selected_labels = st.multiselect('Select labels to display', all_labels, default=all_labels)
+                    st.caption("Transaction Response Times")
+                    st.line_chart(chart_data[rt_selected_labels], use_container_width=True)
             
             with tab_jmeter_charts_rc:
-                # Filter the raw data based on the selected labels
-                filtered_data = st.session_state['raw_jmeter_data'][st.session_state['raw_jmeter_data']['label'].isin(rt_selected_labels)]
+                if raw_jmeter_data is not None:
+                    # Filter the raw data based on the selected labels
+                    filtered_data = raw_jmeter_data[raw_jmeter_data['label'].isin(rt_selected_labels)]
                 
-                # Count the total number of 'responseCode' for each unique response code and label
-                grouped_data = filtered_data.groupby(['responseCode', 'label']).size().reset_index(name='count')
+                    # Count the total number of 'responseCode' for each unique response code and label
+                    grouped_data = filtered_data.groupby(['responseCode', 'label'], observed=True).size().reset_index(name='count')
                 
-                # Pivot the grouped data so that each label becomes a separate column
-                chart_data = grouped_data.pivot(index='responseCode', columns='label', values='count').fillna(0)
+                    # Pivot the grouped data so that each label becomes a separate column
+                    chart_data = grouped_data.pivot(index='responseCode', columns='label', values='count').fillna(0)
                 
-                st.caption("Response Codes")
-                st.bar_chart(chart_data, use_container_width=True)
+                    st.caption("Response Codes")
+                    st.bar_chart(chart_data, use_container_width=True)
+                else:
+                    st.caption("The response codes of each label are only available when a single file is loaded without streaming.")
             
             with tab_jmeter_charts_rb:
-                # Aggregate the data to get the average 'bytes' for each 'timeStamp' and 'label' combination
-                aggregated_data = st.session_state['raw_jmeter_data'].groupby(['timeStamp', 'label'])['bytes'].mean().reset_index()
+                if raw_jmeter_data is not None:
+                    # Aggregate the data to get the average 'bytes' for each 'timeStamp' and 'label' combination
+                    aggregated_data = raw_jmeter_data.groupby(['timeStamp', 'label'], observed=True)['bytes'].mean().reset_index()
 
-                # Pivot the aggregated data  
-                chart_data = aggregated_data.pivot(index='timeStamp', columns='label', values='bytes')
+                    # Pivot the aggregated data  
+                    chart_data = aggregated_data.pivot(index='timeStamp', columns='label', values='bytes')
 
-                # Add a 'total_bytes' column that is the sum of all other columns
-                chart_data['TOTAL BYTES'] = chart_data.sum(axis=1)
+                    # Add a 'total_bytes' column that is the sum of all other columns
+                    chart_data['TOTAL BYTES'] = chart_data.sum(axis=1)
 
-                # Get a list of all unique labels plus 'total_bytes'
-                all_labels = chart_data.columns.tolist()
+                    # Get a list of all unique labels plus 'total_bytes'
+                    all_labels = chart_data.columns.tolist()
 
-                # Create a multiselect widget for label selection with a unique key
-                rb_selected_labels = st.multiselect('Select labels to display', all_labels, default=all_labels, key='rb_select')
+                    # Create a multiselect widget for label selection with a unique key
+                    rb_selected_labels = st.multiselect('Select labels to display', all_labels, default=all_labels, key='rb_select')
 
-                # Filter the chart data based on the selected labels
-                filtered_chart_data = chart_data[rb_selected_labels]
+                    # Filter the chart data based on the selected labels
+                    filtered_chart_data = chart_data[rb_selected_labels]
 
-                st.caption("Received Bytes")
-                st.line_chart(filtered_chart_data, use_container_width=True)
+                    st.caption("Received Bytes")
+                    st.line_chart(filtered_chart_data, use_container_width=True)
+                else:
+                    st.caption("The received bytes are only available when a single file is loaded without streaming.")
+                    all_labels = elapsed_summary.index.tolist()
                 
             with tab_jmeter_charts_perc:
                 # Create percentile charts for each label
@@ -153,25 +211,18 @@ if isJMeterData:
             
                 percentiles = np.arange(0.01, 1.01, 0.01)
             
-                # Initialize an empty DataFrame to store the percentile values for each label
-                percentile_values = pd.DataFrame({'percentile': percentiles})
-            
                 # Create a select box for time unit selection
                 time_unit = st.selectbox('Select time unit', ['milliseconds', 'seconds'], key='time_unit_select')
             
-                for label in all_labels:
-                    # Filter the raw data based on the selected label
-                    filtered_data = st.session_state['raw_jmeter_data'][st.session_state['raw_jmeter_data']['label'] == label]
-                    
-                    # Convert the 'elapsed' column to seconds if the user selects 'seconds'
-                    if time_unit == 'seconds':
-                        filtered_data['elapsed'] = filtered_data['elapsed'] / 1000
-            
-                    # Calculate the corresponding percentile values for the 'elapsed' column
-                    label_percentile_values = filtered_data['elapsed'].quantile(percentiles)
-                    
-                    # Add the percentile values to the DataFrame
-                    percentile_values[label] = label_percentile_values.values
+                # Look up every percentile of every label in one pass
+                label_percentile_values = label_percentiles(percentiles).reindex(all_labels).T
+                
+                # Convert the values to seconds if the user selects 'seconds'
+                if time_unit == 'seconds':
+                    label_percentile_values = label_percentile_values / 1000
+                
+                # Store the percentile values for each label alongside the percentiles
+                percentile_values = pd.concat([pd.DataFrame({'percentile': percentiles}), label_percentile_values.reset_index(drop=True)], axis=1)
             
                 # Multiply the 'percentile' column by 100 and convert it to an integer
                 percentile_values['percentile'] = (percentile_values['percentile'] * 100).astype(int)
@@ -1,35 +1,32 @@
 import streamlit as st
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import seaborn as sns
 import pandas as pd
-import os
 import base64
+import os
 
 from config.config import set_page_config
+from core.charts import chart_filename, render_charts
+from core.workspace import workspace_folder
+from core.instrumentation import trace_table
+from core.pyramid import bucket_intervals, bucket_interval_names, default_interval
 
 set_page_config()
 
 chart_display_width = 500
 chart_display_height = 300
 
-def cleanup_header_names(correlation_data):
-    correlation_data[0] = correlation_data[0].str.replace('jmeter_label_','')
-    correlation_data[0] = correlation_data[0].str.replace('jmeter_responseCode_','')
-    correlation_data[1] = correlation_data[1].str.replace('perfmon_','')
-    return correlation_data
-    
+# Number of correlations shown (and charted) per page of results
+correlations_per_page = 20
+
 # Check for cached data
 
 if "merged_data" in st.session_state:
-    merged_data = st.session_state["merged_data"]
-    # st.write(merged_data.head())
+    merged_data = st.session_state["merged_data"].load()
 else:
     st.switch_page("main.py")
     
 
-if "correlation_pairs" in st.session_state:
-    correlation_pairs = st.session_state["correlation_pairs"]
+if "correlation_results" in st.session_state:
+    correlation_results = st.session_state["correlation_results"]
 else:
     st.switch_page("pages/correlate.py")
     
@@ -41,23 +38,30 @@ with st.sidebar:
         min_val = min_val / 100
         max_val = max_val / 100
         
-        # Calculate the number of correlations that will be returned based on the min/max slider value
-        correlations = []
-        for jmeter_column in merged_data.filter(like='jmeter_').columns:
-            for perfmon_column in merged_data.filter(like='perfmon_').columns:
-                correlation = merged_data[jmeter_column].corr(merged_data[perfmon_column])
-                if min_val <= abs(correlation) <= max_val:
-                    correlations.append((jmeter_column, perfmon_column, correlation))
-
-        # Sort the correlations in descending order
-        correlations.sort(key=lambda x: abs(x[2]), reverse=True)
+        # Look up the correlations within the min/max slider values (already sorted in descending order)
+        correlation_start, correlation_end = correlation_results.range(min_val, max_val)
+        correlations = correlation_results.to_frame(correlation_start, correlation_end)
         
-        # Reset the index
-        correlations = pd.DataFrame(correlations).reset_index(drop=True)   
+        # Group the correlations by JMeter column
+        correlation_groups = correlation_results.group_positions(correlation_start, correlation_end)
+                    
+        # Changing the time bucket size re-runs the correlation using the pre-aggregated data for that size
+        current_interval = st.session_state.get("bucket_interval", default_interval)
+        bucket_interval = st.selectbox("Time bucket size", bucket_intervals, index=bucket_intervals.index(current_interval), format_func=lambda interval: bucket_interval_names[interval])
+        if bucket_interval != current_interval:
+            st.session_state["bucket_interval"] = bucket_interval
+            st.switch_page("pages/correlate.py")
+        
+        # Charts are kept per time bucket size, correlation method and lag scan (in this session's workspace), as
+        # each chart is titled with its coefficient, so changing any of them never shows a chart of another run
+        chart_run_name = st.session_state.get("correlation_method", "Pearson").lower()
+        if st.session_state.get("lag_scan", False):
+            chart_run_name += f"_lag{st.session_state.get('max_lag', 5)}"
+        interval_chart_folder = os.path.join(workspace_folder(st.session_state, 'chart_data'), bucket_interval, chart_run_name)
                     
         # Create a toggle here for "Display Charts" that defaults to off
         display_charts = st.checkbox("Display Charts", value=False)  
-        st.warning("More correlations found mean a longer time to process the charts.")   
+        st.caption(f"Charts are only created for the {correlations_per_page} correlations on the page being viewed.")   
         
         # Reindex correlations
         correlations = correlations.reset_index(drop=True)
@@ -68,44 +72,6 @@ with st.sidebar:
             correlation_text = "correlations"
        
         st.write(f"{len(correlations)} {correlation_text} found.")
-        if display_charts: 
-            # Initialise the progress bar
-            progress_bar = st.progress(0)
-            total_charts = len(correlations)
-            for i in range(total_charts):
-                # Update the progress bar
-                progress_percentage = int((i / total_charts) * 100)
-                progress_bar.progress(progress_percentage)
-                
-                jmeter_column = correlations[0][i]
-                perfmon_column = correlations[1][i]
-                correlation = correlations[2][i]
-                fig_filename = f"{jmeter_column}_{perfmon_column}.png".replace("\\", "_").replace("%", "_").replace("/", "_")
-                fig_filename = os.path.join("chart_data", fig_filename)
-
-                
-                # Check if the file already exists
-                if not os.path.exists(fig_filename):
-                    jmeter_column_name = f"(JMeter) {jmeter_column.replace('jmeter_', '')}"
-                    perfmon_column_name = f"(Perfmon) {perfmon_column.replace('perfmon_', '')}"
-                    if min_val <= abs(correlation) <= max_val:
-                        fig, ax = plt.subplots(figsize=(10, 6))
-                        sns.lineplot(data=merged_data, x=merged_data.index, y=jmeter_column, ax=ax, label=jmeter_column_name)
-                        sns.lineplot(data=merged_data, x=merged_data.index, y=perfmon_column, ax=ax, label=perfmon_column_name)
-                        if correlation < 0:
-                            ax.set_title(f"{correlation*100:.2f}% (Negative Correlation)")
-                        elif correlation == 0:
-                            ax.set_title(f"{correlation*100:.2f}% (Correlation)")
-                        else:
-                            ax.set_title(f"{correlation*100:.2f}% (Positive Correlation)")
-                        ax.set_xlabel("Time") 
-                        ax.set_ylabel("Normalised Value")
-                        ax.legend()
-                        # Format x-axis to display time as hh:mm
-                        ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-                        fig.savefig(fig_filename, format='png')
-            progress_bar.progress(100) 
-                
         
         sidebar_l, sidebar_c, sidebar_r = st.columns([1,1,2])
 
@@ -134,129 +100,83 @@ if len(correlations) == 0:
     st.write(f"No correlations found for the correlation range selected ({min_val*100}% to {max_val*100}%)")
 else:
 
-    # Utilising the data available in correlations, create a list of unique transaction names from the column names that include the string "jmeter_label_" and place them in a new list called transaction_names
-    transaction_names = list(set([x.split('jmeter_label_')[1] for x in correlations[0] if 'jmeter_label_' in x]))
+    # Create a list of the unique transaction names from the grouped JMeter columns that start with "jmeter_label_"
+    transaction_names = [column[len('jmeter_label_'):] for column in correlation_groups if column.startswith('jmeter_label_')]
 
-    # Utilising the data available in correlations, create a list of unique response codes from the column names that include the string "jmeter_responseCode_" and place them in a new list called response_codes
-    response_codes = list(set([x.split('jmeter_responseCode_')[1] for x in correlations[0] if 'jmeter_responseCode_' in x]))
+    # Create a list of the unique response codes from the grouped JMeter columns that start with "jmeter_responseCode_"
+    response_codes = [column[len('jmeter_responseCode_'):] for column in correlation_groups if column.startswith('jmeter_responseCode_')]
     response_codes.sort(reverse=False)
 
-    main_tabs = st.tabs(["Transactions","Response Codes"])
-
-    # Generate the correlation charts and save them to the chart_data folder
-
-    # Transactions
-    with main_tabs[0]:
-        # List all of the transaction names as tabs
-        if len(transaction_names) > 0:
-            transaction_tabs = st.tabs(transaction_names)
-            for i, transaction_tab in enumerate(transaction_tabs):
-                if transaction_tab:
-                    with transaction_tab:
-                        # left_column, right_column = st.columns([1,1])
-                        # Assign column names                
-                        transaction_correlations = correlations[correlations[0].str.contains(f'{transaction_names[i]}')]
-                        
-                        # Remove the string of "perfmon_" from the data
-                        transaction_column_original = transaction_correlations[1]
-                        transaction_correlations[1] = transaction_correlations[1].str.replace('perfmon_','')
-                        
-                        # Create a new dataframe that contains just the final 2 columns from transaction_correlations
-                        transaction_correlations = transaction_correlations.iloc[:,1:3]
-                        raw_correlation = transaction_correlations.iloc[:,1]
-                        transaction_correlations.columns=["Performance Counter","Correlation %"]
-                                                
-                        # Format the correlation values to display only two decimal places
-                        transaction_correlations["Correlation %"] = transaction_correlations["Correlation %"] * 100
-                        transaction_correlations["Correlation %"] = transaction_correlations["Correlation %"].map("{:.2f}%".format)
-
-
-                        # Create a table, with two columns if the display charts toggle is false, or three columns if the display charts toggle is true
-                        # The first and second columms are the transaction_correlation.columns and the third column will contain the correlation chart if the display charts toggle is clicked
-
-                        table_html = "<table><tr><td>Performance Counter</td><td>Correlation %</td>"
-                        if display_charts:
-                            table_html += "<td>Chart</td>"
-                        table_html += "</tr>"
-
-                        for index, row in transaction_correlations.iterrows():
-                            jmeter_column = correlations[0][index]
-                            perfmon_column = correlations[1][index]
-                            correlation = correlations[2][index]
-                            table_html += f"<tr><td>{row['Performance Counter']}</td><td>{row['Correlation %']}</td>"
-                            if display_charts:
-
-                                fig_filename = f"{jmeter_column}_{perfmon_column}.png".replace("\\", "_").replace("%", "_").replace("/", "_")
-                                fig_filename = os.path.join("chart_data", fig_filename)
-                                
-                                # Convert the image to a Base64 string
-                                with open(fig_filename, "rb") as image_file:
-                                    base64_string = base64.b64encode(image_file.read()).decode('utf-8')
-                                
-                                # Embed the Base64 string directly into the HTML
-                                table_html += f"<td><img width='{chart_display_width}' height='{chart_display_height}' src='data:image/png;base64,{base64_string}' /></td>"
-                            table_html += "</tr>"
-
-                        table_html += "</table>"
-                        st.write(table_html, unsafe_allow_html=True)
-
-
-                    
-        else:
-            transaction_tabs=[]
-            st.write("No transaction codes found for the correlation range selected")
+    # Only the selected transaction or response code is displayed, one page at a time, so charts are created on demand
+    view_type = st.radio(" ", ["Transactions", "Response Codes"], horizontal=True, key="display_view_type", label_visibility="collapsed")
+    
+    if view_type == "Transactions":
+        group_names, group_prefix, group_text = transaction_names, 'jmeter_label_', "transaction"
+    else:
+        group_names, group_prefix, group_text = response_codes, 'jmeter_responseCode_', "response code"
+    
+    if len(group_names) == 0:
+        st.write(f"No {group_text}s found for the correlation range selected")
+    else:
+        select_l, select_r = st.columns([3,1])
+        with select_l:
+            group_name = st.selectbox(f"Select a {group_text}", group_names, key=f"display_{group_prefix}select")
+        
+        group_positions = correlation_groups[f'{group_prefix}{group_name}']
+        page_count = max(1, -(-len(group_positions) // correlations_per_page))
+        with select_r:
+            page_number = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1, key=f"display_{group_prefix}{group_name}_page")
+        
+        # Select the correlations for the current page
+        page_positions = group_positions[(page_number - 1) * correlations_per_page:page_number * correlations_per_page]
+        group_correlations = correlations.iloc[page_positions]
         
+        if display_charts:
+            # Render any charts for this page that don't exist yet across a pool of worker processes
+            progress_bar = st.progress(0)
             
-    # Response Codes
-    with main_tabs[1]:
-        # List all of the response codes as tabs
-        if len(response_codes) > 0:
-            responseCode_tabs = st.tabs(response_codes)
-            for i, responseCode_tab in enumerate(responseCode_tabs):
-                if responseCode_tab:
-                    with responseCode_tab:
-                        # Assign column names                
-                        responseCode_correlations = correlations[correlations[0].str.contains(f'responseCode_{response_codes[i]}')]
-                        
-                        # Remove the string of "perfmon_" from the data
-                        responseCode_correlations[1] = responseCode_correlations[1].str.replace('perfmon_','')
-                        
-                        # Create a new dataframe that contains just the final 2 columns from responseCode_correlations
-                        responseCode_correlations = responseCode_correlations.iloc[:,1:3]
-                        responseCode_correlations.columns=["Performance Counter","Correlation %"]
-                        # Format the correlation values to display only two decimal places
-                        responseCode_correlations["Correlation %"] = responseCode_correlations["Correlation %"] * 100
-                        responseCode_correlations["Correlation %"] = responseCode_correlations["Correlation %"].map("{:.2f}%".format)
-                        
-                         # Create a table, with two columns if the display charts toggle is false, or three columns if the display charts toggle is true
-                        # The first and second columms are the transaction_correlation.columns and the third column will contain the correlation chart if the display charts toggle is clicked
-
-                        table_html = "<table><tr><td>Performance Counter</td><td>Correlation %</td>"
-                        if display_charts:
-                            table_html += "<td>Chart</td>"
-                        table_html += "</tr>"
-
-                        for index, row in responseCode_correlations.iterrows():
-                            jmeter_column = correlations[0][index]
-                            perfmon_column = correlations[1][index]
-                            correlation = correlations[2][index]
-                            table_html += f"<tr><td>{row['Performance Counter']}</td><td>{row['Correlation %']}</td>"
-                            if display_charts:
-
-                                fig_filename = f"{jmeter_column}_{perfmon_column}.png".replace("\\", "_").replace("%", "_").replace("/", "_")
-                                fig_filename = os.path.join("chart_data", fig_filename)
-                                
-                                # Convert the image to a Base64 string
-                                with open(fig_filename, "rb") as image_file:
-                                    base64_string = base64.b64encode(image_file.read()).decode('utf-8')
-                                
-                                # Embed the Base64 string directly into the HTML
-                                table_html += f"<td><img width='{chart_display_width}' height='{chart_display_height}' src='data:image/png;base64,{base64_string}' /></td>"
-                            table_html += "</tr>"
-
-                        table_html += "</table>"
-                        st.write(table_html, unsafe_allow_html=True)
+            def update_chart_progress(completed_charts, total_charts):
+                progress_bar.progress(int((completed_charts / total_charts) * 100) if total_charts else 100)
             
-        else:
-            responseCode_tabs=[]
-            st.write("No response codes found for the correlation range selected")
\ No newline at end of file
+            render_charts(merged_data, group_correlations, progress_callback=update_chart_progress, folder=interval_chart_folder)
+            progress_bar.empty()
+        
+        # Create a table, with two columns if the display charts toggle is false, or three columns if the display charts toggle is true
+        # The first and second columms are the performance counter and correlation % and the third column will contain the correlation chart if the display charts toggle is clicked
+        # Results of a lag scan also show how many time buckets the counter leads (+) or trails (-) the JMeter data by
+        display_lags = correlation_results.lag is not None
+        
+        table_html = "<table><tr><td>Performance Counter</td><td>Correlation %</td>"
+        if display_lags:
+            table_html += "<td>Lag</td>"
+        if display_charts:
+            table_html += "<td>Chart</td>"
+        table_html += "</tr>"
+        
+        for position, (jmeter_column, perfmon_column, correlation) in enumerate(zip(group_correlations[0], group_correlations[1], group_correlations[2])):
+            # Remove the string of "perfmon_" from the counter and format the correlation value to two decimal places
+            table_html += f"<tr><td>{perfmon_column.replace('perfmon_', '', 1)}</td><td>{correlation * 100:.2f}%</td>"
+            if display_lags:
+                table_html += f"<td>{group_correlations[3].iloc[position]:+d}</td>"
+            if display_charts:
+                fig_filename = chart_filename(jmeter_column, perfmon_column, interval_chart_folder)
+                
+                # Convert the image to a Base64 string
+                with open(fig_filename, "rb") as image_file:
+                    base64_string = base64.b64encode(image_file.read()).decode('utf-8')
+                
+                # Embed the Base64 string directly into the HTML
+                table_html += f"<td><img width='{chart_display_width}' height='{chart_display_height}' src='data:image/png;base64,{base64_string}' /></td>"
+            table_html += "</tr>"
+        
+        table_html += "</table>"
+        st.write(table_html, unsafe_allow_html=True)
+
+# Show how long each processing step took
+stage_traces = st.session_state.get("stage_traces", {})
+if len(stage_traces) > 0:
+    st.divider()
+    with st.expander("Processing timings"):
+        for trace_name, trace_data in stage_traces.items():
+            st.caption(f"{trace_name} ({trace_data['wall_seconds'].sum():.2f} seconds)")
+            st.dataframe(trace_table(trace_data), hide_index=True, use_container_width=True)
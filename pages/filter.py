@@ -2,11 +2,15 @@ import streamlit as st
 import pandas as pd
 import time
 from config.config import set_page_config
+from core.perfmon import perfmon_counter_metadata, search_counters
 from datetime import datetime
 import tkinter as tk
 
 set_page_config()
 
+# Maximum number of Perfmon counters listed at once on the page
+perfmon_display_limit = 500
+
 def format_seconds_to_text(seconds):
     # Convert the duration to hours, minutes, and seconds
     duration_hours, remainder = divmod(seconds, 3600)
@@ -60,8 +64,8 @@ if "display_error" not in st.session_state:
 if ('formatted_jmeter_data' not in st.session_state) or ('formatted_perfmon_data' not in st.session_state):
     st.switch_page("main.py")
     
-formatted_jmeter_data=st.session_state.formatted_jmeter_data
-formatted_perfmon_data=st.session_state.formatted_perfmon_data
+formatted_jmeter_data=st.session_state.formatted_jmeter_data.load()
+formatted_perfmon_data=st.session_state.formatted_perfmon_data.load()
 
 jmeter_min_date, jmeter_min_time, jmeter_max_date, jmeter_max_time, jmeter_min_datetime, jmeter_max_datetime, jmeter_duration_seconds_total = extract_min_max_time(formatted_jmeter_data)
 perfmon_min_date, perfmon_min_time, perfmon_max_date, perfmon_max_time, perfmon_min_datetime, perfmon_max_datetime, perfmon_duration_seconds_total = extract_min_max_time(formatted_perfmon_data)
@@ -80,7 +84,8 @@ common_max_time = common_max_datetime.strftime("%H:%M")
 common_duration_seconds_total = (common_max_datetime - common_min_datetime).total_seconds()
 
 def calculate_jmeter_summary(display_table=False):        
-    total_jmeter_transactions = formatted_jmeter_data.shape[0]   
+    # The formatted data holds one row per minute, so use the sample count recorded at ingest
+    total_jmeter_transactions = st.session_state.get("jmeter_transaction_count", formatted_jmeter_data.shape[0])   
     if jmeter_min_date == jmeter_max_date:
         jmeter_summary = {
             'Total Number of Transactions': total_jmeter_transactions,
@@ -212,9 +217,6 @@ else:
     formatted_jmeter_responsecode_columns = [column.replace("responseCode_", "") for column in jmeter_responsecode_columns]
 
 
-    # Extract perfmon_columns from formatted_perfmon_data
-    perfmon_data_columns = [column for column in formatted_perfmon_data.columns]
-
     main_tabs = st.tabs(["JMeter Information", "Performance Monitor Counters"])
 
     # JMeter Transaction tab
@@ -278,85 +280,101 @@ else:
          
     # Performance Monitor Tab
     with main_tabs[1]:
-        # Extract unique server names
-        perfmon_counter_data_array = []
+        # Use the server/object/instance/counter index built when the Perfmon data was loaded
+        counter_metadata = st.session_state.get("perfmon_counter_metadata")
+        if counter_metadata is None or not counter_metadata.index.equals(formatted_perfmon_data.columns):
+            counter_metadata = perfmon_counter_metadata(formatted_perfmon_data.columns)
+            st.session_state["perfmon_counter_metadata"] = counter_metadata
         
-        for column in perfmon_data_columns:
-            server_name = column.split("\\")[2]
-            if "(" in column.split("\\")[3]:
-                counter_topic = column.split("\\")[3].split("(")[0]
-                counter_subtopic = column.split("\\")[3].split("(")[1].replace(")", "")
-            else:
-                counter_topic = column.split("\\")[3]
-                counter_subtopic = ""
-            counter_name = column.split("\\")[4]
-            perfmon_counter_data_array.append([server_name, counter_topic, counter_subtopic, counter_name])
-            
-
-        # Organize data into a nested dictionary for easier access
-        perfmon_data_dict = {}
-        for entry in perfmon_counter_data_array:
-            server_name, counter_topic, counter_subtopic, counter_name = entry
-            if server_name not in perfmon_data_dict:
-                perfmon_data_dict[server_name] = {}
-            if counter_topic not in perfmon_data_dict[server_name]:
-                perfmon_data_dict[server_name][counter_topic] = {}
-            if counter_subtopic not in perfmon_data_dict[server_name][counter_topic]:
-                perfmon_data_dict[server_name][counter_topic][counter_subtopic] = []
-            perfmon_data_dict[server_name][counter_topic][counter_subtopic].append(counter_name)
-
-        server_tabs = st.tabs(list(perfmon_data_dict.keys()))
-
-    
-        # Adjusted section for adding checkboxes and collecting selected counter names into a filter array
-
-        filter_array = []
-
-        # Adjusted section for adding a 'Select All' option in the final child tab
-
-        for server_name in perfmon_data_dict:
-            with server_tabs[list(perfmon_data_dict.keys()).index(server_name)]:
-                # Create tabs for each counter topic under the current server
-                if perfmon_data_dict[server_name]:  # Check if there are topics for the server
-                    topic_tabs = st.tabs(list(perfmon_data_dict[server_name].keys()))
-                    for counter_topic in perfmon_data_dict[server_name]:
-                        with topic_tabs[list(perfmon_data_dict[server_name].keys()).index(counter_topic)]:
-                            # Check if there are subtopics for the current topic
-                            if perfmon_data_dict[server_name][counter_topic]:
-                                # If there's only one subtopic and it's empty, list counter names directly under the topic
-                                if len(perfmon_data_dict[server_name][counter_topic]) == 1 and "" in perfmon_data_dict[server_name][counter_topic]:
-                                    select_all = st.checkbox("``` SELECT  ALL```", key=f"{server_name}_{counter_topic}_select_all") 
-                                    for counter_name in perfmon_data_dict[server_name][counter_topic][""]:
-                                        # Create a checkbox for each counter name
-                                        selected = st.checkbox(f"{counter_name}", value=select_all, key=f"{server_name}_{counter_topic}_{counter_name}")
-                                        if selected:
-                                            filter_array.append((server_name, counter_topic, "", counter_name))
-                                else:
-                                    # Create tabs for each counter subtopic under the current topic
-                                    subtopic_tabs = st.tabs(list(perfmon_data_dict[server_name][counter_topic].keys()))
-                                    for counter_subtopic in perfmon_data_dict[server_name][counter_topic]:
-                                        with subtopic_tabs[list(perfmon_data_dict[server_name][counter_topic].keys()).index(counter_subtopic)]:
-                                            # Add a 'Select All' option for the current subtopic
-                                            select_all = st.checkbox('``` SELECT  ALL```', key=f"{server_name}_{counter_topic}_{counter_subtopic}_select_all")
-                                            # List all counter names under the current subtopic with checkboxes
-                                            for counter_name in perfmon_data_dict[server_name][counter_topic][counter_subtopic]:
-                                                selected = st.checkbox(f"{counter_name}", value=select_all, key=f"{server_name}_{counter_topic}_{counter_subtopic}_{counter_name}")
-                                                if selected:
-                                                    filter_array.append((server_name, counter_topic, counter_subtopic, counter_name))
-            
-            st.session_state["perfmon_filter_array"] = filter_array
-            if (len(filter_array) == 0):
-                st.session_state["display_error"] = "No Performance Monitor counters have been selected. Please select at least one item to correlate."
-            else:
-                st.session_state["display_error"] = None          
+        # The selected counters are kept as a set of column names
+        if "perfmon_selected_counters" not in st.session_state:
+            st.session_state["perfmon_selected_counters"] = set()
+            st.session_state["perfmon_selection_version"] = 0
+        selected_counters = st.session_state["perfmon_selected_counters"]
+        
+        # Narrow down the counters by server, object and instance, and by a search pattern
+        server_col, object_col, instance_col = st.columns([1,1,1])
+        with server_col:
+            server_name = st.selectbox("Server", [""] + sorted(counter_metadata['server'].unique()), format_func=lambda value: value or "All servers", key="perfmon_server")
+        with object_col:
+            # Each list only offers what the selections to its left leave
+            server_metadata = counter_metadata if not server_name else counter_metadata[counter_metadata['server'] == server_name]
+            counter_object = st.selectbox("Object", [""] + sorted(server_metadata['object'].unique()), format_func=lambda value: value or "All objects", key="perfmon_object")
+        with instance_col:
+            instance_options = server_metadata['instance'] if not counter_object else server_metadata.loc[server_metadata['object'] == counter_object, 'instance']
+            instance = st.selectbox("Instance", [""] + sorted(value for value in instance_options.unique() if value), format_func=lambda value: value or "All instances", key="perfmon_instance")
+        
+        search_pattern = st.text_input("Search counters", placeholder=r"e.g. Processor Time, or a glob such as \\*\Process(java*)\*", key="perfmon_search")
+        matching_counters = search_counters(counter_metadata, search_pattern, server_name, counter_object, instance)
+        
+        # Bulk selection of everything that matches
+        bulk_l, bulk_c, bulk_r = st.columns([1,1,3])
+        with bulk_l:
+            if st.button(f"Select all {len(matching_counters)} matching", key="perfmon_select_matching"):
+                selected_counters.update(matching_counters)
+                st.session_state["perfmon_selection_version"] += 1
+        with bulk_c:
+            if st.button("Clear matching", key="perfmon_clear_matching"):
+                selected_counters.difference_update(matching_counters)
+                st.session_state["perfmon_selection_version"] += 1
+        with bulk_r:
+            st.write(f"{len(selected_counters)} of {len(counter_metadata)} counters selected.")
+        
+        # Show the matching counters (up to a limit) with a checkbox each
+        displayed_counters = matching_counters[:perfmon_display_limit]
+        if len(matching_counters) > perfmon_display_limit:
+            st.caption(f"Showing the first {perfmon_display_limit} of {len(matching_counters)} matching counters. Refine the search to see the rest, or use the bulk selection buttons.")
+        
+        counter_table = counter_metadata.loc[displayed_counters].reset_index(drop=True)
+        counter_table.insert(0, 'Selected', [counter in selected_counters for counter in displayed_counters])
+        edited_table = st.data_editor(
+            counter_table,
+            disabled=['server', 'object', 'instance', 'counter'],
+            hide_index=True,
+            use_container_width=True,
+            # A new key whenever the listed counters or bulk selection change, so earlier checkbox edits aren't re-applied
+            key=f"perfmon_editor_{server_name}_{counter_object}_{instance}_{search_pattern}_{st.session_state['perfmon_selection_version']}",
+        )
+        selected_counters.difference_update(displayed_counters)
+        selected_counters.update(displayed_counters[edited_table['Selected'].to_numpy(dtype=bool)])
+        
+        # Keep the selection in the original column order
+        filter_array = [column for column in counter_metadata.index if column in selected_counters]
+        st.session_state["perfmon_filter_array"] = filter_array
+        if (len(filter_array) == 0):
+            st.session_state["display_error"] = "No Performance Monitor counters have been selected. Please select at least one item to correlate."
+        else:
+            st.session_state["display_error"] = None          
                 
-            calculate_common_summary()
+        calculate_common_summary()
         
         with st.sidebar:
             st.header("Filter Your Data")
             st.divider()
             st.write("If there is any information you don't need to correlate, it will save time by excluding it.  \n   \n Select which items you would like to include in the correlation analysis and then press the button below to continue.")    
             
+            # The correlation options are chosen here, as the correlation page starts as soon as it opens
+            st.divider()
+            
+            # Spearman (rank) correlation is less sensitive to outliers and to step-like counters than Pearson
+            correlation_methods = ["Pearson", "Spearman"]
+            correlation_method = st.radio("Correlation method", correlation_methods, index=correlation_methods.index(st.session_state.get("correlation_method", "Pearson")), horizontal=True)
+            st.session_state["correlation_method"] = correlation_method
+            
+            # Optionally look for counters that lead or trail the response times by a few time buckets
+            lag_scan = st.checkbox("Scan for lagged correlations", value=st.session_state.get("lag_scan", False))
+            st.session_state["lag_scan"] = lag_scan
+            if lag_scan:
+                max_lag = st.number_input("Maximum lag (time buckets)", min_value=1, max_value=120, value=st.session_state.get("max_lag", 5), step=1)
+                st.session_state["max_lag"] = max_lag
+            
+            # With many counters, keeping only the strongest few of each transaction saves building every pair
+            top_only = st.checkbox("Only keep the most correlated counters of each transaction", value=st.session_state.get("top_only", False))
+            st.session_state["top_only"] = top_only
+            if top_only:
+                top_k = st.number_input("Counters per transaction", min_value=1, max_value=1000, value=st.session_state.get("top_k", 20), step=1)
+                st.session_state["top_k"] = top_k
+            
             sidebar_l, sidebar_c, sidebar_r = st.columns([3,1,5])
 
             with sidebar_l:
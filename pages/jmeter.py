@@ -2,6 +2,15 @@ import streamlit as st
 import pandas as pd
 import time
 from config.config import set_page_config
+from core.storage import save_formatted_data
+from core.cache import hash_upload, load_cached_pyramid, save_cached_pyramid
+from core.jmeter import format_jmeter_data, translate_timestamps, read_jmeter_files, read_jmeter_csv, summarise_labels
+from core.quantiles import ElapsedSketch
+from core.pyramid import bucket_intervals, bucket_interval_names, default_interval
+from core.instrumentation import Trace, finish_trace, trace_table
+from core.datastore import store_dataset, store_pyramid, release_datasets
+from core.workspace import workspace_folder
+import os
 import pytz
 from datetime import datetime
 
@@ -10,6 +19,15 @@ set_page_config()
 # Detail the minimum required columns for the JMeter file
 required_columns = ['timeStamp', 'elapsed', 'label', 'responseCode']
 
+# Number of rows read at a time when streaming a JMeter file
+jmeter_chunk_size = 1_000_000
+
+# Parameters that change the formatted output; they form part of the cache key along with the file contents
+jmeter_cache_parameters = {'source': 'jmeter', 'intervals': bucket_intervals, 'version': 3}
+
+# The per-label response time summary and percentile sketch, cached and stored alongside the bucket sizes
+jmeter_elapsed_frames = ['summary', 'histogram']
+
 # Create the sidebar
 with st.sidebar:
     st.title("JMeter Analysis")
@@ -29,100 +47,155 @@ main_l, main_c, main_r = st.columns([1,4,1])
 
 with main_c:
     st.subheader("JMeter (.JTL) Report")
-    st.caption("JMeter JTL reports contain the performance test results and are in a .CSV format.")
+    st.caption("JMeter JTL reports contain the performance test results and are in a .CSV format. For distributed tests, upload the report of every load generator.")
    
-    jmeter_file = st.file_uploader(" ", type=['jtl'], key="jmeter", accept_multiple_files=False)
+    jmeter_files = st.file_uploader(" ", type=['jtl'], key="jmeter", accept_multiple_files=True)
+    
+    # Streaming keeps only the per-bucket totals in memory while processing. Streamlit still holds the whole upload in
+    # memory (up to maxUploadSize), so files larger than that have to go through cli.py, which reads from disk.
+    stream_file = st.checkbox("Stream the file in chunks (recommended for very large files)", value=False, key="jmeter_stream")
+    st.caption("Uploads are limited to 2 GB. For larger files use the command-line version (see the README).")
     
-    # If a jmeter file has been selected, process it
-    if jmeter_file:
+    # The reports of several load generators are always streamed and merged, with an optional clock correction for each
+    clock_offsets = [0.0] * len(jmeter_files)
+    process_files = len(jmeter_files) == 1
+    if len(jmeter_files) > 1:
+        st.caption("The reports will be merged into one set of results. If a load generator's clock was out, enter the number of seconds to add to its timestamps.")
+        clock_offset_data = st.data_editor(pd.DataFrame({'File': [jmeter_file.name for jmeter_file in jmeter_files], 'Clock offset (seconds)': 0.0}),
+                                           disabled=['File'], hide_index=True, use_container_width=True, key="jmeter_clock_offsets")
+        clock_offsets = clock_offset_data['Clock offset (seconds)'].fillna(0).tolist()
+        process_files = st.button("Process files")
+        stream_file = True
+    
+    # If jmeter files have been selected, process them
+    if jmeter_files and process_files:
         st.session_state["do_not_show_skip_button"] = True
         continue_processing = True
         
-        # Create a dataframe to store the formatted JMeter data
-        formatted_jmeter_data = pd.DataFrame()
+        # Create a dictionary to store the formatted JMeter data for each time bucket size
+        jmeter_pyramid = {}
+        jmeter_elapsed_data = {}
                
+        # Record the time and memory each processing step takes
+        trace = Trace("JMeter")
+        
         with st.status("Uploading JMeter File",  state="running", expanded=False) as status:
+            status = trace.track(status, "Uploading JMeter File")
             
-            # Transfer the file to the uploaded_data directory
+            # Check whether this exact file has already been processed
+            cache_hit = False
             try:
-                with open(f"uploaded_data/jmeter.csv", "wb") as f:
-                    f.write(jmeter_file.getbuffer())
-            except Exception as e:
-                status.update(label="Error loading the JMeter File", state="error", expanded=True)
-                st.error(f"Error loading the JMeter File: {e}")
-                continue_processing=False
+                status.update(label="Checking for previously processed results", state="running", expanded=False)
+                cache_key = hash_upload([jmeter_file.getbuffer() for jmeter_file in jmeter_files], {**jmeter_cache_parameters, 'clock_offsets': clock_offsets})
+                cached_jmeter_pyramid, cached_metadata = load_cached_pyramid(cache_key, bucket_intervals + jmeter_elapsed_frames)
+                if cached_jmeter_pyramid is not None:
+                    jmeter_elapsed_data = {name: cached_jmeter_pyramid.pop(name) for name in jmeter_elapsed_frames}
+                    jmeter_pyramid = cached_jmeter_pyramid
+                    jmeter_transaction_count = cached_metadata.get("transaction_count", 0)
+                    cache_hit = True
+            except Exception:
+                # The cache is only an optimisation, so carry on and process the file as normal
+                cache_key = None
             
-            # Load the file into a dataframe
-            if continue_processing:  
+            # Transfer the files to the uploaded_data directory of this session's workspace
+            upload_folder = workspace_folder(st.session_state, 'uploaded_data')
+            if len(jmeter_files) == 1:
+                jmeter_paths = [os.path.join(upload_folder, "jmeter.csv")]
+            else:
+                jmeter_paths = [os.path.join(upload_folder, f"jmeter_{index}.csv") for index in range(len(jmeter_files))]
+            if not cache_hit:
+                try:
+                    for jmeter_file, jmeter_path in zip(jmeter_files, jmeter_paths):
+                        with open(jmeter_path, "wb") as f:
+                            f.write(jmeter_file.getbuffer())
+                except Exception as e:
+                    status.update(label="Error loading the JMeter File", state="error", expanded=True)
+                    st.error(f"Error loading the JMeter File: {e}")
+                    continue_processing=False
+            
+            # Load the file into a dataframe (or only its header when streaming)
+            if continue_processing and not cache_hit:  
                 status.update(label="Moving contents into a dataframe", state="running", expanded=False)
                 try:
-                    jmeter_df = pd.read_csv('uploaded_data/jmeter.csv')
+                    if stream_file:
+                        # Only the columns present in every file can be relied on
+                        jmeter_headers = [pd.read_csv(jmeter_path, nrows=0).columns for jmeter_path in jmeter_paths]
+                        jmeter_columns = [column for column in jmeter_headers[0] if all(column in jmeter_header for jmeter_header in jmeter_headers[1:])]
+                    else:
+                        # Only the used columns are loaded, as categoricals and downcast integers
+                        jmeter_df = read_jmeter_csv(jmeter_paths[0])
+                        trace.shape(jmeter_df)
+                        jmeter_columns = jmeter_df.columns
                 except Exception as e:
                     status.update(label="Error moving contents into a dataframe", state="error", expanded=True)
                     st.error(f"Error moving contents into a dataframe: {e}")
                     continue_processing=False
             
             # Verify mandatory column information
-            if continue_processing:  
+            if continue_processing and not cache_hit:  
                 status.update(label="Checking for mandatory columns", state="running", expanded=False)
-                if not all(column in jmeter_df.columns for column in required_columns):
+                if not all(column in jmeter_columns for column in required_columns):
                     status.update(label="Required columns are missing", state="error", expanded=True)
-                    missing_columns = [column for column in required_columns if column not in jmeter_df.columns]
+                    missing_columns = [column for column in required_columns if column not in jmeter_columns]
                     st.error(f"The following required columns are missing from the JMeter file: {', '.join(missing_columns)}")
                     continue_processing=False
                                
-            # Convert the timestamp to the correct format and round it to the nearest minute
-            if continue_processing:
+            # Convert the timestamp to the correct format
+            if continue_processing and not cache_hit:
                 try:
-                    status.update(label="Translating timestamps", state="running", expanded=False)              
-                    jmeter_df['timeStamp'] = pd.to_datetime(jmeter_df['timeStamp'], unit='ms')
-                    jmeter_df['timeStamp'] = jmeter_df['timeStamp'].dt.round('min')
-                    
-                    # Add the translated timeStamp column to the formatted_jmeter_data dataframe
-                    formatted_jmeter_data['timeStamp'] = jmeter_df['timeStamp']
+                    if stream_file:
+                        # Fold each file into per-bucket accumulators one chunk at a time (in parallel for several files) and merge them
+                        status.update(label="Streaming the file and translating timestamps" if len(jmeter_paths) == 1 else f"Streaming and merging {len(jmeter_paths)} files", state="running", expanded=False)
+                        usecols = [column for column in jmeter_columns if column in required_columns + ['success']]
+                        jmeter_accumulator = read_jmeter_files(jmeter_paths, [int(clock_offset * 1000) for clock_offset in clock_offsets], chunk_size=jmeter_chunk_size, columns=usecols)
+                    else:
+                        status.update(label="Translating timestamps", state="running", expanded=False)              
+                        jmeter_df = translate_timestamps(jmeter_df)
                                    
                 except Exception as e:
                     status.update(label="Error translating timestamps", state="error", expanded=True)
                     st.error(f"Error translating timestamps: {e}")
                     continue_processing=False
             
-            try:
-                unique_labels = jmeter_df['label'].unique()
-                for columnlabel in unique_labels:
-                    status.update(label="Formatting Label '{}'".format(columnlabel), state="running", expanded=False)
-                    column_name = f"label_{columnlabel}"
-                    label_data = jmeter_df[jmeter_df['label'] == columnlabel].groupby('timeStamp')['elapsed'].mean().reset_index().rename(columns={'elapsed': column_name})
-                    formatted_jmeter_data = pd.merge(formatted_jmeter_data, label_data, on='timeStamp', how='left')
-            except Exception as e:
-                status.update(label="Error formatting labels", state="error", expanded=True)
-                st.error(f"Error formatting labels: {e}")
-                continue_processing=False
+            # Aggregate the data into every time bucket size, creating the label_xxx (average elapsed time), responseCode_xxx (count) and success_true/success_false (count) columns
+            if continue_processing and not cache_hit:
+                for interval in bucket_intervals:
+                    try:
+                        status.update(label=f"Aggregating to {bucket_interval_names[interval]} intervals", state="running", expanded=False)
+                        jmeter_pyramid[interval] = jmeter_accumulator.format_jmeter_data(interval) if stream_file else format_jmeter_data(jmeter_df, interval)
+                        trace.shape(jmeter_pyramid[interval])
+                    except Exception as e:
+                        status.update(label="Error formatting the JMeter data", state="error", expanded=True)
+                        st.error(f"Error aggregating to {bucket_interval_names[interval]} intervals: {e}")
+                        continue_processing=False
+                        break
             
-            if continue_processing:
-                # For each unique value in the responseCode field, create a new column in the formatted_jmeter_data dataframe for each unique responseCode field called responseCode_xxx where xxx is the response code, and contains the count of that responseCode for each timestamp
+            # Summarise the response times of every label and sketch their percentiles, so the percentile tables are
+            # available whichever way the file was read (the raw samples are only kept for a single file loaded in memory)
+            if continue_processing and not cache_hit:
                 try:
-                    unique_response_codes = jmeter_df['responseCode'].unique()
-                    for code in unique_response_codes:
-                        status.update(label="Formatting Response Code '{}'".format(code), state="running", expanded=False)
-                        column_name = f"responseCode_{code}"
-                        code_data = jmeter_df[jmeter_df['responseCode'] == code].groupby('timeStamp')['responseCode'].count().reset_index().rename(columns={'responseCode': column_name})
-                        formatted_jmeter_data = pd.merge(formatted_jmeter_data, code_data, on='timeStamp', how='left')
+                    status.update(label="Summarising the response times", state="running", expanded=False)
+                    if stream_file:
+                        jmeter_elapsed_data['summary'] = jmeter_accumulator.summarise_labels()
+                        jmeter_elapsed_data['histogram'] = jmeter_accumulator.elapsed_sketch.to_frame()
+                    else:
+                        jmeter_elapsed_data['summary'] = summarise_labels(jmeter_df)
+                        jmeter_elapsed_data['histogram'] = ElapsedSketch().add(jmeter_df['label'], jmeter_df['elapsed']).to_frame()
                 except Exception as e:
-                    status.update(label="Error formatting response codes", state="error", expanded=True)
-                    st.error(f"Error formatting response codes: {e}")
-                    continue_processing=False
-                    
-            if continue_processing:
-                # if the column 'success' exists in the jmeter data, create a new columns in the formatted_jmeter_data dataframe called 'success_true' and 'success_false' that contains the count of the number of times the 'success' column is true or false for each timestamp
-                try:        
-                    if 'success' in jmeter_df.columns:
-                        status.update(label="Formatting Statuses", state="running", expanded=False)
-                        formatted_jmeter_data['success_true'] = jmeter_df[jmeter_df['success'] == True].groupby('timeStamp')['success'].count().reset_index(drop=True).astype(int)
-                        formatted_jmeter_data['success_false'] = jmeter_df[jmeter_df['success'] == False].groupby('timeStamp')['success'].count().reset_index(drop=True).astype(int)
-                except Exception as e:
-                    status.update(label="Error formatting statuses", state="error", expanded=True)
-                    st.error(f"Error formatting statuses: {e}")
+                    status.update(label="Error summarising the response times", state="error", expanded=True)
+                    st.error(f"Error summarising the response times: {e}")
                     continue_processing=False
+            
+            if continue_processing and not cache_hit:
+                jmeter_transaction_count = jmeter_accumulator.sample_count if stream_file else len(jmeter_df)
+                
+                # Cache the formatted data so the same file can be reused without processing it again
+                if cache_key is not None:
+                    try:
+                        status.update(label="Caching the formatted data", state="running", expanded=False)
+                        save_cached_pyramid(cache_key, {**jmeter_pyramid, **jmeter_elapsed_data}, {"transaction_count": jmeter_transaction_count})
+                    except Exception as e:
+                        st.warning(f"Unable to cache the formatted data: {e}")
                     
             if continue_processing:
                 # Retrieve the current time in UTC
@@ -134,29 +207,47 @@ with main_c:
                 # Calculate the difference in hours between the current time in UTC and the current time in the local timezone
                 time_difference = (current_time_local - current_time).seconds / 3600
 
-                # Add the time difference to the timeStamp column
-                formatted_jmeter_data['timeStamp'] = formatted_jmeter_data['timeStamp'] + pd.DateOffset(hours=time_difference)
-            
-        
-                status.update(label="Finalising the process", state="error", expanded=True)
+                status.update(label="Finalising the process", state="running", expanded=True)
+                
+                for interval, interval_data in jmeter_pyramid.items():
+                    # Add the time difference to the timeStamp column
+                    interval_data['timeStamp'] = interval_data['timeStamp'] + pd.DateOffset(hours=time_difference)
                     
-                # Set the timeStamp as the dataframe index
-                formatted_jmeter_data.set_index('timeStamp', inplace=True) 
+                    # Set the timeStamp as the dataframe index
+                    interval_data.set_index('timeStamp', inplace=True) 
+                
+                # The rest of the tool works with the default bucket size unless another one is chosen
+                formatted_jmeter_data = jmeter_pyramid[default_interval]
                 
                 try:
                     status.update(label="Saving Processed Results", state="running", expanded=False)
                     
-                    # Save the formatted data to the session state
-                    st.session_state["formatted_jmeter_data"] = formatted_jmeter_data
+                    # Hold every pre-aggregated bucket size once in the shared dataset store and keep handles to them (the
+                    # formatted data is the default bucket size) and the number of samples in the session state
+                    release_datasets(st.session_state, ["formatted_jmeter_data", "jmeter_pyramid", "raw_jmeter_data", "jmeter_elapsed_segments", "jmeter_elapsed_sketch"])
+                    stored_jmeter_pyramid = store_pyramid(jmeter_pyramid, st.session_state["workspace_id"])
+                    st.session_state["jmeter_pyramid"] = stored_jmeter_pyramid
+                    st.session_state["formatted_jmeter_data"] = stored_jmeter_pyramid.handles[default_interval]
+                    st.session_state["jmeter_transaction_count"] = jmeter_transaction_count
+                    st.session_state["jmeter_elapsed_sketch"] = store_pyramid(jmeter_elapsed_data, st.session_state["workspace_id"])
+                    
+                    # Keep the compact frame of raw samples for the percentile tables when the whole file was loaded
+                    if not stream_file and not cache_hit:
+                        st.session_state["raw_jmeter_data"] = store_dataset(jmeter_df, st.session_state["workspace_id"])
                     
-                    # Save the formatted data to a CSV file
-                    formatted_jmeter_data.to_csv('formatted_data/jmeter.csv')
+                    # Save the formatted data to a columnar (Parquet) file
+                    save_formatted_data(formatted_jmeter_data, 'jmeter', workspace_folder(st.session_state, 'formatted_data'))
                     
                 except Exception as e:
                     status.update(label="Error saving processed results", state="error", expanded=True)
                     st.error(f"Error saving processed results: {e}")
                     continue_processing=False
                     
+            trace_data = finish_trace(trace, st.session_state.setdefault("stage_traces", {}), workspace_folder(st.session_state, 'trace_data'))
+            # Show how long each step of this page took
+            with st.expander(f"Processing timings ({trace_data['wall_seconds'].sum():.2f} seconds)"):
+                st.dataframe(trace_table(trace_data), hide_index=True, use_container_width=True)
+            
             if continue_processing:
                 status.update(label="Process Completed", state="complete", expanded=True)
                 st.success("JMeter data has been successfully processed.")
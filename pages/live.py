@@ -0,0 +1,88 @@
+import streamlit as st
+import time
+from config.config import set_page_config
+from core.live import LiveCorrelator
+from core.pipeline import local_utc_offset_hours
+from core.pyramid import bucket_intervals, bucket_interval_names, default_interval
+
+set_page_config()
+
+# Number of correlations listed while the test is running
+live_correlation_count = 50
+
+with st.sidebar:
+    st.title("Live Correlation")
+    st.write("Follow the JMeter results and Perfmon log of a test that is still running. The correlations are updated as each time bucket completes.")
+    st.divider()
+
+    jmeter_path = st.text_input("JMeter .JTL (CSV) file", value=st.session_state.get("live_jmeter_path", ""))
+    perfmon_path = st.text_input("Perfmon .CSV file", value=st.session_state.get("live_perfmon_path", ""))
+    bucket_interval = st.selectbox("Time bucket size", bucket_intervals, index=bucket_intervals.index(default_interval), format_func=lambda interval: bucket_interval_names[interval])
+    utc_offset_hours = st.number_input("Hours to add to the JMeter timestamps", value=local_utc_offset_hours(), step=0.5)
+    refresh_seconds = st.number_input("Refresh every (seconds)", min_value=1, value=10)
+    min_val, max_val = st.slider("Select the minimum and maximum correlation values to display ", 0.0, 100.0, (80.0, 100.0))
+
+    sidebar_l, sidebar_c, sidebar_r = st.columns([1,1,1])
+
+    with sidebar_l:
+        if st.button("Home"):
+            st.session_state.pop("live_correlator", None)
+            st.switch_page("main.py")
+    with sidebar_c:
+        if st.button("Start"):
+            st.session_state["live_jmeter_path"] = jmeter_path
+            st.session_state["live_perfmon_path"] = perfmon_path
+            # The files are only followed, never copied, so they stay on the local disk where the test writes them
+            st.session_state["live_correlator"] = LiveCorrelator(jmeter_path, perfmon_path, bucket_interval, utc_offset_hours)
+            st.session_state["live_running"] = True
+    with sidebar_r:
+        if st.button("Stop"):
+            if "live_correlator" in st.session_state:
+                # Include the buckets still waiting for the other file, as the test has finished
+                st.session_state["live_correlator"].flush()
+            st.session_state["live_running"] = False
+
+main_l, main_c, main_r = st.columns([1,4,1])
+
+with main_c:
+    st.subheader("Live Correlation")
+
+    live_correlator = st.session_state.get("live_correlator")
+    if live_correlator is None:
+        st.caption("Enter the paths of the files the test is writing and press Start.")
+        st.stop()
+
+    if st.session_state.get("live_running"):
+        try:
+            live_correlator.poll()
+        except Exception as e:
+            st.error(f"Error reading the files: {e}")
+            st.session_state["live_running"] = False
+
+    metric_1, metric_2, metric_3, metric_4 = st.columns(4)
+    metric_1.metric("JMeter samples", f"{live_correlator.sample_count:,}")
+    metric_2.metric("Completed buckets", f"{live_correlator.running_correlation.rows:,}")
+    metric_3.metric("Late samples", f"{live_correlator.late_samples:,}")
+    metric_4.metric("Completed up to", live_correlator.completed_until.strftime('%H:%M:%S') if live_correlator.completed_until is not None else "-")
+
+    # Reading the correlations from the running sums only costs O(pairs), however long the test has been running
+    correlation_results = live_correlator.correlation_results()
+    correlation_start, correlation_end = correlation_results.range(min_val / 100, max_val / 100)
+    correlations = correlation_results.to_frame(correlation_start, min(correlation_end, correlation_start + live_correlation_count))
+    correlations[0] = correlations[0].str.replace('jmeter_label_','').str.replace('jmeter_responseCode_','')
+    correlations[1] = correlations[1].str.replace('perfmon_','')
+    correlations[2] = (correlations[2] * 100).round(1)
+
+    st.write(f"{correlation_end - correlation_start} correlations found.")
+    st.dataframe(correlations.rename(columns={0: 'JMeter', 1: 'Perfmon', 2: 'Correlation (%)'}), hide_index=True, use_container_width=True)
+
+    if len(correlations) > 0:
+        # Only the chosen pair's recent buckets are gathered, so charting doesn't grow with the length of the test
+        pair_columns = correlation_results.to_frame(correlation_start, correlation_start + len(correlations))
+        selected_pair = st.selectbox("Chart", range(len(pair_columns)), format_func=lambda position: f"{correlations[0][position]} / {correlations[1][position]}")
+        pair_data = live_correlator.pair_data(pair_columns[0][selected_pair], pair_columns[1][selected_pair])
+        st.line_chart((pair_data - pair_data.mean()) / pair_data.std())
+
+if st.session_state.get("live_running"):
+    time.sleep(refresh_seconds)
+    st.rerun()
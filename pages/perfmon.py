@@ -1,19 +1,30 @@
 import streamlit as st
-import pandas as pd
-import subprocess                  
+import os
 from config.config import set_page_config
+from core.storage import save_formatted_data
+from core.cache import hash_upload, load_cached_pyramid, save_cached_pyramid
+from core.pyramid import bucket_intervals, bucket_interval_names, default_interval
+from core.perfmon import blg_supported, read_perfmon_files, average_perfmon_buckets, perfmon_counter_metadata
+from core.instrumentation import Trace, finish_trace, trace_table
+from core.datastore import store_pyramid, release_datasets
+from core.workspace import workspace_folder
 
 set_page_config()
 
 # Detail the minimum required columns for the Performance Monitor file
 required_columns = []
 
+# Parameters that change the formatted output; they form part of the cache key along with the file contents
+perfmon_cache_parameters = {'source': 'perfmon', 'intervals': bucket_intervals, 'decimals': 3, 'version': 5}
+
 with st.sidebar:
     st.title("Windows Performance Monitor Analysis")
     st.divider()
     # st.write("If you have a Performance Monitor file, you can upload it here have it correlated with other data.")
     # st.write("If you don't have a Performance Monitor file, you can skip this step by pressing the *Skip Step* button.") 
-    info_text = "This file must be in the .BLG format produced by Perfmon."
+    info_text = "This file must be in the .BLG format produced by Perfmon, or a .CSV exported from it."
+    if not blg_supported():
+        info_text += "\n\n.BLG files can only be read on Windows. On this machine please upload a .CSV created with `relog <file>.blg -f CSV -o <file>.csv`."
 
     st.write(info_text)
 
@@ -27,135 +38,128 @@ main_l, main_c, main_r = st.columns([1,4,1])
 
 with main_c:
     st.subheader("Performance Monitor (.BLG, .CSV)")
-    st.caption("JMeter JTL reports contain the performance test results and are in a .BLG or .CSV format.")
+    st.caption("Performance Monitor logs contain the server metrics and are in a .BLG or .CSV format. Upload the log of every server that was monitored.")
    
-    perfmon_file = st.file_uploader(" ", type=['blg','csv'], key="perfmon", accept_multiple_files=False)
+    perfmon_files = st.file_uploader(" ", type=['blg','csv'], key="perfmon", accept_multiple_files=True)
     
-    # If a jmeter file has been selected, process it
-    if perfmon_file:
+    # If perfmon files have been selected, process them
+    if perfmon_files:
         continue_processing = True
         
+        # Record the time and memory each processing step takes
+        trace = Trace("Perfmon")
+        
         with st.status("Uploading Perfmon File",  state="running", expanded=False) as status:
-            # Transfer the file to the uploaded_data directory
+            status = trace.track(status, "Uploading Perfmon File")
+            # Check whether this exact file has already been processed
+            cache_hit = False
+            perfmon_pyramid = {}
             try:
-
-                if perfmon_file.name.endswith('.blg'):
-                    with open(f"uploaded_data/perfmon.blg", "wb") as f:
-                        f.write(perfmon_file.getbuffer())
-                else:
-                    with open(f"uploaded_data/perfmon.csv", "wb") as f:
-                        f.write(perfmon_file.getbuffer())
-            except Exception as e:
-                status.update(label="Error loading the Perfmon File", state="error", expanded=True)
-                st.error(f"Error loading the Perfmon File: {e}")
-                continue_processing=False
-        
-            if continue_processing:  
-                 # if the file is a .BLG file convert it to a .CSV file
-                try: 
-                    if perfmon_file.name.endswith('.blg'):
-                        status.update(label="Converting the BLG to CSV format", state="running", expanded=True)
-                        # Convert the .BLG file to a .CSV file
-                        command = 'relog "uploaded_data/perfmon.blg" -f CSV -o "uploaded_data/perfmon.csv"'
-                        process = subprocess.run(command, shell=True, check=True)
+                status.update(label="Checking for previously processed results", state="running", expanded=False)
+                cache_key = hash_upload([perfmon_file.getbuffer() for perfmon_file in perfmon_files], {**perfmon_cache_parameters, 'blg': [perfmon_file.name.lower().endswith('.blg') for perfmon_file in perfmon_files]})
+                cached_perfmon_pyramid, _ = load_cached_pyramid(cache_key, bucket_intervals)
+                if cached_perfmon_pyramid is not None:
+                    perfmon_pyramid = cached_perfmon_pyramid
+                    cache_hit = True
+            except Exception:
+                # The cache is only an optimisation, so carry on and process the file as normal
+                cache_key = None
+            
+            # Transfer the files to the uploaded_data directory of this session's workspace
+            upload_folder = workspace_folder(st.session_state, 'uploaded_data')
+            perfmon_paths = []
+            for index, perfmon_file in enumerate(perfmon_files):
+                perfmon_extension = 'blg' if perfmon_file.name.lower().endswith('.blg') else 'csv'
+                perfmon_name = f"perfmon.{perfmon_extension}" if len(perfmon_files) == 1 else f"perfmon_{index}.{perfmon_extension}"
+                perfmon_paths.append(os.path.join(upload_folder, perfmon_name))
+            if not cache_hit:
+                try:
+                    for perfmon_file, perfmon_path in zip(perfmon_files, perfmon_paths):
+                        with open(perfmon_path, "wb") as f:
+                            f.write(perfmon_file.getbuffer())
                 except Exception as e:
-                    status.update(label="Error converting the Perfmon File", state="error", expanded=True)
-                    st.error(f"Error converting the Perfmon File: {e}")
+                    status.update(label="Error loading the Perfmon File", state="error", expanded=True)
+                    st.error(f"Error loading the Perfmon File: {e}")
                     continue_processing=False
-                    
-                    
-                status.update(label="Moving contents into a dataframe", state="running", expanded=False)
+        
+            if continue_processing and not cache_hit:  
+                # Read the .BLG (with the Windows PDH library) or .CSV files, parse the timestamps and float32 counters (with " " as missing), drop
+                # the counters and samples without data and sum them into the finest time buckets, one worker process
+                # per file, then align the servers on their common time buckets
+                if len(perfmon_paths) == 1:
+                    status.update(label="Reading the file", state="running", expanded=True)
+                else:
+                    status.update(label=f"Reading {len(perfmon_paths)} files in parallel", state="running", expanded=True)
                 try:
-                    formatted_perfmon_data = pd.read_csv('uploaded_data/perfmon.csv')
+                    perfmon_sums, perfmon_counts = read_perfmon_files(perfmon_paths)
+                    trace.shape(perfmon_sums)
                 except Exception as e:
-                    status.update(label="Error moving contents into a dataframe", state="error", expanded=True)
-                    st.error(f"Error moving contents into a dataframe: {e}")
+                    status.update(label="Error converting the Perfmon File", state="error", expanded=True)
+                    st.error(f"Error converting or reading the Perfmon File: {e}")
                     continue_processing=False
                     
             # Verify mandatory column information
-            if continue_processing:  
+            if continue_processing and not cache_hit:  
                 status.update(label="Checking for mandatory columns", state="running", expanded=False)
-                if not all(column in formatted_perfmon_data.columns for column in required_columns):
+                if not all(column in perfmon_sums.columns for column in required_columns):
                     status.update(label="Required columns are missing", state="error", expanded=True)
-                    missing_columns = [column for column in required_columns if column not in formatted_perfmon_data.columns]
+                    missing_columns = [column for column in required_columns if column not in perfmon_sums.columns]
                     st.error(f"The following required columns are missing from the Perfmon file: {', '.join(missing_columns)}")
                     continue_processing=False
-                    
-            if continue_processing:
-                # Remove empty columns
-                try:
-                    status.update(label="Removing columns with no data", state="running", expanded=False)
-                    formatted_perfmon_data = formatted_perfmon_data.dropna(axis=1, how='all')
-                except Exception as e:
-                    status.update(label="Error removing columns with no data", state="error", expanded=True)
-                    st.error(f"Error removing columns with no data: {e}")
-                    continue_processing=False
             
-            if continue_processing:  
-                # Remove columns that contain only zeros
-                try:
-                    status.update(label="Removing zero-filled columns", state="running", expanded=False)
-                    formatted_perfmon_data = formatted_perfmon_data.loc[:, (formatted_perfmon_data != 0).any(axis=0)]
-                except Exception as e:
-                    status.update(label="Error removing zero-filled columns", state="error", expanded=True)
-                    st.error(f"Error removing zero-filled columns: {e}")
-                    continue_processing=False
-
-            if continue_processing:
-                # Remove rows that contain only zeros
-                try:
-                    status.update(label="Removing rows with all zeros", state="running", expanded=False)
-                    formatted_perfmon_data = formatted_perfmon_data.loc[~(formatted_perfmon_data==0).all(axis=1)]
-                except Exception as e:
-                    status.update(label="Error removing rows with all zeros", state="error", expanded=True)
-                    st.error(f"Error removing rows with all zeros: {e}")
-                    continue_processing=False
-                    
-            if continue_processing:
-                # Round the data to 3 decimal places
-                try:
-                    status.update(label="Rounding to 3 decimal places", state="running", expanded=False)
-                    formatted_perfmon_data = formatted_perfmon_data.round(3)
-                except Exception as e:
-                    status.update(label="Error rounding to 3 decimal places", state="error", expanded=True)
-                    st.error(f"Error rounding to 3 decimal places: {e}")
-                    continue_processing=False
+            # Average the bucket sums into every time bucket size
+            if continue_processing and not cache_hit:
+                for interval in bucket_intervals:
+                    try:
+                        status.update(label=f"Averaging to {bucket_interval_names[interval]} intervals", state="running", expanded=False)
+                        perfmon_pyramid[interval] = average_perfmon_buckets(perfmon_sums, perfmon_counts, interval)
+                        trace.shape(perfmon_pyramid[interval])
+                    except Exception as e:
+                        status.update(label="Error formatting dates", state="error", expanded=True)
+                        st.error(f"Error averaging to {bucket_interval_names[interval]} intervals: {e}")
+                        continue_processing=False
+                        break
             
-            if continue_processing:
+            if continue_processing and not cache_hit and cache_key is not None:
+                # Cache the formatted data so the same file can be reused without processing it again
                 try:
-                    # Format the date format.
-                    status.update(label="Formatting dates", state="running", expanded=False)
-                    formatted_perfmon_data = formatted_perfmon_data.rename(columns={formatted_perfmon_data.columns[0]: "timeStamp"})
-                    # Convert the data in this column to datetime
-                    formatted_perfmon_data['timeStamp'] = pd.to_datetime(formatted_perfmon_data['timeStamp'])
-                    # Round the data in this column to the nearest minute
-                    formatted_perfmon_data['timeStamp'] = formatted_perfmon_data['timeStamp'].dt.round('min')
+                    status.update(label="Caching the formatted data", state="running", expanded=False)
+                    save_cached_pyramid(cache_key, perfmon_pyramid)
                 except Exception as e:
-                    status.update(label="Error formatting dates", state="error", expanded=True)
-                    st.error(f"Error formatting dates: {e}")
-                    continue_processing=False 
+                    st.warning(f"Unable to cache the formatted data: {e}")
                 
             if continue_processing:
-                status.update(label="Finalising the process", state="error", expanded=True)
+                status.update(label="Finalising the process", state="running", expanded=True)
                 
-                # Set the index as the timeStamp
-                formatted_perfmon_data.set_index('timeStamp', inplace=True)  
+                # The rest of the tool works with the default bucket size unless another one is chosen
+                formatted_perfmon_data = perfmon_pyramid[default_interval]
                 
-                # Save the formatted data to a CSV file and into the session state
+                # Save the formatted data to a Parquet file and into the session state
                 try:                  
                     status.update(label="Saving Processed Results", state="running", expanded=False)
                     
-                    # Save the formatted data to the session state
-                    st.session_state["formatted_perfmon_data"] = formatted_perfmon_data
+                    # Hold every pre-aggregated bucket size once in the shared dataset store and keep handles to them (the
+                    # formatted data is the default bucket size) and the server/object/instance/counter breakdown of the
+                    # columns in the session state
+                    release_datasets(st.session_state, ["formatted_perfmon_data", "perfmon_pyramid"])
+                    stored_perfmon_pyramid = store_pyramid(perfmon_pyramid, st.session_state["workspace_id"])
+                    st.session_state["perfmon_pyramid"] = stored_perfmon_pyramid
+                    st.session_state["formatted_perfmon_data"] = stored_perfmon_pyramid.handles[default_interval]
+                    st.session_state["perfmon_counter_metadata"] = perfmon_counter_metadata(formatted_perfmon_data.columns)
                     
-                    # Save the formatted data to a CSV file                   
-                    formatted_perfmon_data.to_csv('formatted_data/perfmon.csv')
+                    # Save the formatted data to a columnar (Parquet) file
+                    save_formatted_data(formatted_perfmon_data, 'perfmon', workspace_folder(st.session_state, 'formatted_data'))
                     
                 except Exception as e:
                     status.update(label="Error saving processed results", state="error", expanded=True)
                     st.error(f"Error saving processed results: {e}")
                     continue_processing=False
                     
+            trace_data = finish_trace(trace, st.session_state.setdefault("stage_traces", {}), workspace_folder(st.session_state, 'trace_data'))
+            # Show how long each step of this page took
+            with st.expander(f"Processing timings ({trace_data['wall_seconds'].sum():.2f} seconds)"):
+                st.dataframe(trace_table(trace_data), hide_index=True, use_container_width=True)
+            
             if continue_processing:
                 status.update(label="Process Completed", state="complete", expanded=True)
                 st.success("Perfmon data has been successfully processed.")
@@ -56,8 +56,8 @@ def extract_min_max_time(data):
 if ('formatted_jmeter_data' not in st.session_state) or ('formatted_perfmon_data' not in st.session_state):
     st.switch_page("main.py")
     
-formatted_jmeter_data=st.session_state.formatted_jmeter_data
-formatted_perfmon_data=st.session_state.formatted_perfmon_data
+formatted_jmeter_data=st.session_state.formatted_jmeter_data.load()
+formatted_perfmon_data=st.session_state.formatted_perfmon_data.load()
 
 jmeter_min_date, jmeter_min_time, jmeter_max_date, jmeter_max_time, jmeter_min_datetime, jmeter_max_datetime, jmeter_duration_seconds_total = extract_min_max_time(formatted_jmeter_data)
 perfmon_min_date, perfmon_min_time, perfmon_max_date, perfmon_max_time, perfmon_min_datetime, perfmon_max_datetime, perfmon_duration_seconds_total = extract_min_max_time(formatted_perfmon_data)
@@ -77,7 +77,8 @@ common_duration_seconds_total = (common_max_datetime - common_min_datetime).tota
 
 
 def display_jmeter_summary():        
-    total_jmeter_transactions = formatted_jmeter_data.shape[0]
+    # The formatted data holds one row per minute, so use the sample count recorded at ingest
+    total_jmeter_transactions = st.session_state.get("jmeter_transaction_count", formatted_jmeter_data.shape[0])
 
     st.subheader("JMeter")
    